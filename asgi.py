@@ -0,0 +1,388 @@
+"""Async (ASGI) serving mode.
+
+Serves the same routes as ``main.app`` but awaits OpenWeather through a pooled
+``httpx`` client and Gemini through its async API, so one worker can keep many
+upstream calls in flight. Validation, response shaping and caching are shared
+with ``main`` so both modes behave identically.
+
+Run with:  hypercorn asgi:app --bind 0.0.0.0:8080 --workers 4
+"""
+import asyncio
+import math
+
+import requests
+from quart import Quart, Response, g, jsonify, render_template, request
+from quart.utils import run_sync, run_sync_iterable
+from quart.wrappers.response import DataBody
+
+import main
+import metrics
+from main import APIError
+from upstream import AsyncUpstreamClient
+
+app = Quart(__name__, template_folder='templates')
+app.json = metrics.timed_json_provider(app.json_provider_class)(app)
+
+# Shares the sync client's circuit breaker: both modes talk to the same upstream.
+openweather_async = AsyncUpstreamClient('openweather', breaker=main.openweather.breaker, **main.UPSTREAM_SETTINGS)
+
+
+async def fetch_openweather(url, params, label, error_message):
+    try:
+        with main.observe_upstream('openweather', label.lower()) as charge:
+            data = await openweather_async.get_json(url, params, on_retry=charge)
+    except requests.exceptions.RequestException as e:
+        raise main.openweather_error(e, label, error_message)
+    main.app.logger.debug("%s: API response: %s", label, data)
+    return data
+
+
+async def fetch_weather(query):
+    data = await fetch_openweather(*main.weather_request(query))
+    weather = main.shape_weather(data)
+    main.history_store.record_weather(data)
+    return weather
+
+
+async def fetch_forecast(query):
+    return main.shape_forecast(await fetch_openweather(*main.forecast_request(query)))
+
+
+async def fetch_air_quality(query):
+    data = await fetch_openweather(*main.air_quality_request(query))
+    air_quality = main.shape_air_quality(data)
+    main.history_store.record_air_quality(query, data)
+    return air_quality
+
+
+async def fetch_location(city):
+    return main.shape_location(await fetch_openweather(*main.location_request(city)), city)
+
+
+async def generate_health_analysis(prompt):
+    if main.GEMINI_BASE_URL:
+        # The REST transport used for custom endpoints has no async client.
+        return await run_sync(main.generate_health_analysis)(prompt)
+    model = main.gemini_model()
+    with main.observe_upstream('gemini', 'generate'):
+        return (await model.generate_content_async(prompt)).text
+
+
+@app.before_request
+async def start_request_metrics():
+    g.request_started = main.begin_request()
+
+
+@app.after_request
+async def record_request_metrics(response):
+    return main.finish_request(response, request.url_rule, request.method, g.request_started)
+
+
+@app.teardown_request
+async def end_request_metrics(exc):
+    if 'request_started' in g:
+        main.IN_FLIGHT.dec()
+
+
+@app.before_request
+async def enforce_rate_limit():
+    wait = main.rate_limit_wait(request.url_rule, request.endpoint, request.remote_addr, request.headers)
+    if wait:
+        return jsonify({"error": main.RATE_LIMIT_MESSAGE}), 429, {'Retry-After': str(math.ceil(wait))}
+
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        version = main.static_version(values['filename'], app.static_folder)
+        if version:
+            values.setdefault('v', version)
+
+
+@app.after_request
+async def finalize_response(response):
+    if request.endpoint == 'static':
+        return main.cache_static(response, request.view_args['filename'], request.args.get('v'), app.static_folder)
+    if not isinstance(response.response, DataBody):
+        return response
+    return main.finalize_body(response, await response.get_data(), request.method, request.headers)
+
+
+@app.before_serving
+async def start_background_tasks():
+    main.start_background_tasks()
+
+
+@app.after_serving
+async def close_clients():
+    await openweather_async.aclose()
+
+
+@app.route('/')
+async def index():
+    favorites = await run_sync(main.list_favorites)()
+    return await render_template('index.html', favorites=main.favorite_snapshots(favorites), live_enabled=True)
+
+
+@app.route('/weather')
+async def get_weather():
+    try:
+        key, query = main.location_query(request.args)
+        main.check_api_key()
+        weather_data = await main.weather_cache.get_or_load_async(key, lambda: fetch_weather(query))
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+    return main.cache_for(jsonify(weather_data), main.weather_cache.fresh_for(key))
+
+
+@app.route('/weather/batch', methods=['GET', 'POST'])
+async def get_weather_batch():
+    try:
+        if request.method == 'POST':
+            body = await request.get_json(force=True, silent=True) or {}
+            queries = main.batch_queries(*main.batch_body(body))
+        else:
+            coords = [dict(zip(('lat', 'lon'), c.split(',', 1))) for c in request.args.getlist('coord')]
+            queries = main.batch_queries(request.args.getlist('city'), coords)
+        main.check_api_key()
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+
+    semaphore = asyncio.Semaphore(main.BATCH_CONCURRENCY)
+
+    async def load(key, label, query):
+        async with semaphore:
+            try:
+                return label, await main.weather_cache.get_or_load_async(key, lambda: fetch_weather(query))
+            except APIError as e:
+                return label, e
+            except Exception as e:
+                app.logger.error(f"WEATHER_BATCH: Unexpected error for {key}: {e}")
+                return label, APIError("Error fetching weather data", 500)
+
+    async def generate():
+        pending = []
+        for key, (label, query) in queries.items():
+            cached = main.weather_cache.get(key)
+            if cached is not None:
+                yield main.batch_line(label, cached).encode('utf-8')
+            else:
+                pending.append(load(key, label, query))
+        for next_done in asyncio.as_completed(pending):
+            label, result = await next_done
+            yield main.batch_line(label, result).encode('utf-8')
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@app.route('/air_quality')
+async def get_air_quality():
+    try:
+        key, query = main.coords_query(request.args)
+        main.check_api_key()
+        air_quality_data = await main.air_quality_cache.get_or_load_async(key, lambda: fetch_air_quality(query))
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+    return main.cache_for(jsonify(air_quality_data), main.air_quality_cache.fresh_for(key))
+
+
+@app.route('/forecast')
+async def get_forecast():
+    try:
+        key, query = main.location_query(request.args)
+        main.check_api_key()
+        forecast = await main.forecast_cache.get_or_load_async(key, lambda: fetch_forecast(query))
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+    return main.cache_for(jsonify(forecast), main.forecast_cache.fresh_for(key))
+
+
+@app.route('/dashboard')
+async def get_dashboard():
+    try:
+        city, location = main.dashboard_query(request.args)
+        if location is None:
+            location = main.gazetteer.lookup(city) or await main.geocode_cache.get_or_load_async(
+                main.make_key(city), lambda: fetch_location(city))
+        key, coords = main.snap_coords(location['lat'], location['lon'])
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+
+    results = await asyncio.gather(
+        main.weather_cache.get_or_load_async(key, lambda: fetch_weather(coords)),
+        main.forecast_cache.get_or_load_async(key, lambda: fetch_forecast(coords)),
+        main.air_quality_cache.get_or_load_async(key, lambda: fetch_air_quality(coords)),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, BaseException) and not isinstance(result, APIError):
+            raise result
+    sections = dict(zip(('weather', 'forecast', 'air_quality'), results))
+    return main.cache_for(jsonify(main.build_dashboard(location, sections)), main.dashboard_max_age(key))
+
+
+@app.route('/cache_stats')
+async def cache_stats():
+    return jsonify(main.cache_report())
+
+
+@app.route('/metrics')
+async def get_metrics():
+    return Response(main.metrics_registry.render(), mimetype=main.METRICS_MIMETYPE)
+
+
+@app.route('/history')
+async def get_history():
+    try:
+        return jsonify(await run_sync(main.load_history)(request.args))
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+
+
+@app.route('/favorites', methods=['GET', 'POST', 'DELETE'])
+async def handle_favorites():
+    if request.method == 'GET':
+        return jsonify(await run_sync(main.list_favorites)())
+
+    data = await request.get_json()
+    city = data.get('city')
+    if not city:
+        return jsonify({"error": "City not provided"}), 400
+
+    if request.method == 'POST':
+        return jsonify(await run_sync(main.add_favorite)(city))
+    return jsonify(await run_sync(main.remove_favorite)(city))
+
+
+@app.route('/favorites/bulk', methods=['POST', 'DELETE'])
+async def handle_favorites_bulk():
+    try:
+        cities = main.bulk_cities(await request.get_json(force=True, silent=True))
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+    return jsonify(await run_sync(main.bulk_update_favorites)(request.method, cities))
+
+
+async def stream_health_analysis(key, prompt):
+    """Async twin of ``main.stream_health_analysis``; the timeout also interrupts a chunk that never arrives."""
+    cached = main.analysis_cache.get(key)
+    if cached is not None:
+        yield main.sse_event('chunk', {'text': cached})
+        yield main.sse_event('done', {'cached': True})
+        return
+    flight, leader = main.analysis_streams.join(key)
+    if not leader:
+        try:
+            async for text in flight.follow_async(main.HEALTH_STREAM_TIMEOUT):
+                yield main.sse_event('chunk', {'text': text})
+        except Exception as e:
+            app.logger.error(f"Error streaming content from Gemini API: {e}")
+            yield main.sse_event('error', {'error': f"Failed to get AI analysis: {str(e)}"})
+            return
+        yield main.sse_event('done', {'cached': False, 'shared': True})
+        return
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + main.HEALTH_STREAM_TIMEOUT
+    parts = []
+    try:
+        model = main.gemini_model()
+        with main.observe_upstream('gemini', 'stream'):
+            response = await asyncio.wait_for(model.generate_content_async(prompt, stream=True), main.HEALTH_STREAM_TIMEOUT)
+            chunks = response.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), deadline - loop.time())
+                except StopAsyncIteration:
+                    break
+                if chunk.text:
+                    parts.append(chunk.text)
+                    flight.append(chunk.text)
+                    yield main.sse_event('chunk', {'text': chunk.text})
+    except asyncio.TimeoutError:
+        main.analysis_streams.finish(key, flight, TimeoutError(f"no complete answer within {main.HEALTH_STREAM_TIMEOUT:g}s"))
+        app.logger.error(f"Gemini stream timed out after {main.HEALTH_STREAM_TIMEOUT:g}s")
+        yield main.sse_event('error', {'error': f"Failed to get AI analysis: no complete answer within {main.HEALTH_STREAM_TIMEOUT:g}s"})
+        return
+    except (asyncio.CancelledError, GeneratorExit):
+        main.analysis_streams.finish(key, flight, RuntimeError("the request generating it was cancelled"))
+        app.logger.info("HEALTH_ANALYSIS: stream cancelled before completion")
+        raise
+    except Exception as e:
+        main.analysis_streams.finish(key, flight, e)
+        app.logger.error(f"Error streaming content from Gemini API: {e}")
+        yield main.sse_event('error', {'error': f"Failed to get AI analysis: {str(e)}"})
+        return
+    main.analysis_cache.set(key, ''.join(parts))
+    main.analysis_streams.finish(key, flight)
+    yield main.sse_event('done', {'cached': False})
+
+
+@app.route('/health_analysis', methods=['POST'])
+async def health_analysis():
+    try:
+        key, prompt = main.health_analysis_request(await request.get_json())
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+
+    try:
+        analysis = await main.analysis_cache.get_or_load_async(key, lambda: generate_health_analysis(prompt))
+        return jsonify({"analysis": analysis})
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+    except Exception as e:
+        app.logger.error(f"Error generating content with Gemini API: {e}")
+        return jsonify({"error": f"Failed to get AI analysis: {str(e)}"}), 500
+
+
+@app.route('/health_analysis/stream', methods=['POST'])
+async def health_analysis_stream():
+    try:
+        key, prompt = main.health_analysis_request(await request.get_json(silent=True))
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+    if main.GEMINI_BASE_URL:
+        body = run_sync_iterable(main.stream_health_analysis(key, prompt))
+    else:
+        body = stream_health_analysis(key, prompt)
+    return Response(body, mimetype='text/event-stream', headers=main.SSE_HEADERS)
+
+
+async def live_events(key, location):
+    """Async twin of main.live_events; the poller thread wakes the loop when it pushes an update.
+
+    Subscribes on the first iteration, so a response whose body never starts
+    leaves nothing behind in the hub.
+    """
+    loop, ready = asyncio.get_running_loop(), asyncio.Event()
+    subscription = main.live_hub.subscribe(key, location, lambda: loop.call_soon_threadsafe(ready.set))
+    if subscription is None:
+        # The hub filled up between the capacity check and the first read.
+        yield main.sse_event('error', {"error": main.LIVE_HUB_FULL})
+        return
+    deadline = loop.time() + main.LIVE_STREAM_DURATION
+    try:
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(ready.wait(), min(main.LIVE_HEARTBEAT, remaining))
+            except asyncio.TimeoutError:
+                pass
+            ready.clear()
+            update = subscription.poll()
+            yield main.sse_event('update', update) if update is not None else ": keep-alive\n\n"
+    finally:
+        subscription.close()
+
+
+@app.route('/live')
+async def live():
+    try:
+        key, location = await run_sync(main.live_request)(request.args)
+        if not main.live_hub.has_room(key):
+            raise APIError(main.LIVE_HUB_FULL, 503)
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+    return Response(live_events(key, location), mimetype='text/event-stream', headers=main.SSE_HEADERS)
@@ -0,0 +1,274 @@
+"""Local stand-in for OpenWeather and the Gemini REST API.
+
+Serves the endpoints the app calls, with deterministic payloads derived from
+the requested location, plus configurable latency and error rate:
+
+* ``GET /data/2.5/weather``, ``/data/2.5/forecast``, ``/data/2.5/air_pollution``
+* ``GET /geo/1.0/direct``
+* ``POST /v1beta/models/<model>:generateContent`` and ``:streamGenerateContent``
+  (JSON array, or SSE with ``?alt=sse``)
+* ``GET /__stats`` (request counts per endpoint) and ``POST /__reset``
+
+Requests without ``appid`` (OpenWeather) or ``key`` / ``x-goog-api-key``
+(Gemini), or with the value ``invalid``, get a 401 like the real services.
+
+Point the app at it with ``OPENWEATHER_BASE_URL`` and ``GEMINI_BASE_URL``.
+Run standalone:  python -m benchmarks.fake_upstream --port 8081 --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+FORECAST_START = 1704067200  # 2024-01-01 00:00 UTC
+CONDITIONS = [('Clear', 'clear sky', '01'), ('Clouds', 'scattered clouds', '03'),
+              ('Rain', 'light rain', '10'), ('Thunderstorm', 'thunderstorm', '11')]
+ANALYSIS = [
+    "### 🌤️ สรุปสภาพอากาศ\n\n*   อากาศร้อนชื้น ควรดื่มน้ำให้เพียงพอ\n",
+    "### 🍃 คุณภาพอากาศ\n\n*   ผู้ที่อยู่ในกลุ่มเสี่ยงควรลดกิจกรรมกลางแจ้ง\n",
+    "### 💡 คำแนะนำ\n\n*   สวมเสื้อผ้าระบายอากาศได้ดีและพกร่มติดตัว\n",
+]
+
+
+def _seed(params):
+    place = params.get('q') or f"{params.get('lat')},{params.get('lon')}"
+    return int(hashlib.sha1(place.lower().encode('utf-8')).hexdigest()[:8], 16)
+
+
+def _coords(params, rng):
+    if params.get('lat') and params.get('lon'):
+        return float(params['lat']), float(params['lon'])
+    return round(rng.uniform(-60, 60), 4), round(rng.uniform(-180, 180), 4)
+
+
+def weather_payload(params):
+    rng = random.Random(_seed(params))
+    lat, lon = _coords(params, rng)
+    main, description, icon = rng.choice(CONDITIONS)
+    temp = round(rng.uniform(-5, 38), 2)
+    return {
+        'coord': {'lon': lon, 'lat': lat},
+        'weather': [{'id': 800, 'main': main, 'description': description, 'icon': icon + 'd'}],
+        'main': {'temp': temp, 'feels_like': temp + 1.5, 'temp_min': temp - 1.2, 'temp_max': temp + 1.4,
+                 'pressure': rng.randint(995, 1025), 'humidity': rng.randint(20, 100)},
+        'wind': {'speed': round(rng.uniform(0, 12), 2), 'deg': rng.randint(0, 359)},
+        'dt': int(time.time()) // 600 * 600,
+        'sys': {'sunrise': FORECAST_START + 23000, 'sunset': FORECAST_START + 66000},
+        'timezone': round(lon / 15) * 3600,
+        'name': (params.get('q') or 'Fake Station').split(',')[0].title(),
+    }
+
+
+def forecast_payload(params):
+    rng = random.Random(_seed(params))
+    lat, lon = _coords(params, rng)
+    items = []
+    for i in range(40):
+        main, description, icon = rng.choice(CONDITIONS)
+        temp = round(rng.uniform(-5, 38), 2)
+        item = {'dt': FORECAST_START + i * 10800, 'pop': round(rng.random(), 2),
+                'main': {'temp': temp, 'temp_min': temp - 1, 'temp_max': temp + 1, 'humidity': rng.randint(20, 100)},
+                'weather': [{'main': main, 'description': description, 'icon': icon + 'd'}]}
+        if main in ('Rain', 'Thunderstorm'):
+            item['rain'] = {'3h': round(rng.uniform(0, 6), 2)}
+        items.append(item)
+    return {'list': items, 'city': {'name': 'Fake Station', 'coord': {'lat': lat, 'lon': lon},
+                                    'timezone': round(lon / 15) * 3600}}
+
+
+def air_pollution_payload(params):
+    rng = random.Random(_seed(params))
+    lat, lon = _coords(params, rng)
+    components = {name: round(rng.uniform(0, high), 2) for name, high in
+                  (('co', 900), ('no', 20), ('no2', 60), ('o3', 150), ('so2', 30), ('pm2_5', 90),
+                   ('pm10', 150), ('nh3', 20))}
+    return {'coord': {'lon': lon, 'lat': lat},
+            'list': [{'main': {'aqi': rng.randint(1, 5)}, 'components': components,
+                      'dt': int(time.time()) // 3600 * 3600}]}
+
+
+def geocoding_payload(params):
+    rng = random.Random(_seed(params))
+    lat, lon = _coords(params, rng)
+    name = params.get('q', '').split(',')[0].strip()
+    if not name or name.lower() == 'atlantis':
+        return []
+    return [{'name': name.title(), 'lat': lat, 'lon': lon, 'country': 'XX'}]
+
+
+def gemini_chunk(text, last):
+    chunk = {'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}, 'index': 0}]}
+    if last:
+        chunk['candidates'][0]['finishReason'] = 'STOP'
+    return chunk
+
+
+OPENWEATHER_ROUTES = {
+    '/data/2.5/weather': weather_payload,
+    '/data/2.5/forecast': forecast_payload,
+    '/data/2.5/air_pollution': air_pollution_payload,
+    '/geo/1.0/direct': geocoding_payload,
+}
+
+
+class FakeUpstream:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _delay(self):
+        with self._lock:
+            delay = self.latency + self._rng.uniform(-self.jitter, self.jitter) if self.jitter else self.latency
+            fail = self._rng.random() < self.error_rate
+        if delay > 0:
+            time.sleep(delay)
+        return fail
+
+    def count(self, endpoint):
+        with self._lock:
+            self._counts[endpoint] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts, total=sum(self._counts.values()))
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+    def start(self, host='127.0.0.1', port=0):
+        upstream = self
+
+        class Handler(_Handler):
+            fake = upstream
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-upstream', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start() if self._server is None else self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    fake = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path == '/__stats':
+            return self._send_json(200, self.fake.stats())
+        handler = OPENWEATHER_ROUTES.get(url.path)
+        if handler is None:
+            return self._send_json(404, {'cod': '404', 'message': 'Not found'})
+        self.fake.count(url.path)
+        fail = self.fake._delay()
+        if params.get('appid') in (None, '', 'invalid'):
+            return self._send_json(401, {'cod': 401, 'message': 'Invalid API key.'})
+        if fail:
+            return self._send_json(500, {'cod': '500', 'message': 'Internal error'})
+        self._send_json(200, handler(params))
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        if url.path == '/__reset':
+            self.fake.reset()
+            return self._send_json(200, {'reset': True})
+        if not url.path.startswith('/v1beta/models/'):
+            return self._send_json(404, {'error': {'code': 404, 'message': 'Not found'}})
+        method = url.path.rsplit(':', 1)[-1]
+        self.fake.count(f"gemini:{method}")
+        key = params.get('key') or self.headers.get('x-goog-api-key')
+        if key in (None, '', 'invalid'):
+            return self._send_json(401, {'error': {'code': 401, 'message': 'API key not valid.',
+                                                   'status': 'UNAUTHENTICATED'}})
+        if self.fake._delay():
+            return self._send_json(500, {'error': {'code': 500, 'message': 'Internal error', 'status': 'INTERNAL'}})
+        if method == 'generateContent':
+            return self._send_json(200, gemini_chunk(''.join(ANALYSIS), last=True))
+        if method == 'streamGenerateContent':
+            return self._stream(sse=params.get('alt') == 'sse')
+        self._send_json(404, {'error': {'code': 404, 'message': f'Unknown method {method}'}})
+
+    def _stream(self, sse):
+        """Send the analysis in chunks, spaced by the configured latency, without a Content-Length."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream' if sse else 'application/json; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i, text in enumerate(ANALYSIS):
+            if i:
+                time.sleep(self.fake.latency)
+            chunk = json.dumps(gemini_chunk(text, last=i == len(ANALYSIS) - 1), ensure_ascii=False)
+            if sse:
+                piece = f"data: {chunk}\r\n\r\n"
+            else:
+                piece = ('[' if i == 0 else ',\r\n') + chunk + (']' if i == len(ANALYSIS) - 1 else '')
+            self._write_chunk(piece.encode('utf-8'))
+        self._write_chunk(b'')
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local OpenWeather/Gemini stand-in.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='+/- seconds of random latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 500')
+    args = parser.parse_args()
+    fake = FakeUpstream(args.latency, args.jitter, args.error_rate).start(args.host, args.port)
+    print(f"fake upstream listening on {fake.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
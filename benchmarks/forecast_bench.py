@@ -0,0 +1,98 @@
+"""Micro-benchmark for forecast aggregation.
+
+Compares the previous per-request implementation (kept below as ``legacy``)
+with ``forecast.aggregate_daily`` and ``forecast.aggregate_many`` on synthetic
+40-entry forecasts, and prints the throughput in cities per second.
+
+Run from the repository root:  python -m benchmarks.forecast_bench [--cities 1000]
+"""
+import argparse
+import datetime
+import random
+import time
+from collections import defaultdict
+
+import forecast
+
+CONDITIONS = [('Clear', '01'), ('Clouds', '03'), ('Rain', '10'), ('Drizzle', '09'), ('Thunderstorm', '11')]
+
+
+def synthetic_forecast(rng, start=1704067200):
+    offset = rng.choice(range(-12, 15)) * 3600
+    items = []
+    for i in range(40):
+        condition, icon = rng.choice(CONDITIONS)
+        temp = rng.uniform(5, 35)
+        item = {
+            'dt': start + i * 10800,
+            'main': {'temp': temp, 'temp_min': temp - rng.uniform(0, 2), 'temp_max': temp + rng.uniform(0, 2)},
+            'weather': [{'main': condition, 'icon': icon + 'd'}],
+            'pop': rng.random(),
+        }
+        if condition in ('Rain', 'Drizzle', 'Thunderstorm'):
+            item['rain'] = {'3h': rng.uniform(0, 5)}
+        items.append(item)
+    return items, offset
+
+
+def legacy(items, tz_offset):
+    """The aggregation main.shape_forecast did before forecast.py (server-local days, quadratic icon fallback)."""
+    daily = defaultdict(lambda: {'temp_min': float('inf'), 'temp_max': float('-inf'),
+                                 'weather': defaultdict(int), 'icon': '', 'date': ''})
+    for item in items:
+        dt_object = datetime.datetime.fromtimestamp(item['dt'])
+        date_key = dt_object.strftime('%Y-%m-%d')
+        daily[date_key]['date'] = dt_object.strftime('%a, %b %d')
+        daily[date_key]['temp_min'] = min(daily[date_key]['temp_min'], item['main']['temp_min'])
+        daily[date_key]['temp_max'] = max(daily[date_key]['temp_max'], item['main']['temp_max'])
+        daily[date_key]['weather'][item['weather'][0]['main']] += 1
+        if 12 <= dt_object.hour < 15:
+            daily[date_key]['icon'] = item['weather'][0]['icon']
+    result = []
+    for date_key in sorted(daily):
+        day = daily[date_key]
+        if not day['icon']:
+            for item in items:
+                if datetime.datetime.fromtimestamp(item['dt']).strftime('%Y-%m-%d') == date_key:
+                    day['icon'] = item['weather'][0]['icon']
+                    break
+        result.append({'date': day['date'], 'temp_min': round(day['temp_min']), 'temp_max': round(day['temp_max']),
+                       'description': max(day['weather'], key=day['weather'].get), 'icon': day['icon'] or '01d'})
+    return result[:5]
+
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cities', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    forecasts = [synthetic_forecast(rng) for _ in range(args.cities)]
+    cases = [
+        ('legacy (per city)', lambda: [legacy(items, offset) for items, offset in forecasts]),
+        ('aggregate_daily (per city)', lambda: [forecast.aggregate_daily(items, offset) for items, offset in forecasts]),
+    ]
+    if forecast.np is not None:
+        cases.append(('aggregate_many (numpy)', lambda: forecast.aggregate_many(forecasts)))
+    else:
+        print('numpy not installed; skipping the vectorized path')
+
+    print(f"{args.cities} cities x 40 entries, best of {args.repeat}")
+    for label, fn in cases:
+        seconds = best_of(args.repeat, fn)
+        print(f"  {label:<28} {seconds * 1000:8.1f} ms  {args.cities / seconds:10.0f} cities/s  "
+              f"{seconds / args.cities * 1e6:7.1f} us/city")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+"""Load test the app against the local upstream stand-in.
+
+Starts ``benchmarks.fake_upstream`` in-process, then for each concurrency
+level launches a fresh app server (``wsgi``: Flask's threaded server, ``asgi``:
+hypercorn) pointed at it through ``OPENWEATHER_BASE_URL`` / ``GEMINI_BASE_URL``
+with throwaway databases, and drives a mix of routes for ``--duration``
+seconds. Reported per level, overall and per route:
+
+* latency p50 / p95 / p99 (ms), requests per second, error count
+* upstream calls per request (counted by the fake upstream)
+* server RSS at the end of the level and its peak (Linux only)
+
+Results are written as JSON (with the current commit) so runs on different
+commits can be compared with ``--compare``.
+
+Run from the repository root:
+    python -m benchmarks.load_test --mode wsgi --concurrency 1,8,32 --duration 10 --latency 0.05
+    python -m benchmarks.load_test --compare benchmarks/results/<old>.json benchmarks/results/<new>.json
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from benchmarks.fake_upstream import FakeUpstream
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+HEALTH_PAYLOAD = {
+    'weather_data': {'temperature': 30.2, 'description': 'Clear sky', 'humidity': 71, 'wind_speed': 10.3},
+    'air_quality_data': {'aqi': 3, 'description': 'Moderate', 'components': {'pm2_5': 35.4}},
+}
+WSGI_SERVER = ("import main; app = main.create_app(); "
+               "app.run(host='127.0.0.1', port={port}, threaded=True)")
+
+
+def route_requests(route, rng, cities):
+    """Return (method, path, json) for one request to ``route``."""
+    city = rng.choice(cities)
+    if route in ('weather', 'forecast', 'dashboard'):
+        return 'GET', f"/{route}?city={city}", None
+    if route == 'air_quality':
+        return 'GET', f"/air_quality?lat={rng.uniform(13.6, 13.9):.4f}&lon={rng.uniform(100.4, 100.7):.4f}", None
+    if route == 'health_analysis':
+        payload = json.loads(json.dumps(HEALTH_PAYLOAD))
+        payload['weather_data']['temperature'] = rng.choice(range(25, 35))
+        return 'POST', '/health_analysis', payload
+    raise ValueError(f"unknown route {route!r}")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def process_tree(pid):
+    """``pid`` and its descendants (hypercorn serves from child processes)."""
+    pids = [pid]
+    for parent in pids:
+        try:
+            for task in os.listdir(f"/proc/{parent}/task"):
+                with open(f"/proc/{parent}/task/{task}/children") as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def memory_kb(pid):
+    """(current, peak) resident set size of the server processes in KiB, or (None, None) without /proc."""
+    totals = {}
+    for process in process_tree(pid):
+        try:
+            with open(f"/proc/{process}/status") as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in ('VmRSS', 'VmHWM'):
+                        totals[key] = totals.get(key, 0) + int(value.split()[0])
+        except OSError:
+            pass
+    return totals.get('VmRSS'), totals.get('VmHWM')
+
+
+def start_server(mode, port, upstream_url, workdir):
+    env = dict(os.environ,
+               API_KEY='load-test', GEMINI_API_KEY='load-test',
+               OPENWEATHER_BASE_URL=upstream_url, GEMINI_BASE_URL=upstream_url,
+               DATABASE_PATH=os.path.join(workdir, 'database.db'),
+               CACHE_DB_PATH=os.path.join(workdir, 'cache.db'),
+               ANALYSIS_CACHE_DB_PATH=os.path.join(workdir, 'cache.db'),
+               BUDGET_DB_PATH=os.path.join(workdir, 'cache.db'),
+               HISTORY_DB_PATH=os.path.join(workdir, 'history.db'),
+               FAVORITES_WARM_INTERVAL='0',
+               # Every simulated client shares one IP, and the fake upstream has no quota.
+               RATE_LIMIT_PER_MINUTE='0', HEALTH_RATE_LIMIT_PER_MINUTE='0',
+               OPENWEATHER_CALLS_PER_MINUTE='0', OPENWEATHER_CALLS_PER_DAY='0',
+               GEMINI_CALLS_PER_MINUTE='0', GEMINI_CALLS_PER_DAY='0')
+    if mode == 'wsgi':
+        command = [sys.executable, '-c', WSGI_SERVER.format(port=port)]
+    else:
+        command = [sys.executable, '-m', 'hypercorn', 'asgi:app', '--bind', f"127.0.0.1:{port}"]
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{mode} server exited with code {process.returncode}")
+        try:
+            requests.get(url + '/cache_stats', timeout=1)
+            return process, url
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{mode} server did not start within 30s")
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples, elapsed, upstream_calls=None):
+    latencies = sorted(latency for latency, ok in samples)
+    summary = {
+        'requests': len(samples),
+        'errors': sum(1 for latency, ok in samples if not ok),
+        'rps': round(len(samples) / elapsed, 1),
+        'p50_ms': None, 'p95_ms': None, 'p99_ms': None,
+    }
+    for name, fraction in (('p50_ms', 0.50), ('p95_ms', 0.95), ('p99_ms', 0.99)):
+        value = percentile(latencies, fraction)
+        summary[name] = round(value * 1000, 2) if value is not None else None
+    if upstream_calls is not None:
+        summary['upstream_calls'] = upstream_calls
+        summary['upstream_per_request'] = round(upstream_calls / len(samples), 3) if samples else None
+    return summary
+
+
+def run_level(url, routes, concurrency, duration, cities, seed):
+    stop = time.monotonic() + duration
+    samples = {route: [] for route in routes}
+    lock = threading.Lock()
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        session = requests.Session()
+        local = {route: [] for route in routes}
+        while time.monotonic() < stop:
+            route = rng.choice(routes)
+            method, path, payload = route_requests(route, rng, cities)
+            started = time.perf_counter()
+            try:
+                ok = session.request(method, url + path, json=payload, timeout=60).status_code < 400
+            except requests.exceptions.RequestException:
+                ok = False
+            local[route].append((time.perf_counter() - started, ok))
+        with lock:
+            for route, values in local.items():
+                samples[route].extend(values)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.monotonic() - started
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    routes = args.routes.split(',')
+    cities = [f"Loadtown {i}" for i in range(args.cities)]
+    result = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'mode': args.mode,
+        'config': {'routes': routes, 'duration': args.duration, 'cities': args.cities,
+                   'latency': args.latency, 'error_rate': args.error_rate, 'seed': args.seed},
+        'levels': [],
+    }
+    with FakeUpstream(args.latency, args.jitter, args.error_rate, args.seed) as fake:
+        for concurrency in (int(level) for level in args.concurrency.split(',')):
+            with tempfile.TemporaryDirectory() as workdir:
+                process, url = start_server(args.mode, free_port(), fake.url, workdir)
+                try:
+                    fake.reset()
+                    samples, elapsed = run_level(url, routes, concurrency, args.duration, cities, args.seed)
+                    rss_kb, peak_rss_kb = memory_kb(process.pid)
+                finally:
+                    process.terminate()
+                    process.wait(timeout=10)
+            upstream = fake.stats()
+            level = {'concurrency': concurrency,
+                     'overall': summarize([s for values in samples.values() for s in values], elapsed,
+                                          upstream['total']),
+                     'routes': {route: summarize(values, elapsed) for route, values in samples.items()},
+                     'upstream': upstream, 'rss_kb': rss_kb, 'peak_rss_kb': peak_rss_kb}
+            result['levels'].append(level)
+            print_level(level)
+    return result
+
+
+def print_level(level):
+    overall = level['overall']
+    memory = f"  rss {level['rss_kb'] / 1024:.1f} MiB (peak {level['peak_rss_kb'] / 1024:.1f})" if level['rss_kb'] else ''
+    print(f"c={level['concurrency']:<4} {overall['rps']:8.1f} rps  p50 {overall['p50_ms']} ms  p95 {overall['p95_ms']} ms  "
+          f"p99 {overall['p99_ms']} ms  errors {overall['errors']}  "
+          f"upstream/req {overall['upstream_per_request']}{memory}")
+    for route, stats in level['routes'].items():
+        print(f"    {route:<16} {stats['requests']:6d} req  p50 {stats['p50_ms']} ms  p95 {stats['p95_ms']} ms  "
+              f"p99 {stats['p99_ms']} ms  errors {stats['errors']}")
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old.get('commit')} -> {new.get('commit')} ({old['mode']} -> {new['mode']})")
+    old_levels = {level['concurrency']: level for level in old['levels']}
+    for level in new['levels']:
+        before = old_levels.get(level['concurrency'])
+        if before is None:
+            continue
+        changes = []
+        for name in ('rps', 'p50_ms', 'p95_ms', 'p99_ms', 'upstream_per_request'):
+            a, b = before['overall'].get(name), level['overall'].get(name)
+            if a and b is not None:
+                changes.append(f"{name} {a} -> {b} ({(b - a) / a * 100:+.1f}%)")
+        if before.get('peak_rss_kb') and level.get('peak_rss_kb'):
+            changes.append(f"peak_rss_kb {before['peak_rss_kb']} -> {level['peak_rss_kb']}")
+        print(f"c={level['concurrency']:<4} " + '  '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the app against a local OpenWeather/Gemini stand-in.')
+    parser.add_argument('--mode', choices=('wsgi', 'asgi'), default='wsgi')
+    parser.add_argument('--concurrency', default='1,8,32', help='comma-separated client counts')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per concurrency level')
+    parser.add_argument('--routes', default='weather,forecast,air_quality,dashboard,health_analysis')
+    parser.add_argument('--cities', type=int, default=50, help='distinct cities requested (fewer = more cache hits)')
+    parser.add_argument('--latency', type=float, default=0.05, help='fake upstream latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='result file (default benchmarks/results/<commit>-<mode>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    result = run(args)
+    output = args.output or os.path.join(RESULTS_DIR, f"{result['commit'] or 'unknown'}-{args.mode}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"saved {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Cold-start and memory benchmark.
+
+Measures, each in fresh processes:
+
+* ``import main``: wall time and peak RSS of the interpreter
+* a gunicorn server (``gunicorn.conf.py`` is picked up from the repository
+  root when present): time from spawn until the first ``/weather`` answer,
+  then RSS and PSS of the master and each worker. PSS splits pages shared
+  between processes (e.g. preloaded before fork) evenly, so it is the
+  honest per-worker cost.
+
+Upstream calls go to ``benchmarks.fake_upstream``.
+
+Run from the repository root:  python -m benchmarks.startup_bench [--repeat 5] [--workers 4] [--app main:app]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from benchmarks.fake_upstream import FakeUpstream
+from benchmarks.load_test import ROOT, free_port, process_tree
+
+IMPORT_PROBE = ("import json, resource, time; started = time.perf_counter(); import main; "
+                "print(json.dumps({'seconds': time.perf_counter() - started, "
+                "'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))")
+
+
+def memory(pid):
+    """RSS and PSS of one process in KiB (PSS needs /proc/<pid>/smaps_rollup)."""
+    values = {}
+    for path, keys in ((f"/proc/{pid}/status", ('VmRSS',)), (f"/proc/{pid}/smaps_rollup", ('Pss',))):
+        try:
+            with open(path) as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in keys:
+                        values[key] = int(value.split()[0])
+        except OSError:
+            pass
+    return {'rss_kb': values.get('VmRSS'), 'pss_kb': values.get('Pss')}
+
+
+def environment(upstream_url, workdir):
+    return dict(os.environ, API_KEY='bench', GEMINI_API_KEY='bench',
+                OPENWEATHER_BASE_URL=upstream_url, GEMINI_BASE_URL=upstream_url,
+                DATABASE_PATH=os.path.join(workdir, 'database.db'),
+                ANALYSIS_CACHE_DB_PATH=os.path.join(workdir, 'cache.db'),
+                BUDGET_DB_PATH=os.path.join(workdir, 'cache.db'),
+                HISTORY_DB_PATH=os.path.join(workdir, 'history.db'),
+                FAVORITES_WARM_INTERVAL='0')
+
+
+def measure_import(env):
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_PROBE], cwd=ROOT, env=env, text=True,
+                                     stderr=subprocess.DEVNULL)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure_server(env, app, workers):
+    port = free_port()
+    env = dict(env, WEB_CONCURRENCY=str(workers))
+    started = time.perf_counter()
+    command = [sys.executable, '-m', 'gunicorn', '--bind', f"127.0.0.1:{port}", '--workers', str(workers)]
+    process = subprocess.Popen(command + ([app] if app else []), cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with code {process.returncode}")
+            if time.perf_counter() - started > 60:
+                raise RuntimeError("gunicorn did not answer within 60s")
+            try:
+                if requests.get(f"http://127.0.0.1:{port}/weather?city=Bangkok", timeout=5).status_code == 200:
+                    break
+            except requests.exceptions.ConnectionError:
+                time.sleep(0.05)
+        first_response = time.perf_counter() - started
+        # Let every worker finish booting before reading memory.
+        time.sleep(1.0)
+        pids = process_tree(process.pid)
+        return {'first_response_s': first_response, 'master': memory(pids[0]),
+                'workers': [memory(pid) for pid in pids[1:]]}
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold-start and memory benchmark.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--app', help="gunicorn application spec (default: wsgi_app from gunicorn.conf.py)")
+    args = parser.parse_args()
+
+    with FakeUpstream() as fake, tempfile.TemporaryDirectory() as workdir:
+        env = environment(fake.url, workdir)
+        imports = [measure_import(env) for _ in range(args.repeat)]
+        print(f"import main      {statistics.median(i['seconds'] for i in imports) * 1000:7.0f} ms  "
+              f"peak rss {statistics.median(i['peak_rss_kb'] for i in imports) / 1024:6.1f} MiB  "
+              f"(median of {args.repeat})")
+        try:
+            import gunicorn  # noqa: F401
+        except ImportError:
+            print('gunicorn not installed; skipping the server measurement')
+            return
+        servers = [measure_server(env, args.app, args.workers) for _ in range(max(1, args.repeat // 2))]
+        last = servers[-1]
+        workers = [w for w in last['workers'] if w['rss_kb']]
+        print(f"first response   {statistics.median(s['first_response_s'] for s in servers) * 1000:7.0f} ms  "
+              f"({args.app or 'gunicorn.conf.py'}, {args.workers} workers)")
+        print(f"master           rss {last['master']['rss_kb'] / 1024:6.1f} MiB  pss {last['master']['pss_kb'] / 1024:6.1f} MiB")
+        if workers:
+            print(f"per worker (avg) rss {statistics.mean(w['rss_kb'] for w in workers) / 1024:6.1f} MiB  "
+                  f"pss {statistics.mean(w['pss_kb'] for w in workers) / 1024:6.1f} MiB  ({len(workers)} workers)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,647 @@
+"""Cache for upstream API results.
+
+``TTLCache`` keeps each entry fresh for ``ttl`` seconds and may then serve it
+stale for another ``stale_ttl`` seconds while a single background refresh
+runs. Concurrent misses for the same key share one loader call (single-flight).
+``get_or_load_async`` offers the same behaviour to coroutines.
+
+Entries live in a pluggable backend:
+
+* ``MemoryBackend`` - per-process LRU dictionary (default).
+* ``SQLiteBackend`` - a WAL-mode SQLite file shared by every worker on a host.
+* ``RedisBackend`` - any server speaking the Redis protocol, shared across hosts.
+
+Shared backends also hand out short-lived locks so only one worker refreshes
+a given key; the others wait for its result instead of calling upstream, and
+expiring counters (``incr`` to change, ``counter`` to read) that every worker
+sees, used for upstream budgets.
+
+``StreamFlights`` is single-flight for streamed loads: the first caller for a
+key produces the stream, and callers arriving meanwhile replay its parts
+(``follow`` / ``follow_async``) instead of starting their own.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger(__name__)
+
+CacheEntry = namedtuple('CacheEntry', ['value', 'fresh_until', 'stale_until'])
+
+
+def make_key(city=None, lat=None, lon=None, precision=2):
+    """Normalize a city name or a lat/lon pair into a cache key."""
+    if lat and lon:
+        try:
+            return f"coord:{float(lat):.{precision}f},{float(lon):.{precision}f}"
+        except ValueError:
+            return f"coord:{lat},{lon}"
+    return f"city:{(city or '').strip().lower()}"
+
+
+def dumps(value):
+    """Serialize a JSON-compatible value into a compact compressed blob."""
+    return zlib.compress(json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
+
+
+def loads(blob):
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+class MemoryBackend:
+    name = 'memory'
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self, prefix=''):
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                del self._entries[key]
+            for key in [k for k in self._counters if k.startswith(prefix)]:
+                del self._counters[key]
+
+    def incr(self, key, amount=1, ttl=None):
+        """Add ``amount`` to the counter ``key`` (created at 0, dropped ``ttl`` seconds after creation); returns the new value."""
+        now = time.time()
+        with self._lock:
+            value, expires = self._counters.get(key, (0, None))
+            if expires is not None and expires <= now:
+                value, expires = 0, None
+            if expires is None and ttl is not None:
+                expires = now + ttl
+                # A new counter usually means a new window; drop the ones whose windows have passed.
+                for name in [k for k, (_, until) in self._counters.items() if until is not None and until <= now]:
+                    del self._counters[name]
+            self._counters[key] = (value + amount, expires)
+            return value + amount
+
+    def counter(self, key):
+        """Current value of the counter ``key`` (0 if missing or expired)."""
+        with self._lock:
+            value, expires = self._counters.get(key, (0, None))
+        return 0 if expires is not None and expires <= time.time() else value
+
+    def acquire_lock(self, key, timeout):
+        # Within one process the cache's own single-flight already serializes loads.
+        return 'local'
+
+    def release_lock(self, key, token):
+        pass
+
+    def stats(self):
+        with self._lock:
+            return {'backend': self.name, 'size': len(self._entries), 'evictions': self._evictions}
+
+
+class SQLiteBackend:
+    """Cache entries in a SQLite file opened in WAL mode, shared between processes.
+
+    To keep reads from turning into writes, a hit only records its access time
+    when the stored one is more than ``touch_interval`` seconds old. The size is
+    checked every ``max_entries // 10`` inserts rather than on each one, so the
+    table may briefly hold somewhat more than ``max_entries`` rows.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path='cache.db', max_entries=10000, touch_interval=60.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self._evict_every = max(1, max_entries // 10)
+        self._sets = 0
+        self._local = threading.local()
+        self._evictions = 0
+        conn = self._connect()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                fresh_until REAL NOT NULL,
+                stale_until REAL NOT NULL,
+                accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS cache_entries_accessed ON cache_entries (accessed);
+            CREATE TABLE IF NOT EXISTS cache_locks (
+                key TEXT PRIMARY KEY,
+                token TEXT NOT NULL,
+                expires REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS cache_counters (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL,
+                expires REAL NOT NULL
+            );
+        ''')
+
+    def _connect(self):
+        # A connection inherited from a pre-fork parent is never reused in the child.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        row = conn.execute('SELECT value, fresh_until, stale_until, accessed FROM cache_entries WHERE key = ?',
+                           (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if row[2] <= now:
+            conn.execute('DELETE FROM cache_entries WHERE key = ? AND stale_until <= ?', (key, now))
+            return None
+        if now - row[3] >= self.touch_interval:
+            conn.execute('UPDATE cache_entries SET accessed = ? WHERE key = ?', (now, key))
+        return CacheEntry(loads(row[0]), row[1], row[2])
+
+    def set(self, key, entry):
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            'INSERT OR REPLACE INTO cache_entries (key, value, fresh_until, stale_until, accessed) VALUES (?, ?, ?, ?, ?)',
+            (key, dumps(entry.value), entry.fresh_until, entry.stale_until, now))
+        self._sets += 1
+        if self._sets % self._evict_every:
+            return
+        overflow = conn.execute('SELECT COUNT(*) FROM cache_entries').fetchone()[0] - self.max_entries
+        if overflow > 0:
+            conn.execute('DELETE FROM cache_entries WHERE key IN '
+                         '(SELECT key FROM cache_entries ORDER BY accessed LIMIT ?)', (overflow,))
+            self._evictions += overflow
+
+    def delete(self, key):
+        self._connect().execute('DELETE FROM cache_entries WHERE key = ?', (key,))
+
+    def clear(self, prefix=''):
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        conn = self._connect()
+        conn.execute("DELETE FROM cache_entries WHERE key LIKE ? ESCAPE '\\'", (escaped + '%',))
+        conn.execute("DELETE FROM cache_counters WHERE key LIKE ? ESCAPE '\\'", (escaped + '%',))
+
+    def incr(self, key, amount=1, ttl=None):
+        now = time.time()
+        expires = now + ttl if ttl is not None else float('inf')
+        conn = self._connect()
+        # An expired counter restarts from ``amount`` in the same atomic upsert.
+        value = conn.execute(
+            'INSERT INTO cache_counters (key, value, expires) VALUES (?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET '
+            'value = CASE WHEN cache_counters.expires <= ? THEN excluded.value ELSE cache_counters.value + excluded.value END, '
+            'expires = CASE WHEN cache_counters.expires <= ? THEN excluded.expires ELSE cache_counters.expires END '
+            'RETURNING value',
+            (key, amount, expires, now, now)).fetchone()[0]
+        if value == amount:
+            conn.execute('DELETE FROM cache_counters WHERE expires <= ?', (now,))
+        return value
+
+    def counter(self, key):
+        row = self._connect().execute('SELECT value FROM cache_counters WHERE key = ? AND expires > ?',
+                                      (key, time.time())).fetchone()
+        return row[0] if row is not None else 0
+
+    def acquire_lock(self, key, timeout):
+        token = uuid.uuid4().hex
+        now = time.time()
+        cursor = self._connect().execute(
+            'INSERT INTO cache_locks (key, token, expires) VALUES (?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET token = excluded.token, expires = excluded.expires '
+            'WHERE cache_locks.expires <= ?',
+            (key, token, now + timeout, now))
+        return token if cursor.rowcount == 1 else None
+
+    def release_lock(self, key, token):
+        self._connect().execute('DELETE FROM cache_locks WHERE key = ? AND token = ?', (key, token))
+
+    def stats(self):
+        size = self._connect().execute('SELECT COUNT(*) FROM cache_entries').fetchone()[0]
+        return {'backend': self.name, 'size': size, 'evictions': self._evictions}
+
+
+class RedisBackend:
+    """Cache entries in a Redis-protocol server.
+
+    ``client`` only needs ``get``, ``set`` (with ``nx``/``px``), ``delete``,
+    ``incrby``, ``pexpire`` and ``scan_iter``, so any redis-py compatible client works. Eviction is left to
+    the server's ``maxmemory-policy``.
+    """
+
+    name = 'redis'
+
+    def __init__(self, client, prefix='weatherairquality:'):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("CACHE_BACKEND=redis requires the 'redis' package (pip install redis)") from e
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, key):
+        blob = self.client.get(self.prefix + key)
+        if blob is None:
+            return None
+        value, fresh_until, stale_until = loads(blob)
+        return CacheEntry(value, fresh_until, stale_until)
+
+    def set(self, key, entry):
+        ttl_ms = max(1, int((entry.stale_until - time.time()) * 1000))
+        self.client.set(self.prefix + key, dumps(list(entry)), px=ttl_ms)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self, prefix=''):
+        for key in self.client.scan_iter(match=self.prefix + prefix + '*'):
+            self.client.delete(key)
+
+    def incr(self, key, amount=1, ttl=None):
+        value = self.client.incrby(self.prefix + key, amount)
+        if value == amount and ttl is not None:
+            self.client.pexpire(self.prefix + key, max(1, int(ttl * 1000)))
+        return value
+
+    def counter(self, key):
+        value = self.client.get(self.prefix + key)
+        return int(value) if value is not None else 0
+
+    def acquire_lock(self, key, timeout):
+        token = uuid.uuid4().hex
+        if self.client.set(self.prefix + 'lock:' + key, token, nx=True, px=int(timeout * 1000)):
+            return token
+        return None
+
+    def release_lock(self, key, token):
+        lock_key = self.prefix + 'lock:' + key
+        current = self.client.get(lock_key)
+        if current is not None and (current.decode() if isinstance(current, bytes) else current) == token:
+            self.client.delete(lock_key)
+
+    def stats(self):
+        return {'backend': self.name}
+
+
+class _Flight:
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class StreamFlight:
+    """Parts of one in-flight streamed load, for followers to replay from the start."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._wakeups = []
+        self.parts = []
+        self.done = False
+        self.error = None
+
+    def _changed(self):
+        self._cond.notify_all()
+        for wakeup in self._wakeups:
+            wakeup()
+
+    def append(self, part):
+        with self._cond:
+            self.parts.append(part)
+            self._changed()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._changed()
+
+    def _read(self, index):
+        # Call with the condition held.
+        return self.parts[index:], self.done and index >= len(self.parts)
+
+    def follow(self, timeout):
+        """Yield every part as the leader produces it; raises its error, or TimeoutError after ``timeout`` seconds."""
+        deadline = time.monotonic() + timeout
+        index = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self.done or len(self.parts) > index, max(deadline - time.monotonic(), 0))
+                parts, finished = self._read(index)
+            if finished:
+                break
+            if not parts:
+                raise TimeoutError(f"no complete answer within {timeout:g}s")
+            index += len(parts)
+            yield from parts
+        if self.error is not None:
+            raise self.error
+
+    async def follow_async(self, timeout):
+        """Async version of ``follow``; the leader may run in another thread."""
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        wakeup = lambda: loop.call_soon_threadsafe(ready.set)
+        deadline = loop.time() + timeout
+        index = 0
+        with self._cond:
+            self._wakeups.append(wakeup)
+        try:
+            while True:
+                ready.clear()
+                with self._cond:
+                    parts, finished = self._read(index)
+                if finished:
+                    break
+                if not parts:
+                    try:
+                        await asyncio.wait_for(ready.wait(), deadline - loop.time())
+                    except asyncio.TimeoutError:
+                        raise TimeoutError(f"no complete answer within {timeout:g}s") from None
+                    continue
+                index += len(parts)
+                for part in parts:
+                    yield part
+        finally:
+            with self._cond:
+                self._wakeups.remove(wakeup)
+        if self.error is not None:
+            raise self.error
+
+
+class StreamFlights:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.stats = {'leaders': 0, 'followers': 0}
+
+    def join(self, key):
+        """Return (flight, leader): the leader produces the stream and must ``finish`` it, the others follow."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = StreamFlight()
+            self.stats['leaders' if leader else 'followers'] += 1
+        return flight, leader
+
+    def finish(self, key, flight, error=None):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.finish(error)
+
+
+class TTLCache:
+    def __init__(self, name, ttl, stale_ttl=0, max_entries=1024, clock=time.time, backend=None,
+                 lock_timeout=10.0, poll_interval=0.05, ttl_scale=None):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        # Optional callable; values above 1 stretch the fresh and stale windows of newly stored entries.
+        self.ttl_scale = ttl_scale
+        self.backend = backend if backend is not None else MemoryBackend(max_entries)
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._async_inflight = {}
+        self._stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'loads': 0, 'load_errors': 0, 'peer_loads': 0,
+                       'coalesced': 0}
+
+    def _full_key(self, key):
+        return f"{self.name}:{key}"
+
+    def _entry(self, value):
+        scale = max(self.ttl_scale(), 1.0) if self.ttl_scale is not None else 1.0
+        now = self._clock()
+        return CacheEntry(value, now + self.ttl * scale, now + (self.ttl + self.stale_ttl) * scale)
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def get_or_load(self, key, loader):
+        """Return the cached value for ``key``, calling ``loader()`` when needed.
+
+        Exceptions raised by the loader are not cached; they propagate to the
+        caller and to every request waiting on the same flight.
+        """
+        entry = self.backend.get(self._full_key(key))
+        now = self._clock()
+        if entry is not None and now < entry.stale_until:
+            if now < entry.fresh_until:
+                self._count('hits')
+                return entry.value
+            with self._lock:
+                self._stats['stale_hits'] += 1
+                refresh = key not in self._inflight
+                if refresh:
+                    flight = self._inflight[key] = _Flight()
+            if refresh:
+                threading.Thread(target=self._load, args=(key, loader, flight),
+                                 name=f"cache-refresh-{self.name}", daemon=True).start()
+            return entry.value
+
+        with self._lock:
+            self._stats['misses'] += 1
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            else:
+                self._stats['coalesced'] += 1
+
+        if leader:
+            self._load(key, loader, flight)
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def _load(self, key, loader, flight):
+        full_key = self._full_key(key)
+        token = None
+        try:
+            token = self.backend.acquire_lock(full_key, self.lock_timeout)
+            entry = None
+            if token is None:
+                entry, token = self._wait_for_peer(full_key)
+            if entry is not None:
+                flight.value = entry.value
+                self._count('peer_loads')
+            else:
+                flight.value = loader()
+                self.backend.set(full_key, self._entry(flight.value))
+                self._count('loads')
+        except Exception as e:
+            flight.error = e
+            self._count('load_errors')
+            logger.debug("%s cache: load failed for %s: %s", self.name, key, e)
+        finally:
+            if token is not None:
+                self.backend.release_lock(full_key, token)
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    async def get_or_load_async(self, key, loader):
+        """Coroutine version of ``get_or_load``; ``loader`` is an async callable."""
+        entry = self.backend.get(self._full_key(key))
+        now = self._clock()
+        if entry is not None and now < entry.stale_until:
+            if now < entry.fresh_until:
+                self._count('hits')
+                return entry.value
+            self._count('stale_hits')
+            if key not in self._async_inflight:
+                task = self._async_inflight[key] = asyncio.ensure_future(self._load_async(key, loader))
+                # Nobody awaits a background refresh; retrieve its exception so it is not reported.
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            return entry.value
+
+        self._count('misses')
+        task = self._async_inflight.get(key)
+        if task is None:
+            task = self._async_inflight[key] = asyncio.ensure_future(self._load_async(key, loader))
+        else:
+            self._count('coalesced')
+        # Shield the shared load so one cancelled waiter does not cancel it for the rest.
+        return await asyncio.shield(task)
+
+    async def _load_async(self, key, loader):
+        full_key = self._full_key(key)
+        token = None
+        try:
+            token = self.backend.acquire_lock(full_key, self.lock_timeout)
+            entry = None
+            if token is None:
+                entry, token = await self._wait_for_peer_async(full_key)
+            if entry is not None:
+                self._count('peer_loads')
+                return entry.value
+            value = await loader()
+            self.backend.set(full_key, self._entry(value))
+            self._count('loads')
+            return value
+        except Exception as e:
+            self._count('load_errors')
+            logger.debug("%s cache: load failed for %s: %s", self.name, key, e)
+            raise
+        finally:
+            if token is not None:
+                self.backend.release_lock(full_key, token)
+            self._async_inflight.pop(key, None)
+
+    def _peer_result(self, full_key):
+        entry = self.backend.get(full_key)
+        if entry is not None and self._clock() < entry.fresh_until:
+            return entry, None
+        # The holder gave up (its load failed) or its lock expired: load here instead of waiting on.
+        return None, self.backend.acquire_lock(full_key, self.lock_timeout)
+
+    async def _wait_for_peer_async(self, full_key):
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            entry, token = self._peer_result(full_key)
+            if entry is not None or token is not None:
+                return entry, token
+        return None, None
+
+    def _wait_for_peer(self, full_key):
+        """Poll while another process holds the refresh lock for ``full_key``.
+
+        Returns ``(entry, None)`` once the holder stored a fresh entry, or
+        ``(None, token)`` once the lock is ours to load with; ``(None, None)``
+        if neither happened within ``lock_timeout``.
+        """
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            entry, token = self._peer_result(full_key)
+            if entry is not None or token is not None:
+                return entry, token
+        return None, None
+
+    def get(self, key):
+        """Return a fresh cached value (counted as a hit) or None without loading."""
+        value = self.peek(key)
+        if value is not None:
+            self._count('hits')
+        return value
+
+    def peek(self, key):
+        """Return a fresh cached value without loading or touching the stats."""
+        entry = self.backend.get(self._full_key(key))
+        if entry is not None and self._clock() < entry.fresh_until:
+            return entry.value
+        return None
+
+    def fresh_for(self, key):
+        """Seconds until the cached value for ``key`` goes stale; 0 if it is missing or already stale."""
+        entry = self.backend.get(self._full_key(key))
+        if entry is None:
+            return 0.0
+        return max(entry.fresh_until - self._clock(), 0.0)
+
+    def set(self, key, value):
+        self.backend.set(self._full_key(key), self._entry(value))
+
+    def clear(self):
+        """Drop this cache's entries and reset its counters."""
+        self.backend.clear(self._full_key(''))
+        with self._lock:
+            self._stats = dict.fromkeys(self._stats, 0)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, ttl=self.ttl, stale_ttl=self.stale_ttl)
+        if self.ttl_scale is not None:
+            stats['ttl_scale'] = round(max(self.ttl_scale(), 1.0), 2)
+        stats.update(self.backend.stats())
+        lookups = stats['hits'] + stats['stale_hits'] + stats['misses']
+        stats['hit_ratio'] = round((stats['hits'] + stats['stale_hits']) / lookups, 4) if lookups else 0.0
+        # Lookups answered without calling the loader: cache hits, joined flights and peer refreshes.
+        stats['saved_loads'] = stats['hits'] + stats['stale_hits'] + stats['coalesced'] + stats['peer_loads']
+        return stats
@@ -12,6 +12,11 @@ fi
 # Activate the virtual environment
 source .venv/bin/activate
 
+# SERVER_MODE=asgi serves the async routes in asgi.py under hypercorn instead.
+if [ "$SERVER_MODE" = "asgi" ]; then
+  exec .venv/bin/hypercorn asgi:app --bind 0.0.0.0:$PORT --reload
+fi
+
 # Set FLASK_APP to specify the application file
 export FLASK_APP=main.py
 
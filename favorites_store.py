@@ -0,0 +1,107 @@
+"""Data access for the favorites table.
+
+``FavoritesStore`` keeps one SQLite connection per thread (opened lazily in
+WAL mode with tuned pragmas) so concurrent readers never block on writers,
+and caches the favorites list in memory. Writes made through the store
+invalidate that cache immediately; writes from other worker processes show up
+once ``cache_ttl`` expires.
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database.db')
+
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA temp_store=MEMORY',
+)
+
+# Statements are kept as constants so each connection's statement cache reuses the compiled form.
+SCHEMA_SQL = 'CREATE TABLE IF NOT EXISTS favorites (city TEXT PRIMARY KEY)'
+SELECT_SQL = 'SELECT city FROM favorites ORDER BY rowid'
+INSERT_SQL = 'INSERT OR IGNORE INTO favorites (city) VALUES (?)'
+DELETE_SQL = 'DELETE FROM favorites WHERE city = ?'
+
+
+class FavoritesStore:
+    def __init__(self, path=DEFAULT_PATH, cache_ttl=5.0, clock=time.monotonic):
+        self.path = path
+        self.cache_ttl = cache_ttl
+        self._clock = clock
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._cached = None
+        self._cached_at = 0.0
+
+    def _connect(self):
+        # SQLite connections must not cross a fork (gunicorn --preload); the child opens its own.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, cached_statements=32)
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            conn.execute(SCHEMA_SQL)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def init_schema(self):
+        self._connect()
+
+    def _invalidate(self):
+        with self._lock:
+            self._cached = None
+
+    def list(self):
+        with self._lock:
+            if self._cached is not None and self._clock() - self._cached_at < self.cache_ttl:
+                return list(self._cached)
+        favorites = [row[0] for row in self._connect().execute(SELECT_SQL)]
+        with self._lock:
+            self._cached = tuple(favorites)
+            self._cached_at = self._clock()
+        return favorites
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        # IMMEDIATE takes the write lock up front instead of failing mid-transaction.
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+        finally:
+            self._invalidate()
+
+    def add_many(self, cities):
+        """Insert cities in one transaction; returns (added, already_present)."""
+        added, existing = [], []
+        with self._transaction() as conn:
+            for city in dict.fromkeys(cities):
+                (added if conn.execute(INSERT_SQL, (city,)).rowcount else existing).append(city)
+        return added, existing
+
+    def remove_many(self, cities):
+        """Delete cities in one transaction; returns the ones that were present."""
+        removed = []
+        with self._transaction() as conn:
+            for city in dict.fromkeys(cities):
+                if conn.execute(DELETE_SQL, (city,)).rowcount:
+                    removed.append(city)
+        return removed
+
+    def add(self, city):
+        """Returns False if the city was already a favorite."""
+        return bool(self.add_many([city])[0])
+
+    def remove(self, city):
+        return bool(self.remove_many([city]))
@@ -0,0 +1,174 @@
+"""Daily aggregation of OpenWeather's 5-day / 3-hour forecast.
+
+``aggregate_daily(items, tz_offset)`` groups the 3-hour entries by the city's
+local calendar day in a single pass and returns one summary per day:
+
+* ``temp_min`` / ``temp_max`` / ``temp_mean``
+* ``description`` - the most frequent condition (ties go to the earliest seen)
+* ``icon`` - the first midday (12:00-14:59 local) icon, else the day's first
+* ``precipitation`` - rain + snow in mm, ``pop`` - highest chance of precipitation in %
+* ``hourly`` - the day's 3-hour series
+
+``aggregate_many(forecasts)`` aggregates many cities at once. With NumPy
+installed it does so in one vectorized group-by over every city's entries;
+without it, it falls back to ``aggregate_daily`` per city. Both produce the
+same output.
+"""
+import datetime
+
+try:
+    import numpy as np
+except ImportError:  # optional: only speeds up aggregate_many
+    np = None
+
+SECONDS_PER_DAY = 86400
+MIDDAY = (12, 15)
+DEFAULT_ICON = '01d'
+EPOCH = datetime.date(1970, 1, 1)
+
+
+def _date_label(day_index):
+    return (EPOCH + datetime.timedelta(days=int(day_index))).strftime('%a, %b %d')
+
+
+def _precipitation(item):
+    return item.get('rain', {}).get('3h', 0) + item.get('snow', {}).get('3h', 0)
+
+
+class _Day:
+    __slots__ = ('index', 'temp_min', 'temp_max', 'temp_sum', 'count', 'conditions',
+                 'icon', 'midday_icon', 'precipitation', 'pop', 'hourly')
+
+    def __init__(self, index, icon):
+        self.index = index
+        self.temp_min = float('inf')
+        self.temp_max = float('-inf')
+        self.temp_sum = 0.0
+        self.count = 0
+        self.conditions = {}
+        self.icon = icon
+        self.midday_icon = None
+        self.precipitation = 0.0
+        self.pop = 0.0
+        self.hourly = []
+
+    def summary(self):
+        return {
+            'date': _date_label(self.index),
+            'temp_min': round(self.temp_min),
+            'temp_max': round(self.temp_max),
+            'temp_mean': round(self.temp_sum / self.count, 1),
+            'description': max(self.conditions, key=self.conditions.get),
+            'icon': self.midday_icon or self.icon or DEFAULT_ICON,
+            'precipitation': round(self.precipitation, 1),
+            'pop': round(self.pop * 100),
+            'hourly': self.hourly,
+        }
+
+
+def aggregate_daily(items, tz_offset=0, days=5):
+    """Summarize forecast entries per local day; ``tz_offset`` is the city's UTC offset in seconds."""
+    by_day = {}
+    for item in items:
+        local = item['dt'] + tz_offset
+        index, seconds = divmod(local, SECONDS_PER_DAY)
+        weather = item['weather'][0]
+        day = by_day.get(index)
+        if day is None:
+            day = by_day[index] = _Day(index, weather['icon'])
+
+        main = item['main']
+        temp = main.get('temp', (main['temp_min'] + main['temp_max']) / 2)
+        day.temp_min = min(day.temp_min, main['temp_min'])
+        day.temp_max = max(day.temp_max, main['temp_max'])
+        day.temp_sum += temp
+        day.count += 1
+        day.conditions[weather['main']] = day.conditions.get(weather['main'], 0) + 1
+        hour, minute = seconds // 3600, seconds % 3600 // 60
+        if day.midday_icon is None and MIDDAY[0] <= hour < MIDDAY[1]:
+            day.midday_icon = weather['icon']
+        day.precipitation += _precipitation(item)
+        day.pop = max(day.pop, item.get('pop', 0))
+        day.hourly.append({'time': f"{hour:02d}:{minute:02d}", 'temp': round(temp), 'icon': weather['icon']})
+
+    return [by_day[index].summary() for index in sorted(by_day)[:days]]
+
+
+def aggregate_many(forecasts, days=5):
+    """Aggregate ``(items, tz_offset)`` pairs; returns one daily list per pair, in order."""
+    forecasts = list(forecasts)
+    if np is None:
+        return [aggregate_daily(items, tz_offset, days) for items, tz_offset in forecasts]
+    return _aggregate_arrays(forecasts, days)
+
+
+def _aggregate_arrays(forecasts, days):
+    results = [[] for _ in forecasts]
+    conditions, icons = {}, {}
+    rows = []
+    for city, (items, tz_offset) in enumerate(forecasts):
+        for item in items:
+            main, weather = item['main'], item['weather'][0]
+            rows.append((city, item['dt'] + tz_offset, main['temp_min'], main['temp_max'],
+                         main.get('temp', (main['temp_min'] + main['temp_max']) / 2),
+                         _precipitation(item), item.get('pop', 0),
+                         conditions.setdefault(weather['main'], len(conditions)),
+                         icons.setdefault(weather['icon'], len(icons))))
+    if not rows:
+        return results
+
+    table = np.array(rows, dtype=float)
+    table = table[np.lexsort((table[:, 1], table[:, 0]))]
+    city, local, condition, icon = (table[:, i].astype(np.int64) for i in (0, 1, 7, 8))
+    temp_min, temp_max, temp, precipitation, pop = (table[:, i] for i in (2, 3, 4, 5, 6))
+    day_index, seconds = np.divmod(local, SECONDS_PER_DAY)
+    hour, minute = seconds // 3600, seconds % 3600 // 60
+
+    n = len(rows)
+    starts = np.flatnonzero(np.r_[True, (city[1:] != city[:-1]) | (day_index[1:] != day_index[:-1])])
+    ends = np.r_[starts[1:], n]
+    group = np.repeat(np.arange(len(starts)), ends - starts)
+    position = np.arange(n)
+
+    group_min = np.minimum.reduceat(temp_min, starts)
+    group_max = np.maximum.reduceat(temp_max, starts)
+    group_mean = np.add.reduceat(temp, starts) / (ends - starts)
+    group_precipitation = np.add.reduceat(precipitation, starts)
+    group_pop = np.maximum.reduceat(pop, starts)
+
+    # Most frequent condition per day; ties go to the condition seen first that day.
+    condition_counts = np.zeros((len(starts), len(conditions)), np.int64)
+    np.add.at(condition_counts, (group, condition), 1)
+    first_seen = np.full(condition_counts.shape, n, np.int64)
+    np.minimum.at(first_seen, (group, condition), position)
+    leaders = condition_counts == condition_counts.max(axis=1, keepdims=True)
+    dominant = np.where(leaders, first_seen, n).argmin(axis=1)
+
+    midday = (hour >= MIDDAY[0]) & (hour < MIDDAY[1])
+    midday_first = np.full(len(starts), n, np.int64)
+    np.minimum.at(midday_first, group[midday], position[midday])
+    day_icon = icon[np.where(midday_first < n, midday_first, starts)]
+
+    # Back to Python scalars once; indexing NumPy arrays element by element is slow.
+    condition_names, icon_names = list(conditions), list(icons)
+    times = [f"{h:02d}:{m:02d}" for h, m in zip(hour.tolist(), minute.tolist())]
+    hourly = [{'time': t, 'temp': round(value), 'icon': icon_names[i]}
+              for t, value, i in zip(times, temp.tolist(), icon.tolist())]
+    city, day_index = city.tolist(), day_index.tolist()
+    for start, end, low, high, mean, rain, chance, condition_id, icon_id in zip(
+            starts.tolist(), ends.tolist(), group_min.tolist(), group_max.tolist(), group_mean.tolist(),
+            group_precipitation.tolist(), group_pop.tolist(), dominant.tolist(), day_icon.tolist()):
+        daily = results[city[start]]
+        if len(daily) < days:
+            daily.append({
+                'date': _date_label(day_index[start]),
+                'temp_min': round(low),
+                'temp_max': round(high),
+                'temp_mean': round(mean, 1),
+                'description': condition_names[condition_id],
+                'icon': icon_names[icon_id] or DEFAULT_ICON,
+                'precipitation': round(rain, 1),
+                'pop': round(chance * 100),
+                'hourly': hourly[start:end],
+            })
+    return results
@@ -0,0 +1,160 @@
+"""Spatial snapping and a local gazetteer for location lookups.
+
+``GeoGrid`` snaps coordinates to geohash cells. Every request inside a cell
+shares one cache key and is sent upstream as the cell's centre, so two users
+a few hundred metres apart cost one OpenWeather call instead of two. The price
+is an error radius: a reading is at most half a cell diagonal away from the
+point that was asked for. ``stats()`` reports that bound and the distances
+actually observed.
+
+``Gazetteer`` maps city names (and aliases, e.g. Thai names) to coordinates
+from a bundled JSON file, so ``?city=`` lookups can skip the geocoding call.
+"""
+import json
+import math
+import os
+import threading
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+METERS_PER_DEGREE = 111320.0
+DEFAULT_GAZETTEER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gazetteer.json')
+
+
+def geohash_encode(lat, lon, precision):
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, value, bits, use_lon = [], 0, 0, True
+    while len(chars) < precision:
+        rng, coordinate = (lon_range, lon) if use_lon else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        if coordinate >= mid:
+            value = value * 2 + 1
+            rng[0] = mid
+        else:
+            value *= 2
+            rng[1] = mid
+        use_lon = not use_lon
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            value, bits = 0, 0
+    return ''.join(chars)
+
+
+def geohash_bounds(geohash):
+    """Return (lat_min, lat_max, lon_min, lon_max) of a geohash cell."""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    use_lon = True
+    for char in geohash:
+        value = BASE32.index(char)
+        for shift in range(4, -1, -1):
+            rng = lon_range if use_lon else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            rng[0 if value >> shift & 1 else 1] = mid
+            use_lon = not use_lon
+    return lat_range[0], lat_range[1], lon_range[0], lon_range[1]
+
+
+def distance_m(lat1, lon1, lat2, lon2):
+    """Equirectangular distance; accurate to well under 1% at cell scale."""
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return math.hypot(x, y) * 6371000
+
+
+class GeoGrid:
+    def __init__(self, precision=6):
+        self.precision = precision
+        lon_bits = math.ceil(5 * precision / 2)
+        lat_bits = 5 * precision // 2
+        self.cell_height_deg = 180.0 / 2 ** lat_bits
+        self.cell_width_deg = 360.0 / 2 ** lon_bits
+        self._lock = threading.Lock()
+        self._snapped = 0
+        self._error_sum = 0.0
+        self._error_max = 0.0
+
+    def max_error_m(self, lat=0.0):
+        """Farthest a point can be from its cell centre (half the diagonal) at latitude ``lat``."""
+        half_height = self.cell_height_deg / 2 * METERS_PER_DEGREE
+        half_width = self.cell_width_deg / 2 * METERS_PER_DEGREE * math.cos(math.radians(lat))
+        return math.hypot(half_height, half_width)
+
+    def snap(self, lat, lon, record=True):
+        """Return (cache key, {'lat', 'lon'} of the cell centre) for a coordinate pair.
+
+        Raises ValueError for values that are not coordinates.
+        """
+        lat, lon = float(lat), float(lon)
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError(f"coordinates out of range: {lat}, {lon}")
+        cell = geohash_encode(lat, lon, self.precision)
+        lat_min, lat_max, lon_min, lon_max = geohash_bounds(cell)
+        center = {'lat': round((lat_min + lat_max) / 2, 5), 'lon': round((lon_min + lon_max) / 2, 5)}
+        if record:
+            error = distance_m(lat, lon, center['lat'], center['lon'])
+            with self._lock:
+                self._snapped += 1
+                self._error_sum += error
+                self._error_max = max(self._error_max, error)
+        return f"geo:{cell}", center
+
+    def stats(self):
+        with self._lock:
+            snapped, error_sum, error_max = self._snapped, self._error_sum, self._error_max
+        return {
+            'precision': self.precision,
+            'cell_height_m': round(self.cell_height_deg * METERS_PER_DEGREE),
+            'cell_width_m': round(self.cell_width_deg * METERS_PER_DEGREE),  # at the equator
+            'max_error_m': round(self.max_error_m()),
+            'snapped': snapped,
+            'mean_error_m': round(error_sum / snapped, 1) if snapped else 0.0,
+            'max_observed_error_m': round(error_max, 1),
+        }
+
+
+def normalize_name(name):
+    return ' '.join(name.casefold().split())
+
+
+class Gazetteer:
+    def __init__(self, places=()):
+        self._places = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        for place in places:
+            self.add(place)
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_GAZETTEER):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def add(self, place):
+        location = {'name': place['name'], 'lat': place['lat'], 'lon': place['lon'], 'country': place.get('country')}
+        for name in [place['name']] + place.get('aliases', []):
+            self._places.setdefault(normalize_name(name), location)
+
+    def lookup(self, name, record=True):
+        """Return {name, lat, lon, country} for a known city (``"Name"`` or ``"Name, CC"``), else None."""
+        key = normalize_name(name)
+        location = self._places.get(key)
+        if location is None and ',' in key:
+            city, country = (part.strip() for part in key.rsplit(',', 1))
+            location = self._places.get(city)
+            if location is not None and location['country'] and location['country'].casefold() != country:
+                location = None
+        if record:
+            with self._lock:
+                if location is None:
+                    self._misses += 1
+                else:
+                    self._hits += 1
+        return dict(location) if location else None
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self._hits, self._misses
+        lookups = hits + misses
+        return {'names': len(self._places), 'hits': hits, 'misses': misses,
+                'hit_ratio': round(hits / lookups, 4) if lookups else 0.0}
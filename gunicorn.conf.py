@@ -0,0 +1,36 @@
+"""Gunicorn settings for production; picked up automatically when gunicorn runs from this directory.
+
+    gunicorn -c gunicorn.conf.py
+
+The app is imported once in the master (``preload_app``) and the workers fork
+from it, sharing those pages copy-on-write. Background threads (history
+flushing, favorites warming) cannot survive a fork, so each worker starts its
+own in ``post_fork``; the favorites warmer then only runs in the worker that
+holds its lock file.
+"""
+import multiprocessing
+import os
+
+wsgi_app = 'main:create_app(start_tasks=False)'
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+preload_app = True
+
+# Requests spend most of their time waiting on OpenWeather and Gemini, so every
+# worker also runs a few threads. WEB_CONCURRENCY / GUNICORN_THREADS override.
+workers = int(os.getenv('WEB_CONCURRENCY') or multiprocessing.cpu_count() * 2 + 1)
+threads = int(os.getenv('GUNICORN_THREADS') or 4)
+worker_class = 'gthread'
+# SSE health analyses stay open for up to HEALTH_STREAM_TIMEOUT seconds.
+timeout = int(os.getenv('GUNICORN_TIMEOUT') or 60)
+keepalive = 5
+accesslog = '-'
+
+
+def post_fork(server, worker):
+    import main
+    main.start_background_tasks()
+
+
+def worker_exit(server, worker):
+    import main
+    main.history_store.stop()
@@ -0,0 +1,326 @@
+"""Historical observation store.
+
+``HistoryStore`` keeps every weather and air-pollution observation the app
+fetches, in a SQLite file:
+
+* Observations are buffered in memory and written in batches (every
+  ``batch_size`` records or ``flush_interval`` seconds).
+* Readings are stored as one chunk per location and UTC day; each batch is
+  merged into the day's existing chunk in the same transaction. A chunk holds
+  a column of timestamps and one column per field, packed with ``array`` and
+  compressed, so a day of readings costs a single row.
+* The same write also folds the batch into hourly and daily rollups
+  (count/sum/min/max per field), so range queries over weeks read one row per
+  bucket instead of every observation.
+* Each (location, kind) remembers its latest recorded timestamp in the file,
+  so when several workers fetch the same observation only the first flush
+  stores it.
+
+Reads don't flush: an observation shows up in queries once its batch is
+written, at most ``flush_interval`` seconds after it was fetched.
+
+Locations are grid cells of ``make_key(lat, lon, precision=1)`` (about 11 km),
+so the weather (upstream coordinates) and air-quality (geocoded coordinates)
+readings for a city land in the same series.
+"""
+import atexit
+import logging
+import math
+import os
+import sqlite3
+import threading
+import zlib
+from array import array
+from contextlib import contextmanager
+
+from cache import make_key
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('temperature', 'humidity', 'pressure', 'wind_speed', 'aqi',
+          'co', 'no', 'no2', 'o3', 'so2', 'pm2_5', 'pm10', 'nh3')
+RESOLUTIONS = {'hour': 3600, 'day': 86400}
+SECONDS_PER_DAY = 86400
+LOCATION_PRECISION = 1
+
+SCHEMA_SQL = '''
+    CREATE TABLE IF NOT EXISTS history_chunks (
+        location TEXT NOT NULL,
+        day INTEGER NOT NULL,
+        fields TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        data BLOB NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS history_chunks_location_day ON history_chunks (location, day);
+    CREATE TABLE IF NOT EXISTS history_rollups (
+        location TEXT NOT NULL,
+        resolution TEXT NOT NULL,
+        bucket INTEGER NOT NULL,
+        field TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        total REAL NOT NULL,
+        minimum REAL NOT NULL,
+        maximum REAL NOT NULL,
+        PRIMARY KEY (location, resolution, bucket, field)
+    );
+    CREATE TABLE IF NOT EXISTS history_locations (
+        location TEXT PRIMARY KEY,
+        name TEXT,
+        lat REAL NOT NULL,
+        lon REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS history_locations_name ON history_locations (name COLLATE NOCASE);
+    CREATE TABLE IF NOT EXISTS history_last_seen (
+        location TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        ts INTEGER NOT NULL,
+        PRIMARY KEY (location, kind)
+    ) WITHOUT ROWID;
+'''
+INSERT_CHUNK_SQL = 'INSERT INTO history_chunks (location, day, fields, count, data) VALUES (?, ?, ?, ?, ?)'
+UPSERT_ROLLUP_SQL = '''
+    INSERT INTO history_rollups (location, resolution, bucket, field, count, total, minimum, maximum)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (location, resolution, bucket, field) DO UPDATE SET
+        count = count + excluded.count,
+        total = total + excluded.total,
+        minimum = min(minimum, excluded.minimum),
+        maximum = max(maximum, excluded.maximum)
+'''
+UPSERT_LOCATION_SQL = '''
+    INSERT INTO history_locations (location, name, lat, lon) VALUES (?, ?, ?, ?)
+    ON CONFLICT (location) DO UPDATE SET name = coalesce(excluded.name, name)
+'''
+# Only advances for a newer timestamp; rowcount tells whether the observation is new.
+MARK_SEEN_SQL = '''
+    INSERT INTO history_last_seen (location, kind, ts) VALUES (?, ?, ?)
+    ON CONFLICT (location, kind) DO UPDATE SET ts = excluded.ts WHERE excluded.ts > history_last_seen.ts
+'''
+SELECT_CHUNKS_SQL = 'SELECT fields, count, data FROM history_chunks WHERE location = ? AND day BETWEEN ? AND ?'
+SELECT_DAY_CHUNKS_SQL = 'SELECT rowid, fields, count, data FROM history_chunks WHERE location = ? AND day = ?'
+DELETE_CHUNK_SQL = 'DELETE FROM history_chunks WHERE rowid = ?'
+SELECT_ROLLUPS_SQL = '''
+    SELECT bucket, field, count, total, minimum, maximum FROM history_rollups
+    WHERE location = ? AND resolution = ? AND bucket BETWEEN ? AND ? ORDER BY bucket
+'''
+SELECT_LOCATION_SQL = 'SELECT location FROM history_locations WHERE name = ? COLLATE NOCASE LIMIT 1'
+
+
+def location_key(lat, lon):
+    return make_key(lat=lat, lon=lon, precision=LOCATION_PRECISION)
+
+
+def encode_chunk(rows, fields=FIELDS):
+    """Pack ``(ts, values)`` rows column by column: int64 timestamps, then one float64 column per field."""
+    columns = [array('q', (ts for ts, _ in rows))]
+    for field in fields:
+        columns.append(array('d', (values.get(field, math.nan) for _, values in rows)))
+    return zlib.compress(b''.join(column.tobytes() for column in columns))
+
+
+def decode_chunk(blob, count, fields):
+    raw = zlib.decompress(blob)
+    timestamps = array('q')
+    timestamps.frombytes(raw[:count * 8])
+    offset = count * 8
+    columns = {}
+    for field in fields:
+        column = array('d')
+        column.frombytes(raw[offset:offset + count * 8])
+        columns[field] = column
+        offset += count * 8
+    return timestamps, columns
+
+
+def chunk_rows(blob, count, fields):
+    """Unpack a chunk back into ``(ts, values)`` rows, leaving out fields a row has no value for."""
+    timestamps, columns = decode_chunk(blob, count, fields)
+    return [(ts, {field: columns[field][i] for field in fields if not math.isnan(columns[field][i])})
+            for i, ts in enumerate(timestamps)]
+
+
+def aggregate(observations):
+    """Group buffered observations into day chunks, rollup deltas and location details."""
+    partitions, rollups, locations = {}, {}, {}
+    for location, _, ts, values, name, lat, lon in observations:
+        partitions.setdefault((location, ts // SECONDS_PER_DAY), []).append((ts, values))
+        if name or location not in locations:
+            locations[location] = (name, lat, lon)
+        for resolution, width in RESOLUTIONS.items():
+            bucket = ts - ts % width
+            for field, value in values.items():
+                agg = rollups.get((location, resolution, bucket, field))
+                if agg is None:
+                    rollups[(location, resolution, bucket, field)] = [1, value, value, value]
+                else:
+                    agg[0] += 1
+                    agg[1] += value
+                    agg[2] = min(agg[2], value)
+                    agg[3] = max(agg[3], value)
+    return partitions, rollups, locations
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class HistoryStore:
+    def __init__(self, path='history.db', batch_size=500, flush_interval=30.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._buffer = []
+        self._last_seen = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {'recorded': 0, 'duplicates': 0, 'flushes': 0, 'flush_errors': 0}
+
+    def _connect(self):
+        # Reopen in forked children instead of sharing the parent's connection.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA_SQL)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+
+    def record(self, kind, lat, lon, ts, values, name=None):
+        """Buffer one observation; repeats of an already recorded (location, kind, ts) are dropped.
+
+        This process's repeats are dropped here, other workers' ones when the batch is flushed.
+        """
+        numbers = {}
+        for field, value in values.items():
+            number = _number(value)
+            if field in FIELDS and number is not None:
+                numbers[field] = number
+        if ts is None or not numbers:
+            return False
+        location = location_key(lat, lon)
+        with self._lock:
+            if self._last_seen.get((location, kind), -1) >= ts:
+                self.stats['duplicates'] += 1
+                return False
+            self._last_seen[(location, kind)] = ts
+            self._buffer.append((location, kind, int(ts), numbers, name, float(lat), float(lon)))
+            self.stats['recorded'] += 1
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.flush()
+        return True
+
+    def record_weather(self, data):
+        """Record a raw OpenWeather current-weather response (metric units)."""
+        main, coord = data.get('main', {}), data.get('coord', {})
+        if 'lat' not in coord or 'lon' not in coord:
+            return False
+        wind_speed = _number(data.get('wind', {}).get('speed'))
+        return self.record('weather', coord['lat'], coord['lon'], data.get('dt'), {
+            'temperature': main.get('temp'),
+            'humidity': main.get('humidity'),
+            'pressure': main.get('pressure'),
+            'wind_speed': wind_speed * 3.6 if wind_speed is not None else None,  # km/h, as shown in the UI
+        }, name=data.get('name'))
+
+    def record_air_quality(self, query, data):
+        """Record a raw air-pollution response for the ``{'lat', 'lon'}`` it was requested for."""
+        if not data.get('list'):
+            return False
+        reading = data['list'][0]
+        values = dict(reading.get('components', {}), aqi=reading.get('main', {}).get('aqi'))
+        return self.record('air_quality', query['lat'], query['lon'], reading.get('dt'), values)
+
+    def flush(self):
+        """Write buffered observations into the chunk of their (location, day) and update the rollups."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+            if not batch:
+                return 0
+            try:
+                with self._transaction() as conn:
+                    # Another worker may already have stored some of these; keep only the new ones.
+                    fresh = [observation for observation in sorted(batch, key=lambda o: o[2])
+                             if conn.execute(MARK_SEEN_SQL, observation[:3]).rowcount]
+                    partitions, rollups, locations = aggregate(fresh)
+                    for (location, day), rows in partitions.items():
+                        # Fold the day's earlier chunks (one, or several from older versions) into the new one.
+                        for rowid, fields, count, blob in conn.execute(SELECT_DAY_CHUNKS_SQL, (location, day)).fetchall():
+                            rows.extend(chunk_rows(blob, count, fields.split(',')))
+                            conn.execute(DELETE_CHUNK_SQL, (rowid,))
+                        rows.sort(key=lambda r: r[0])
+                        conn.execute(INSERT_CHUNK_SQL, (location, day, ','.join(FIELDS), len(rows), encode_chunk(rows)))
+                    conn.executemany(UPSERT_ROLLUP_SQL, [key + tuple(agg) for key, agg in rollups.items()])
+                    conn.executemany(UPSERT_LOCATION_SQL, [(location,) + info for location, info in locations.items()])
+            except sqlite3.Error as e:
+                self.stats['flush_errors'] += 1
+                logger.error("history: could not write %d observations: %s", len(batch), e)
+                with self._lock:
+                    self._buffer[:0] = batch
+                return 0
+            with self._lock:
+                self.stats['duplicates'] += len(batch) - len(fresh)
+            self.stats['flushes'] += 1
+            return len(fresh)
+
+    def find_location(self, city):
+        row = self._connect().execute(SELECT_LOCATION_SQL, (city.strip(),)).fetchone()
+        return row[0] if row else None
+
+    def query(self, location, start, end, resolution='hour'):
+        """Return points between ``start`` and ``end`` (epoch seconds) at 'raw', 'hour' or 'day' resolution."""
+        conn = self._connect()
+        if resolution == 'raw':
+            # Weather and air-quality readings taken at the same moment merge into one point.
+            points = {}
+            for fields, count, blob in conn.execute(SELECT_CHUNKS_SQL, (location, start // SECONDS_PER_DAY,
+                                                                        end // SECONDS_PER_DAY)):
+                for ts, values in chunk_rows(blob, count, fields.split(',')):
+                    if start <= ts <= end:
+                        points.setdefault(ts, {'t': ts}).update(values)
+            return [points[ts] for ts in sorted(points)]
+
+        width = RESOLUTIONS[resolution]
+        points = {}
+        for bucket, field, count, total, minimum, maximum in conn.execute(
+                SELECT_ROLLUPS_SQL, (location, resolution, start - start % width, end)):
+            point = points.setdefault(bucket, {'t': bucket})
+            point[field] = {'avg': round(total / count, 2), 'min': minimum, 'max': maximum, 'count': count}
+        return list(points.values())
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def start(self):
+        """Flush in the background every ``flush_interval`` seconds and once more at exit."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='history-flush', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
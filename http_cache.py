@@ -0,0 +1,129 @@
+"""HTTP validation, compression and static fingerprints.
+
+``finalize()`` post-processes a complete (not streamed) response:
+
+* A strong ``ETag`` is the hash of the uncompressed body. Compressed
+  representations get a ``-gzip`` / ``-br`` suffix so each encoding has its
+  own validator, and ``If-None-Match`` is compared against the base hash, so
+  a 304 is decided before anything is compressed.
+* Bodies of compressible types are encoded with the best encoding the client
+  accepts: brotli when the optional ``brotli`` package is installed, else gzip.
+* Responses without explicit caching get ``Cache-Control: no-cache``, so the
+  browser stores them but revalidates with the ETag.
+
+``fingerprint(path)`` hashes a static file's content; templates link to
+``?v=<fingerprint>`` URLs, which are then safe to cache for a year.
+"""
+import functools
+import gzip
+import hashlib
+import os
+
+try:
+    import brotli
+except ImportError:  # optional: gzip is used instead
+    brotli = None
+
+COMPRESSIBLE_TYPES = frozenset({'application/json', 'text/html', 'text/plain', 'text/css',
+                                'application/javascript', 'image/svg+xml'})
+MIN_COMPRESS_SIZE = 512
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+IMMUTABLE_MAX_AGE = 365 * 86400
+
+
+def etag_for(body):
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def _base_tag(tag):
+    tag = tag.strip()
+    if tag.startswith('W/'):
+        tag = tag[2:]
+    for suffix in ('-gzip"', '-br"'):
+        if tag.endswith(suffix):
+            return tag[:-len(suffix)] + '"'
+    return tag
+
+
+def matches(if_none_match, etag):
+    """Whether an ``If-None-Match`` header matches ``etag`` (weak comparison, any encoding)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return any(_base_tag(tag) == etag for tag in if_none_match.split(','))
+
+
+def negotiate(accept_encoding):
+    """Pick 'br', 'gzip' or None from an ``Accept-Encoding`` header."""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    for coding in ('br', 'gzip'):
+        if coding == 'br' and brotli is None:
+            continue
+        if accepted.get(coding, accepted.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+
+def compress(body, coding):
+    if coding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def finalize(method, status, mimetype, body, headers, if_none_match=None, accept_encoding=None):
+    """Return (status, body, headers to set) for a complete response.
+
+    ``headers`` are the response's current headers (only ``Cache-Control`` and
+    ``Content-Encoding`` are read). Responses other than a GET/HEAD 200 are
+    returned unchanged.
+    """
+    if method not in ('GET', 'HEAD') or status != 200 or headers.get('Content-Encoding'):
+        return status, body, {}
+    compressible = mimetype in COMPRESSIBLE_TYPES
+    etag = etag_for(body)
+    updates = {'ETag': etag}
+    if compressible:
+        updates['Vary'] = 'Accept-Encoding'
+    if not headers.get('Cache-Control'):
+        updates['Cache-Control'] = 'no-cache'
+
+    coding = negotiate(accept_encoding) if compressible and len(body) >= MIN_COMPRESS_SIZE else None
+    if coding:
+        updates['ETag'] = f'{etag[:-1]}-{coding}"'
+    if matches(if_none_match, etag):
+        return 304, b'', updates
+    if coding:
+        body = compress(body, coding)
+        updates['Content-Encoding'] = coding
+    return status, body, updates
+
+
+@functools.lru_cache(maxsize=256)
+def _file_hash(path, mtime_ns, size):
+    digest = hashlib.blake2b(digest_size=6)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fingerprint(path):
+    """Short content hash of a file, recomputed only when its mtime or size changes; None if missing."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return _file_hash(path, stat.st_mtime_ns, stat.st_size)
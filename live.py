@@ -0,0 +1,162 @@
+"""Live updates: one poller per subscribed location, fanned out to every subscriber.
+
+``LiveHub.subscribe(key, location)`` registers a subscriber for a location
+key (a geohash cell). The first subscriber of a key starts a poller thread
+that calls ``load(location)`` every ``interval`` seconds; the last one to
+``close()`` stops it. So N viewers of one city cost one load per interval,
+and since ``load`` reads through the TTL caches, upstream is still called at
+most once per cache TTL.
+
+Subscribers receive only what changed (``diff``). Updates a subscriber has not
+picked up yet are merged (``merge``) instead of queued, so a slow reader holds
+one pending document, never a backlog. A new subscriber's first update is the
+latest full snapshot.
+"""
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def diff(old, new):
+    """Fields of ``new`` that differ from ``old``, compared recursively; removed fields map to None."""
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return new
+    changes = {}
+    for name, value in new.items():
+        if name not in old:
+            changes[name] = value
+        elif old[name] != value:
+            changes[name] = diff(old[name], value)
+    for name in old.keys() - new.keys():
+        changes[name] = None
+    return changes
+
+
+def merge(base, update):
+    """Apply a ``diff`` result to ``base`` (returns a new document)."""
+    if not isinstance(base, dict) or not isinstance(update, dict):
+        return update
+    merged = dict(base)
+    for name, value in update.items():
+        merged[name] = merge(base[name], value) if name in base else value
+    return merged
+
+
+class Subscription:
+    def __init__(self, hub, key, wakeup=None):
+        self.hub = hub
+        self.key = key
+        self._wakeup = wakeup
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._pending = None
+
+    def push(self, update):
+        with self._lock:
+            self._pending = update if self._pending is None else merge(self._pending, update)
+        self._ready.set()
+        if self._wakeup is not None:
+            try:
+                self._wakeup()
+            except Exception as e:  # e.g. the subscriber's event loop has already closed
+                logger.debug("live: could not wake a subscriber of %s: %s", self.key, e)
+
+    def poll(self):
+        """Take the pending update without waiting; None if there is none."""
+        with self._lock:
+            update, self._pending = self._pending, None
+            self._ready.clear()
+        return update
+
+    def wait(self, timeout=None):
+        """Block up to ``timeout`` seconds for an update; None on timeout."""
+        self._ready.wait(timeout)
+        return self.poll()
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class _Poller:
+    def __init__(self, location):
+        self.location = location
+        self.subscribers = set()
+        self.latest = None
+        self.stop = threading.Event()
+        self.thread = None
+
+
+class LiveHub:
+    def __init__(self, load, interval=60, max_locations=200):
+        self.load = load
+        self.interval = interval
+        self.max_locations = max_locations
+        self._lock = threading.Lock()
+        self._pollers = {}
+        self.stats = {'polls': 0, 'updates': 0, 'errors': 0}
+
+    def subscribe(self, key, location, wakeup=None):
+        """Subscribe to ``key``; None when ``max_locations`` other locations are already polled.
+
+        ``wakeup()`` is called (from the poller thread) whenever an update is
+        pushed, e.g. to wake an event loop.
+        """
+        subscription = Subscription(self, key, wakeup)
+        with self._lock:
+            poller = self._pollers.get(key)
+            if poller is None:
+                if len(self._pollers) >= self.max_locations:
+                    return None
+                poller = self._pollers[key] = _Poller(location)
+                poller.thread = threading.Thread(target=self._run, args=(key, poller), name=f"live-{key}", daemon=True)
+                poller.thread.start()
+            poller.subscribers.add(subscription)
+            if poller.latest is not None:
+                subscription.push(poller.latest)
+        return subscription
+
+    def has_room(self, key):
+        """Whether ``subscribe(key, ...)`` would be accepted right now."""
+        with self._lock:
+            return key in self._pollers or len(self._pollers) < self.max_locations
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            poller = self._pollers.get(subscription.key)
+            if poller is None:
+                return
+            poller.subscribers.discard(subscription)
+            if not poller.subscribers:
+                del self._pollers[subscription.key]
+                poller.stop.set()
+
+    def locations(self):
+        with self._lock:
+            return {key: len(poller.subscribers) for key, poller in self._pollers.items()}
+
+    def _run(self, key, poller):
+        while not poller.stop.is_set():
+            try:
+                snapshot = self.load(poller.location)
+            except Exception as e:
+                logger.warning("live: could not load %s: %s", key, e)
+                snapshot = None
+            with self._lock:
+                self.stats['polls'] += 1
+                if snapshot is None:
+                    self.stats['errors'] += 1
+                else:
+                    changes = snapshot if poller.latest is None else diff(poller.latest, snapshot)
+                    poller.latest = snapshot
+                    if changes:
+                        self.stats['updates'] += 1
+                        for subscription in poller.subscribers:
+                            subscription.push(changes)
+            poller.stop.wait(self.interval)
+
+    def stop(self):
+        with self._lock:
+            pollers, self._pollers = list(self._pollers.values()), {}
+        for poller in pollers:
+            poller.stop.set()
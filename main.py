@@ -1,21 +1,38 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, g
 import requests
 import os
 from dotenv import load_dotenv
-import sqlite3
 import datetime
-from collections import defaultdict
+from collections import deque
 import logging
 import json
-import google.generativeai as genai # Import the Gemini API client library
+import hashlib
+import math
+import time
+import contextvars
+import threading
+from contextlib import contextmanager
 import sys
-
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from cache import TTLCache, SQLiteBackend, RedisBackend, StreamFlights, make_key
+from upstream import UpstreamClient, CircuitBreaker, AuthError, CircuitOpenError
+from warmer import CacheWarmer
+from live import LiveHub
+from ratelimit import RateLimiter, UpstreamBudget
+from forecast import aggregate_daily
+from geo import GeoGrid, Gazetteer, DEFAULT_GAZETTEER
+from history import HistoryStore, location_key as history_location_key
+from favorites_store import FavoritesStore, DEFAULT_PATH as DEFAULT_DATABASE_PATH
+import metrics
+import http_cache
 
 load_dotenv()
 
+# Configure logging; LOG_LEVEL=DEBUG also logs every upstream response
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+
 app = Flask(__name__, template_folder='templates')
+app.json = metrics.timed_json_provider(app.json_provider_class)(app)
 
 API_KEY = os.getenv("API_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -23,27 +40,147 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not API_KEY or API_KEY.strip() == "":
     logging.error("OPENWEATHER API_KEY not found or empty in environment variables. Weather features will be disabled.")
 
-# Configure the Gemini API client
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-else:
+# Upstream base URLs; point both at benchmarks/fake_upstream.py for load tests
+OPENWEATHER_BASE_URL = os.getenv("OPENWEATHER_BASE_URL", "https://api.openweathermap.org").rstrip('/')
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "").rstrip('/')
+
+# The Gemini client is imported and configured on first use (see gemini_model)
+if not GEMINI_API_KEY:
     app.logger.error("GEMINI_API_KEY not found in environment variables. AI features will be disabled.")
 
-WEATHER_API_URL = "https://api.openweathermap.org/data/2.5/weather"
-AIR_QUALITY_API_URL = "https://api.openweathermap.org/data/2.5/air_pollution"
-FORECAST_API_URL = "https://api.openweathermap.org/data/2.5/forecast"
+WEATHER_API_URL = f"{OPENWEATHER_BASE_URL}/data/2.5/weather"
+AIR_QUALITY_API_URL = f"{OPENWEATHER_BASE_URL}/data/2.5/air_pollution"
+FORECAST_API_URL = f"{OPENWEATHER_BASE_URL}/data/2.5/forecast"
+GEOCODING_API_URL = f"{OPENWEATHER_BASE_URL}/geo/1.0/direct"
 # GEMINI_API_URL is no longer needed when using the client library
 
+# One pooled keep-alive session for every OpenWeather call, with timeouts, retries and a circuit breaker.
+UPSTREAM_SETTINGS = {
+    'connect_timeout': float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3.05")),
+    'read_timeout': float(os.getenv("UPSTREAM_READ_TIMEOUT", "10")),
+    'max_retries': int(os.getenv("UPSTREAM_MAX_RETRIES", "2")),
+    'backoff_base': float(os.getenv("UPSTREAM_BACKOFF", "0.5")),
+    'pool_size': int(os.getenv("UPSTREAM_POOL_SIZE", "20")),
+}
+openweather = UpstreamClient(
+    'openweather',
+    breaker=CircuitBreaker(int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5")), float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))),
+    **UPSTREAM_SETTINGS,
+)
+
+# Upstream data only changes every ~10 minutes, so results are cached per endpoint.
+# Stale entries are still served for CACHE_STALE_TTL seconds while they refresh in the background.
+CACHE_STALE_TTL = int(os.getenv("CACHE_STALE_TTL", "300"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+# CACHE_BACKEND=sqlite or redis shares cached results (and refresh locks) between workers.
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory").lower()
+if CACHE_BACKEND == 'sqlite':
+    cache_backend = SQLiteBackend(os.getenv("CACHE_DB_PATH", "cache.db"), CACHE_MAX_ENTRIES)
+elif CACHE_BACKEND == 'redis':
+    cache_backend = RedisBackend.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+else:
+    cache_backend = None  # each cache keeps its own in-process LRU
+# A worker's refresh lock has to outlast its slowest possible OpenWeather call, or peers stampede mid-load.
+CACHE_LOCK_TIMEOUT = openweather.max_call_duration()
+weather_cache = TTLCache('weather', int(os.getenv("WEATHER_CACHE_TTL", "600")), CACHE_STALE_TTL, CACHE_MAX_ENTRIES, backend=cache_backend,
+                         lock_timeout=CACHE_LOCK_TIMEOUT)
+forecast_cache = TTLCache('forecast', int(os.getenv("FORECAST_CACHE_TTL", "1800")), CACHE_STALE_TTL, CACHE_MAX_ENTRIES, backend=cache_backend,
+                          lock_timeout=CACHE_LOCK_TIMEOUT)
+air_quality_cache = TTLCache('air_quality', int(os.getenv("AIR_QUALITY_CACHE_TTL", "900")), CACHE_STALE_TTL, CACHE_MAX_ENTRIES, backend=cache_backend,
+                             lock_timeout=CACHE_LOCK_TIMEOUT)
+# City coordinates practically never change.
+geocode_cache = TTLCache('geocode', int(os.getenv("GEOCODE_CACHE_TTL", "604800")), CACHE_STALE_TTL, CACHE_MAX_ENTRIES, backend=cache_backend,
+                         lock_timeout=CACHE_LOCK_TIMEOUT)
+
+
+# Gemini answers are keyed by bucketed conditions and kept on disk, so restarts don't pay for them again.
+HEALTH_MODEL = 'gemini-2.0-flash'
+analysis_backend = cache_backend or SQLiteBackend(os.getenv("ANALYSIS_CACHE_DB_PATH", "cache.db"),
+                                                  int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "5000")))
+# Hard limit for one streamed Gemini generation, in seconds.
+HEALTH_STREAM_TIMEOUT = float(os.getenv("HEALTH_STREAM_TIMEOUT", "30"))
+analysis_cache = TTLCache('health_analysis', int(os.getenv("ANALYSIS_CACHE_TTL", "21600")), backend=analysis_backend,
+                          lock_timeout=HEALTH_STREAM_TIMEOUT)
+# Streamed requests for the same conditions that arrive while one is generating replay its chunks.
+analysis_streams = StreamFlights()
+
+CACHES = (weather_cache, forecast_cache, air_quality_cache, geocode_cache, analysis_cache)
+
+# Upstream call budgets per minute and per day (the API plans' caps; 0 = no cap). Once less than
+# BUDGET_RESERVE of a budget is left, new cache entries live up to BUDGET_MAX_TTL_STRETCH times longer;
+# once it is used up, calls are refused and cached data is served until it expires.
+# The plans' caps are per API key, so every worker counts in one shared store: the cache backend
+# when it is shared, otherwise a SQLite file.
+BUDGET_RESERVE = float(os.getenv("BUDGET_RESERVE", "0.25"))
+BUDGET_MAX_TTL_STRETCH = float(os.getenv("BUDGET_MAX_TTL_STRETCH", "4"))
+budget_backend = cache_backend or SQLiteBackend(os.getenv("BUDGET_DB_PATH", "cache.db"))
+upstream_budgets = {
+    'openweather': UpstreamBudget('openweather', int(os.getenv("OPENWEATHER_CALLS_PER_MINUTE", "60")),
+                                  int(os.getenv("OPENWEATHER_CALLS_PER_DAY", "0")), budget_backend,
+                                  BUDGET_RESERVE, BUDGET_MAX_TTL_STRETCH),
+    'gemini': UpstreamBudget('gemini', int(os.getenv("GEMINI_CALLS_PER_MINUTE", "15")),
+                             int(os.getenv("GEMINI_CALLS_PER_DAY", "1500")), budget_backend,
+                             BUDGET_RESERVE, BUDGET_MAX_TTL_STRETCH),
+}
+for cache in (weather_cache, forecast_cache, air_quality_cache, geocode_cache):
+    cache.ttl_scale = upstream_budgets['openweather'].ttl_scale
+analysis_cache.ttl_scale = upstream_budgets['gemini'].ttl_scale
+
+# Coordinates snap to geohash cells: every request inside a cell shares one cache entry and upstream call.
+geo_grid = GeoGrid(int(os.getenv("GEO_CELL_PRECISION", "6")))
+# Known cities resolve to coordinates locally instead of through the geocoding API.
+gazetteer = Gazetteer.from_file(os.getenv("GAZETTEER_PATH", DEFAULT_GAZETTEER))
+
+# Request, upstream and cache metrics, served at /metrics
+metrics_registry = metrics.Registry()
+REQUESTS = metrics_registry.counter('http_requests_total', 'HTTP responses by route, method and status.',
+                                    ('route', 'method', 'status'))
+REQUEST_LATENCY = metrics_registry.histogram('http_request_duration_seconds',
+                                             'Time until the response starts (streamed bodies excluded).',
+                                             ('route', 'method'))
+IN_FLIGHT = metrics_registry.gauge('http_requests_in_flight', 'Requests currently being handled.')
+UPSTREAM_LATENCY = metrics_registry.histogram('upstream_request_duration_seconds',
+                                              'Upstream call latency, retries included.', ('upstream', 'endpoint'))
+UPSTREAM_ERRORS = metrics_registry.counter('upstream_errors_total', 'Upstream calls that failed.',
+                                           ('upstream', 'endpoint'))
+
+RATE_LIMITED = metrics_registry.counter('rate_limited_total', 'Requests refused with 429 by the rate limiter.',
+                                        ('route',))
+
+# Token bucket per client IP and route: RATE_LIMIT_PER_MINUTE requests a minute, bursts of up to
+# RATE_LIMIT_BURST (0 disables). The Gemini-backed routes have their own, lower limit.
+# Behind proxies (e.g. Render) set TRUSTED_PROXY_HOPS so the client is read from X-Forwarded-For.
+RATE_LIMIT_PER_MINUTE = int(os.getenv("RATE_LIMIT_PER_MINUTE", "120"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "30"))
+HEALTH_RATE_LIMIT = (int(os.getenv("HEALTH_RATE_LIMIT_PER_MINUTE", "10")), int(os.getenv("HEALTH_RATE_LIMIT_BURST", "5")))
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+rate_limiter = RateLimiter(RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST, {
+    '/health_analysis': HEALTH_RATE_LIMIT,
+    '/health_analysis/stream': HEALTH_RATE_LIMIT,
+    '/metrics': (0, 0),
+})
+
+# Worker threads for fanning out upstream calls within a single request.
+upstream_pool = ThreadPoolExecutor(max_workers=int(os.getenv("UPSTREAM_WORKERS", "16")), thread_name_prefix='upstream')
+# /weather/batch limits: items per request and upstream calls in flight per request.
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+# Favorites live in SQLite (WAL, one connection per thread); the list is cached in memory between writes.
+favorites_store = FavoritesStore(os.getenv("DATABASE_PATH", DEFAULT_DATABASE_PATH),
+                                 cache_ttl=float(os.getenv("FAVORITES_CACHE_TTL", "5")))
+# Cities accepted by one /favorites/bulk request.
+FAVORITES_BULK_MAX = int(os.getenv("FAVORITES_BULK_MAX", "100"))
+
+# Every observation fetched from OpenWeather is also appended to a local time-series store for /history.
+history_store = HistoryStore(os.getenv("HISTORY_DB_PATH", "history.db"),
+                             batch_size=int(os.getenv("HISTORY_BATCH_SIZE", "500")),
+                             flush_interval=float(os.getenv("HISTORY_FLUSH_INTERVAL", "30")))
+# Range /history returns when no 'from' is given.
+HISTORY_DEFAULT_SPAN = int(os.getenv("HISTORY_DEFAULT_SPAN", str(7 * 86400)))
+
 def init_db():
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS favorites (
-            city TEXT PRIMARY KEY
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    favorites_store.init_schema()
 
 def get_aqi_description(aqi):
     return {1: "Good", 2: "Fair", 3: "Moderate", 4: "Poor", 5: "Very Poor"}.get(aqi, "Unknown")
@@ -53,44 +190,237 @@ def get_wind_direction(deg):
     idx = round(deg / (360. / len(directions)))
     return directions[idx % len(directions)]
 
+class APIError(Exception):
+    """An error carrying the JSON message and HTTP status a route should return."""
+
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+def check_api_key():
+    if not API_KEY or API_KEY.strip() == "":
+        app.logger.error("OPENWEATHER API_KEY not configured.")
+        raise APIError("OpenWeather API key not configured. Please set API_KEY in your .env file.", 503)
+
+def location_query(args):
+    """Turn ?city= or ?lat=&lon= into a cache key and the matching OpenWeather query."""
+    city = args.get('city')
+    lat = args.get('lat')
+    lon = args.get('lon')
+    if lat and lon:
+        return snap_coords(lat, lon)
+    if city:
+        return make_key(city), {'q': city}
+    raise APIError("City or coordinates must be provided", 400)
+
+def coords_query(args):
+    lat = args.get('lat')
+    lon = args.get('lon')
+    if not lat or not lon:
+        app.logger.error("AIR_QUALITY: Latitude or longitude not provided.")
+        raise APIError("Latitude or longitude not provided", 400)
+    return snap_coords(lat, lon)
+
+def snap_coords(lat, lon, record=True):
+    """Cache key and upstream query (the cell centre) for the grid cell containing lat/lon."""
+    try:
+        return geo_grid.snap(lat, lon, record)
+    except ValueError:
+        raise APIError("Invalid latitude or longitude", 400)
+
+def resolve_city(city):
+    """Coordinates for a city name: the local gazetteer first, then the (cached) geocoding API."""
+    return gazetteer.lookup(city) or geocode_cache.get_or_load(make_key(city), lambda: fetch_location(city))
+
+def list_favorites():
+    return favorites_store.list()
+
+def add_favorite(city):
+    if not favorites_store.add(city):
+        return {"error": "City already in favorites"}
+    return {"success": True, "city": city}
+
+def remove_favorite(city):
+    favorites_store.remove(city)
+    return {"success": True, "city": city}
+
+def bulk_cities(data):
+    """Validate the {"cities": [...]} body of a /favorites/bulk request."""
+    if data is not None and not isinstance(data, dict):
+        raise APIError('Body must be a JSON object like {"cities": [...]}', 400)
+    cities = (data or {}).get('cities')
+    if not isinstance(cities, list) or not cities:
+        raise APIError("Cities not provided", 400)
+    if not all(isinstance(city, str) and city.strip() for city in cities):
+        raise APIError("Cities must be non-empty strings", 400)
+    if len(cities) > FAVORITES_BULK_MAX:
+        raise APIError(f"Too many cities (max {FAVORITES_BULK_MAX})", 400)
+    return [city.strip() for city in cities]
+
+def bulk_update_favorites(method, cities):
+    if method == 'POST':
+        added, skipped = favorites_store.add_many(cities)
+        return {"success": True, "added": added, "skipped": skipped}
+    return {"success": True, "removed": favorites_store.remove_many(cities)}
+
+# Shared by the request hooks here and in asgi.py
+def begin_request():
+    IN_FLIGHT.inc()
+    metrics.start_timing()
+    return time.perf_counter()
+
+def finish_request(response, rule, method, started):
+    elapsed = time.perf_counter() - started
+    route = rule.rule if rule is not None else 'unmatched'
+    REQUESTS.inc(route=route, method=method, status=response.status_code)
+    REQUEST_LATENCY.observe(elapsed, route=route, method=method)
+    response.headers['Server-Timing'] = metrics.server_timing(elapsed)
+    return response
+
+METRICS_MIMETYPE = 'text/plain; version=0.0.4'
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = begin_request()
+
+@app.after_request
+def record_request_metrics(response):
+    return finish_request(response, request.url_rule, request.method, g.request_started)
+
+@app.teardown_request
+def end_request_metrics(exc):
+    if 'request_started' in g:
+        IN_FLIGHT.dec()
+
+def client_address(remote_addr, forwarded_for):
+    """The client's IP: the address TRUSTED_PROXY_HOPS proxies back in X-Forwarded-For, else the peer address."""
+    if TRUSTED_PROXY_HOPS and forwarded_for:
+        hops = [hop.strip() for hop in forwarded_for.split(',')]
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+    return remote_addr
+
+def rate_limit_wait(rule, endpoint, remote_addr, headers):
+    """Seconds the client must wait before calling this route again; 0 when the request may go ahead."""
+    if rule is None or endpoint == 'static':
+        return 0
+    wait = rate_limiter.allow(client_address(remote_addr, headers.get('X-Forwarded-For')), rule.rule)
+    if wait:
+        RATE_LIMITED.inc(route=rule.rule)
+    return wait
+
+RATE_LIMIT_MESSAGE = "Too many requests. Please wait a moment and try again."
+
+# Registered after start_request_metrics, so refused requests are still counted.
+@app.before_request
+def enforce_rate_limit():
+    wait = rate_limit_wait(request.url_rule, request.endpoint, request.remote_addr, request.headers)
+    if wait:
+        return jsonify({"error": RATE_LIMIT_MESSAGE}), 429, {'Retry-After': str(math.ceil(wait))}
+
+def cache_for(response, seconds):
+    """Let browsers reuse ``response`` for ``seconds``, e.g. the remaining freshness of the cached upstream data."""
+    response.cache_control.public = True
+    response.cache_control.max_age = int(seconds)
+    return response
+
+def dashboard_max_age(key):
+    return min(cache.fresh_for(key) for cache in (weather_cache, forecast_cache, air_quality_cache))
+
+def static_version(filename, static_folder):
+    return http_cache.fingerprint(os.path.join(static_folder, filename))
+
+def cache_static(response, filename, version, static_folder):
+    """Fingerprinted static URLs never change content, so they can be cached for a year."""
+    if version and version == static_version(filename, static_folder):
+        response.cache_control.public = True
+        response.cache_control.max_age = http_cache.IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+# Shared by both finalize hooks: ETag/304, default Cache-Control and compression.
+def finalize_body(response, body, method, request_headers):
+    status, body, headers = http_cache.finalize(method, response.status_code, response.mimetype, body,
+                                                response.headers, request_headers.get('If-None-Match'),
+                                                request_headers.get('Accept-Encoding'))
+    if headers:
+        response.status_code = status
+        response.set_data(body)
+        response.headers.update(headers)
+    return response
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        version = static_version(values['filename'], app.static_folder)
+        if version:
+            values.setdefault('v', version)
+
+# Registered after the metrics hooks so it runs before them and they record the final status.
+@app.after_request
+def finalize_response(response):
+    if request.endpoint == 'static':
+        return cache_static(response, request.view_args['filename'], request.args.get('v'), app.static_folder)
+    if response.is_streamed or response.direct_passthrough:
+        return response
+    return finalize_body(response, response.get_data(), request.method, request.headers)
+
 @app.route('/')
 def index():
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT city FROM favorites')
-    favorites = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return render_template('index.html', favorites=favorites)
+    # Each /live stream holds a worker thread here, so the page only follows updates under asgi.py.
+    return render_template('index.html', favorites=favorite_snapshots(list_favorites()), live_enabled=False)
 
-@app.route('/weather')
-def get_weather():
-    city = request.args.get('city')
-    lat = request.args.get('lat')
-    lon = request.args.get('lon')
+def openweather_error(e, label, error_message):
+    """Translate an upstream client exception into the APIError a route returns."""
+    if isinstance(e, AuthError):
+        app.logger.error("OpenWeather API Key is invalid or expired.")
+        return APIError("OpenWeather API Key is invalid or expired. Please check your API_KEY.", 401)
+    if isinstance(e, CircuitOpenError):
+        app.logger.error(f"{label}: {e}")
+        return APIError("OpenWeather is temporarily unavailable. Please try again shortly.", 503)
+    app.logger.error(f"{label}: Error fetching data: {e}")
+    return APIError(error_message, 500)
 
-    params = {'appid': API_KEY, 'units': 'metric'}
-    if lat and lon:
-        params['lat'] = lat
-        params['lon'] = lon
-    elif city:
-        params['q'] = city
-    else:
-        return jsonify({"error": "City or coordinates must be provided"}), 400
+@contextmanager
+def observe_upstream(upstream, endpoint):
+    """Charge an upstream call to its budget, and time it for /metrics and the request's Server-Timing header.
 
-    if not API_KEY or API_KEY.strip() == "":
-        app.logger.error("OPENWEATHER API_KEY not configured.")
-        return jsonify({"error": "OpenWeather API key not configured. Please set API_KEY in your .env file."}), 503
+    Yields a function that charges one more attempt, for the client's ``on_retry``.
+    """
+    budget = upstream_budgets.get(upstream)
 
+    def charge():
+        if budget is not None and not budget.spend(endpoint):
+            app.logger.warning("%s call budget used up; not calling %s", upstream, endpoint)
+            raise APIError("The upstream service's call budget is used up for now. Please try again later.", 503)
+
+    charge()
+    started = time.perf_counter()
     try:
-        response = requests.get(WEATHER_API_URL, params=params)
-        app.logger.debug(f"WEATHER: API response status code: {response.status_code}")
-        app.logger.debug(f"WEATHER: API response text: {response.text}")
-        if response.status_code == 401:
-            app.logger.error("OpenWeather API Key is invalid or expired.")
-            return jsonify({"error": "OpenWeather API Key is invalid or expired. Please check your API_KEY."}), 401
-        response.raise_for_status()
-        data = response.json()
+        with metrics.upstream_span():
+            yield charge
+    except Exception:
+        UPSTREAM_ERRORS.inc(upstream=upstream, endpoint=endpoint)
+        raise
+    finally:
+        UPSTREAM_LATENCY.observe(time.perf_counter() - started, upstream=upstream, endpoint=endpoint)
+
+def submit_upstream(fn, *args):
+    """Run ``fn`` on the upstream pool inside a copy of the request's context (for its timings)."""
+    return upstream_pool.submit(contextvars.copy_context().run, fn, *args)
 
+def fetch_openweather(url, params, label, error_message):
+    try:
+        with observe_upstream('openweather', label.lower()) as charge:
+            data = openweather.get_json(url, params, on_retry=charge)
+    except requests.exceptions.RequestException as e:
+        raise openweather_error(e, label, error_message)
+    app.logger.debug("%s: API response: %s", label, data)
+    return data
+
+def shape_weather(data):
+    try:
         tz_offset = datetime.timedelta(seconds=data['timezone'])
         tz = datetime.timezone(tz_offset)
         # Platform-specific hour format
@@ -98,7 +428,7 @@ def get_weather():
         sunrise = datetime.datetime.fromtimestamp(data["sys"]["sunrise"], tz=tz).strftime(hour_fmt)
         sunset = datetime.datetime.fromtimestamp(data["sys"]["sunset"], tz=tz).strftime(hour_fmt)
 
-        weather_data = {
+        return {
             "city": data["name"],
             "temperature": round(data["main"]["temp"]),
             "humidity": data["main"]["humidity"],
@@ -115,39 +445,12 @@ def get_weather():
             "sunrise": sunrise,
             "sunset": sunset
         }
-        return jsonify(weather_data)
-    except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error fetching weather data: {e}")
-        return jsonify({"error": "Error fetching weather data"}), 500
     except KeyError as e:
-        app.logger.error(f"Invalid data received from weather API: {e} | Response: {response.text}")
-        return jsonify({"error": f"Invalid data received from weather API: missing key {e}"}), 500
-
-@app.route('/air_quality')
-def get_air_quality():
-    lat = request.args.get('lat')
-    lon = request.args.get('lon')
-    if not lat or not lon:
-        app.logger.error("AIR_QUALITY: Latitude or longitude not provided.")
-        return jsonify({"error": "Latitude or longitude not provided"}), 400
-
-    params = {'lat': lat, 'lon': lon, 'appid': API_KEY}
-    app.logger.debug(f"AIR_QUALITY: Requesting API with params: {params}")
-    
-    if not API_KEY or API_KEY.strip() == "":
-        app.logger.error("OPENWEATHER API_KEY not configured.")
-        return jsonify({"error": "OpenWeather API key not configured. Please set API_KEY in your .env file."}), 503
+        app.logger.error(f"Invalid data received from weather API: {e} | Response: {data}")
+        raise APIError(f"Invalid data received from weather API: missing key {e}", 500)
 
+def shape_air_quality(data):
     try:
-        response = requests.get(AIR_QUALITY_API_URL, params=params)
-        app.logger.debug(f"AIR_QUALITY: API response status code: {response.status_code}")
-        app.logger.debug(f"AIR_QUALITY: API response text: {response.text}")
-        if response.status_code == 401:
-            app.logger.error("OpenWeather API Key is invalid or expired.")
-            return jsonify({"error": "OpenWeather API Key is invalid or expired. Please check your API_KEY."}), 401
-        response.raise_for_status()
-        data = response.json()
-
         if 'list' in data and data['list']:
             aqi_data = data['list'][0]
             air_quality_data = {
@@ -155,139 +458,519 @@ def get_air_quality():
                 "description": get_aqi_description(aqi_data.get('main', {}).get('aqi')),
                 "components": aqi_data.get('components', {})
             }
-            app.logger.debug(f"AIR_QUALITY: Successfully processed data: {air_quality_data}")
-            return jsonify(air_quality_data)
+            app.logger.debug("AIR_QUALITY: Successfully processed data: %s", air_quality_data)
+            return air_quality_data
         else:
             app.logger.warning("AIR_QUALITY: 'list' key not in data or is empty.")
-            return jsonify({"error": "Air quality data not available"}), 404
-    except requests.exceptions.RequestException as e:
-        app.logger.error(f"AIR_QUALITY: RequestException: {e}")
-        return jsonify({"error": "Error fetching air quality data"}), 500
+            raise APIError("Air quality data not available", 404)
     except (KeyError, IndexError) as e:
         app.logger.error(f"AIR_QUALITY: Data processing error (KeyError/IndexError): {e}")
-        return jsonify({"error": "Error processing air quality data"}), 500
+        raise APIError("Error processing air quality data", 500)
 
-@app.route('/forecast')
-def get_forecast():
-    lat = request.args.get('lat')
-    lon = request.args.get('lon')
-    params = {'appid': API_KEY, 'units': 'metric'}
+def shape_forecast(data):
+    try:
+        # Days are bucketed in the city's local time, not the server's.
+        return aggregate_daily(data.get('list', []), data.get('city', {}).get('timezone', 0))
+    except KeyError as e:
+        app.logger.error(f"Invalid data received from forecast API: {e}")
+        raise APIError("Invalid data received from forecast API", 500)
+
+def shape_location(data, city):
+    if not data:
+        app.logger.warning(f"GEOCODING: No match for city '{city}'.")
+        raise APIError("City not found", 404)
+    try:
+        place = data[0]
+        return {"name": place.get("name") or city, "lat": place["lat"], "lon": place["lon"], "country": place.get("country")}
+    except (KeyError, IndexError, TypeError) as e:
+        app.logger.error(f"GEOCODING: Data processing error: {e}")
+        raise APIError("Error resolving city location", 500)
+
+# Each upstream call is described once (URL, extra params, log label, error message, shaper)
+# so the sync routes here and the async routes in asgi.py behave identically.
+def weather_request(query):
+    return WEATHER_API_URL, dict(query, appid=API_KEY, units='metric'), "WEATHER", "Error fetching weather data"
+
+def forecast_request(query):
+    return FORECAST_API_URL, dict(query, appid=API_KEY, units='metric'), "FORECAST", "Error fetching forecast data"
+
+def air_quality_request(query):
+    app.logger.debug("AIR_QUALITY: Requesting API with params: %s", query)
+    return AIR_QUALITY_API_URL, dict(query, appid=API_KEY), "AIR_QUALITY", "Error fetching air quality data"
+
+def location_request(city):
+    return GEOCODING_API_URL, {'q': city, 'limit': 1, 'appid': API_KEY}, "GEOCODING", "Error resolving city location"
 
+def fetch_weather(query):
+    data = fetch_openweather(*weather_request(query))
+    weather = shape_weather(data)
+    history_store.record_weather(data)
+    return weather
+
+def fetch_forecast(query):
+    return shape_forecast(fetch_openweather(*forecast_request(query)))
+
+def fetch_air_quality(query):
+    data = fetch_openweather(*air_quality_request(query))
+    air_quality = shape_air_quality(data)
+    history_store.record_air_quality(query, data)
+    return air_quality
+
+def fetch_location(city):
+    return shape_location(fetch_openweather(*location_request(city)), city)
+
+def history_time(value, default):
+    """Parse a /history bound given as epoch seconds or ISO 8601 (UTC unless it has an offset)."""
+    if not value:
+        return default
+    try:
+        return int(float(value))
+    except ValueError:
+        pass
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise APIError(f"Invalid time '{value}': use epoch seconds or ISO 8601", 400)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return int(parsed.timestamp())
+
+def history_request(args):
+    """Validate /history arguments; returns (location, start, end, resolution)."""
+    resolution = args.get('resolution', 'hour')
+    if resolution not in ('raw', 'hour', 'day'):
+        raise APIError("Resolution must be one of raw, hour, day", 400)
+    end = history_time(args.get('to'), int(time.time()))
+    start = history_time(args.get('from'), end - HISTORY_DEFAULT_SPAN)
+    if start > end:
+        raise APIError("'from' must not be after 'to'", 400)
+
+    lat, lon, city = args.get('lat'), args.get('lon'), args.get('city')
     if lat and lon:
-        params['lat'] = lat
-        params['lon'] = lon
+        return history_location_key(lat, lon), start, end, resolution
+    if not city:
+        raise APIError("City or coordinates must be provided", 400)
+    # Readings are keyed by coordinates (air quality ones carry no name, and OpenWeather may name the
+    # station differently), so resolve the city locally first; the recorded names are the fallback.
+    coords = gazetteer.lookup(city, record=False) or geocode_cache.peek(make_key(city))
+    if coords:
+        return history_location_key(coords['lat'], coords['lon']), start, end, resolution
+    location = history_store.find_location(city)
+    if location is None:
+        raise APIError("No history recorded for this city", 404)
+    return location, start, end, resolution
+
+def load_history(args):
+    location, start, end, resolution = history_request(args)
+    return {"location": location, "resolution": resolution, "from": start, "to": end,
+            "points": history_store.query(location, start, end, resolution)}
+
+def dashboard_query(args):
+    """Validate /dashboard arguments; returns (city, coordinates or None)."""
+    _, query = location_query(args)
+    check_api_key()
+    if 'q' in query:
+        return query['q'], None
+    return None, {"name": None, "lat": query['lat'], "lon": query['lon']}
+
+def build_dashboard(location, sections):
+    """Combine per-section results (values or APIErrors) into the /dashboard document."""
+    dashboard = {"location": location, "errors": {}}
+    for section, result in sections.items():
+        if isinstance(result, APIError):
+            dashboard[section] = None
+            dashboard["errors"][section] = {"error": result.message, "status": result.status_code}
+        else:
+            dashboard[section] = result
+    if dashboard["weather"] and location["name"]:
+        # Keep the searched city's name rather than the nearest station's.
+        dashboard["weather"] = dict(dashboard["weather"], city=location["name"])
+    return dashboard
+
+def batch_queries(cities, coords):
+    """Dedupe a batch of cities and {"lat", "lon"} pairs into {cache key: (query label, OpenWeather query)}."""
+    if not isinstance(cities, list) or not isinstance(coords, list):
+        raise APIError("'cities' and 'coords' must be lists", 400)
+    queries = {}
+    for city in cities:
+        if isinstance(city, str) and city.strip():
+            queries.setdefault(make_key(city), (city, {'q': city}))
+    for coord in coords:
+        if isinstance(coord, dict) and coord.get('lat') is not None and coord.get('lon') is not None:
+            key, query = snap_coords(coord['lat'], coord['lon'])
+            queries.setdefault(key, ({'lat': coord['lat'], 'lon': coord['lon']}, query))
+    if not queries:
+        raise APIError("At least one city or coordinate pair must be provided", 400)
+    if len(queries) > BATCH_MAX_ITEMS:
+        raise APIError(f"Too many locations in one batch (max {BATCH_MAX_ITEMS})", 400)
+    return queries
+
+def batch_body(body):
+    """Split a POST /weather/batch body into (cities, coords); a bare JSON list is taken as the cities."""
+    if isinstance(body, list):
+        return body, []
+    if not isinstance(body, dict):
+        raise APIError("Body must be a JSON object with 'cities' and/or 'coords', or a list of cities", 400)
+    return body.get('cities', []), body.get('coords', [])
+
+def batch_line(label, result):
+    if isinstance(result, APIError):
+        line = {"query": label, "status": result.status_code, "error": result.message}
     else:
-        city = request.args.get('city')
-        if not city:
-            return jsonify({"error": "City or coordinates must be provided"}), 400
-        params['q'] = city
+        line = {"query": label, "status": 200, "weather": result}
+    return json.dumps(line, ensure_ascii=False) + "\n"
 
-    if not API_KEY or API_KEY.strip() == "":
-        app.logger.error("OPENWEATHER API_KEY not configured.")
-        return jsonify({"error": "OpenWeather API key not configured. Please set API_KEY in your .env file."}), 503
+def load_dashboard_sections(location, sections=('weather', 'forecast', 'air_quality')):
+    """Fetch the given sections (default: weather, forecast and air quality) for a resolved location concurrently."""
+    key, coords = snap_coords(location['lat'], location['lon'])
+    loaders = {
+        'weather': (weather_cache, fetch_weather),
+        'forecast': (forecast_cache, fetch_forecast),
+        'air_quality': (air_quality_cache, fetch_air_quality),
+    }
+    futures = {}
+    for section in sections:
+        cache, fetch = loaders[section]
+        futures[section] = submit_upstream(cache.get_or_load, key, lambda fetch=fetch: fetch(coords))
+    sections = {}
+    for section, future in futures.items():
+        try:
+            sections[section] = future.result()
+        except APIError as e:
+            sections[section] = e
+    return sections
+
+def warm_favorite(city):
+    """Load everything /dashboard?city= needs for a favorite into the caches."""
+    check_api_key()
+    location = resolve_city(city)
+    for section, result in load_dashboard_sections(location).items():
+        if isinstance(result, APIError):
+            raise result
+
+def favorite_snapshots(favorites):
+    """Attach whatever current temperature and AQI is cached to each favorite, without fetching."""
+    snapshots = []
+    for city in favorites:
+        snapshot = {"city": city, "temperature": None, "icon": None, "aqi": None, "aqi_description": None}
+        location = gazetteer.lookup(city, record=False) or geocode_cache.peek(make_key(city))
+        if location:
+            key, _ = snap_coords(location['lat'], location['lon'], record=False)
+            weather_data = weather_cache.peek(key)
+            if weather_data:
+                snapshot.update(temperature=weather_data["temperature"], icon=weather_data["icon"])
+            air_quality_data = air_quality_cache.peek(key)
+            if air_quality_data:
+                snapshot.update(aqi=air_quality_data["aqi"], aqi_description=air_quality_data["description"])
+        snapshots.append(snapshot)
+    return snapshots
+
+# Keeps every favorite's dashboard data cached so clicking one is a cache hit.
+# FAVORITES_WARM_INTERVAL=0 disables it.
+FAVORITES_WARM_INTERVAL = int(os.getenv("FAVORITES_WARM_INTERVAL", "300"))
+def favorites_to_warm():
+    # Prefetching is the first thing to go when the OpenWeather budget runs low.
+    if upstream_budgets['openweather'].low():
+        return []
+    return list_favorites()
+
+# Only the worker holding FAVORITES_WARM_LOCK_PATH warms, so N workers don't make N times the calls.
+favorites_warmer = CacheWarmer('favorites', favorites_to_warm, warm_favorite,
+                               interval=FAVORITES_WARM_INTERVAL,
+                               concurrency=int(os.getenv("FAVORITES_WARM_CONCURRENCY", "4")),
+                               lock_path=os.getenv("FAVORITES_WARM_LOCK_PATH", "favorites-warmer.lock"))
+
+def live_snapshot(location):
+    """The document /live streams: /dashboard without the forecast."""
+    return build_dashboard(location, load_dashboard_sections(location, ('weather', 'air_quality')))
+
+def live_request(args):
+    """Validate /live arguments; returns (subscription key, resolved location).
 
+    Viewers of the same city, or of coordinates in the same cell, share a key
+    and so one poller. Different city names in one cell get their own poller,
+    since the name is part of the document, but still share the cached data.
+    """
+    city, location = dashboard_query(args)
+    if location is None:
+        location = resolve_city(city)
+    key, _ = snap_coords(location['lat'], location['lon'], record=False)
+    return (f"{key}|{make_key(city)}" if city else key), location
+
+# /live pushes weather and air quality changes as Server-Sent Events. One poller per geohash cell
+# re-reads the caches every LIVE_POLL_INTERVAL seconds and sends subscribers only the fields that changed.
+LIVE_POLL_INTERVAL = float(os.getenv("LIVE_POLL_INTERVAL", "60"))
+# Locations polled at once, comment lines sent to keep idle connections open, and seconds
+# before a stream ends (the browser's EventSource then reconnects on its own).
+LIVE_MAX_LOCATIONS = int(os.getenv("LIVE_MAX_LOCATIONS", "200"))
+LIVE_HEARTBEAT = float(os.getenv("LIVE_HEARTBEAT", "15"))
+LIVE_STREAM_DURATION = float(os.getenv("LIVE_STREAM_DURATION", "600"))
+live_hub = LiveHub(lambda location: live_snapshot(location), LIVE_POLL_INTERVAL, LIVE_MAX_LOCATIONS)
+# Under gunicorn's gthread workers an open /live stream occupies one of the GUNICORN_THREADS threads until
+# it ends, so each WSGI worker serves at most LIVE_MAX_STREAMS of them (a quarter of its threads by default)
+# and answers 503 beyond that. 0 turns /live off here; the ASGI server has no such limit.
+LIVE_MAX_STREAMS = int(os.getenv("LIVE_MAX_STREAMS") or int(os.getenv("GUNICORN_THREADS") or 4) // 4)
+live_stream_slots = threading.BoundedSemaphore(LIVE_MAX_STREAMS) if LIVE_MAX_STREAMS > 0 else None
+
+def start_background_tasks():
+    history_store.start()
+    if FAVORITES_WARM_INTERVAL > 0 and API_KEY:
+        favorites_warmer.start()
+
+def create_app(start_tasks=True):
+    """Production entry point, e.g. ``gunicorn 'main:create_app()'``: prepare storage and return the app.
+
+    A server that preloads the app and then forks should pass ``start_tasks=False``
+    and call ``start_background_tasks()`` in each worker (see gunicorn.conf.py),
+    since threads do not survive a fork.
+    """
+    init_db()
+    if start_tasks:
+        start_background_tasks()
+    return app
+
+@app.route('/weather')
+def get_weather():
     try:
-        response = requests.get(FORECAST_API_URL, params=params)
-        app.logger.debug(f"FORECAST: API response status code: {response.status_code}")
-        app.logger.debug(f"FORECAST: API response text: {response.text}")
-        if response.status_code == 401:
-            app.logger.error("OpenWeather API Key is invalid or expired.")
-            return jsonify({"error": "OpenWeather API Key is invalid or expired. Please check your API_KEY."}), 401
-        response.raise_for_status()
-        data = response.json()
-
-        daily_forecasts = defaultdict(lambda: {
-            'temp_min': float('inf'), 'temp_max': float('-inf'),
-            'weather': defaultdict(int), 'icon': '', 'date': '',
-        })
-
-        for item in data.get('list', []):
-            dt_object = datetime.datetime.fromtimestamp(item['dt'])
-            date_key = dt_object.strftime('%Y-%m-%d')
-            daily_forecasts[date_key]['date'] = dt_object.strftime('%a, %b %d')
-            daily_forecasts[date_key]['temp_min'] = min(daily_forecasts[date_key]['temp_min'], item['main']['temp_min'])
-            daily_forecasts[date_key]['temp_max'] = max(daily_forecasts[date_key]['temp_max'], item['main']['temp_max'])
-            weather_main = item['weather'][0]['main']
-            daily_forecasts[date_key]['weather'][weather_main] += 1
-            if dt_object.hour >= 12 and dt_object.hour < 15:
-                daily_forecasts[date_key]['icon'] = item['weather'][0]['icon']
-        
-        final_forecast = []
-        sorted_keys = sorted(daily_forecasts.keys())
-        for date_key in sorted_keys:
-            forecast = daily_forecasts[date_key]
-            if not forecast['date']: continue
-
-            dominant_weather = max(forecast['weather'], key=forecast['weather'].get) if forecast['weather'] else 'N/A'
-            if not forecast['icon']:
-                for item in data.get('list', []):
-                    if datetime.datetime.fromtimestamp(item['dt']).strftime('%Y-%m-%d') == date_key:
-                        forecast['icon'] = item['weather'][0]['icon']
-                        break
-            
-            final_forecast.append({
-                'date': forecast['date'],
-                'temp_min': round(forecast['temp_min']),
-                'temp_max': round(forecast['temp_max']),
-                'description': dominant_weather,
-                'icon': forecast['icon'] or '01d'
-            })
-        
-        return jsonify(final_forecast[:5])
+        key, query = location_query(request.args)
+        check_api_key()
+        weather_data = weather_cache.get_or_load(key, lambda: fetch_weather(query))
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+    return cache_for(jsonify(weather_data), weather_cache.fresh_for(key))
 
-    except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error fetching forecast data: {e}")
-        return jsonify({"error": "Error fetching forecast data"}), 500
-    except KeyError as e:
-        app.logger.error(f"Invalid data received from forecast API: {e}")
-        return jsonify({"error": "Invalid data received from forecast API"}), 500
+@app.route('/weather/batch', methods=['GET', 'POST'])
+def get_weather_batch():
+    try:
+        if request.method == 'POST':
+            queries = batch_queries(*batch_body(request.get_json(force=True, silent=True) or {}))
+        else:
+            coords = [dict(zip(('lat', 'lon'), c.split(',', 1))) for c in request.args.getlist('coord')]
+            queries = batch_queries(request.args.getlist('city'), coords)
+        check_api_key()
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+
+    def load(key, query):
+        try:
+            return weather_cache.get_or_load(key, lambda: fetch_weather(query))
+        except APIError as e:
+            return e
+        except Exception as e:
+            app.logger.error(f"WEATHER_BATCH: Unexpected error for {key}: {e}")
+            return APIError("Error fetching weather data", 500)
+
+    def generate():
+        # Cached results go out first; the rest stream back as they complete,
+        # with at most BATCH_CONCURRENCY upstream calls running for this request.
+        pending = deque()
+        for key, (label, query) in queries.items():
+            cached = weather_cache.get(key)
+            if cached is not None:
+                yield batch_line(label, cached)
+            else:
+                pending.append((key, label, query))
+        running = {}
+        while pending or running:
+            while pending and len(running) < BATCH_CONCURRENCY:
+                key, label, query = pending.popleft()
+                running[submit_upstream(load, key, query)] = label
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield batch_line(running.pop(future), future.result())
+
+    return app.response_class(generate(), mimetype='application/x-ndjson')
+
+@app.route('/air_quality')
+def get_air_quality():
+    try:
+        key, query = coords_query(request.args)
+        check_api_key()
+        air_quality_data = air_quality_cache.get_or_load(key, lambda: fetch_air_quality(query))
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+    return cache_for(jsonify(air_quality_data), air_quality_cache.fresh_for(key))
+
+@app.route('/forecast')
+def get_forecast():
+    try:
+        key, query = location_query(request.args)
+        check_api_key()
+        forecast = forecast_cache.get_or_load(key, lambda: fetch_forecast(query))
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+    return cache_for(jsonify(forecast), forecast_cache.fresh_for(key))
+
+@app.route('/dashboard')
+def get_dashboard():
+    try:
+        city, location = dashboard_query(request.args)
+        # Resolve coordinates once so all three sections can be fetched at the same time.
+        if location is None:
+            location = resolve_city(city)
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+
+    dashboard = build_dashboard(location, load_dashboard_sections(location))
+    key, _ = snap_coords(location['lat'], location['lon'], record=False)
+    return cache_for(jsonify(dashboard), dashboard_max_age(key))
+
+def cache_report():
+    report = {cache.name: cache.stats() for cache in CACHES}
+    report['geo'] = dict(geo_grid.stats(), gazetteer=gazetteer.stats())
+    return report
+
+@metrics_registry.collector
+def cache_metrics():
+    events = metrics.Counter('cache_events_total', 'Cache lookups and loads by outcome.', ('cache', 'event'))
+    hit_ratio = metrics.Gauge('cache_hit_ratio', 'Share of lookups answered from the cache (stale included).', ('cache',))
+    for cache in CACHES:
+        stats = cache.stats()
+        for event in ('hits', 'stale_hits', 'misses', 'loads', 'load_errors', 'coalesced', 'peer_loads'):
+            events.inc(stats[event], cache=cache.name, event=event)
+        hit_ratio.set(stats['hit_ratio'], cache=cache.name)
+    return [events, hit_ratio]
+
+@metrics_registry.collector
+def live_metrics():
+    locations = live_hub.locations()
+    polled = metrics.Gauge('live_locations', 'Locations with a /live poller.')
+    subscribers = metrics.Gauge('live_subscribers', 'Open /live streams.')
+    polled.set(len(locations))
+    subscribers.set(sum(locations.values()))
+    events = metrics.Counter('live_events_total', 'Poller loads, change fan-outs and load errors.', ('event',))
+    for event, count in live_hub.stats.items():
+        events.inc(count, event=event)
+    return [polled, subscribers, events]
+
+@metrics_registry.collector
+def budget_metrics():
+    remaining = metrics.Gauge('upstream_budget_remaining', 'Upstream calls left in the current window.',
+                              ('upstream', 'window'))
+    limit = metrics.Gauge('upstream_budget_limit', 'Upstream calls allowed per window.', ('upstream', 'window'))
+    ttl_scale = metrics.Gauge('upstream_budget_ttl_scale', 'Factor stretching cache TTLs while the budget is low.',
+                              ('upstream',))
+    calls = metrics.Counter('upstream_budget_calls_total', 'Upstream calls charged to the budget by this worker.',
+                            ('upstream', 'endpoint'))
+    rejected = metrics.Counter('upstream_budget_rejected_total', 'Upstream calls refused because the budget was used up.',
+                               ('upstream',))
+    for name, budget in upstream_budgets.items():
+        for window, left in budget.remaining().items():
+            remaining.set(left, upstream=name, window=window)
+            limit.set(budget.limits[window], upstream=name, window=window)
+        ttl_scale.set(round(budget.ttl_scale(), 3), upstream=name)
+        for endpoint, count in budget.calls.items():
+            calls.inc(count, upstream=name, endpoint=endpoint)
+        rejected.inc(budget.rejected, upstream=name)
+    return [remaining, limit, ttl_scale, calls, rejected]
+
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify(cache_report())
+
+@app.route('/metrics')
+def get_metrics():
+    return app.response_class(metrics_registry.render(), mimetype=METRICS_MIMETYPE)
+
+@app.route('/history')
+def get_history():
+    try:
+        return jsonify(load_history(request.args))
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
 
 @app.route('/favorites', methods=['GET', 'POST', 'DELETE'])
 def handle_favorites():
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
     if request.method == 'GET':
-        cursor.execute('SELECT city FROM favorites')
-        favorites = [row[0] for row in cursor.fetchall()]
-        conn.close()
-        return jsonify(favorites)
+        return jsonify(list_favorites())
 
     data = request.get_json()
     city = data.get('city')
     if not city:
-        conn.close()
         return jsonify({"error": "City not provided"}), 400
 
     if request.method == 'POST':
-        try:
-            cursor.execute('INSERT INTO favorites (city) VALUES (?)', (city,))
-            conn.commit()
-            message = {"success": True, "city": city}
-        except sqlite3.IntegrityError:
-            message = {"error": "City already in favorites"}
-    
-    elif request.method == 'DELETE':
-        cursor.execute('DELETE FROM favorites WHERE city = ?', (city,))
-        conn.commit()
-        message = {"success": True, "city": city}
-
-    conn.close()
-    return jsonify(message)
+        return jsonify(add_favorite(city))
+    return jsonify(remove_favorite(city))
 
-@app.route('/health_analysis', methods=['POST'])
-def health_analysis():
-    data = request.get_json()
-    weather_data = data.get('weather_data')
-    air_quality_data = data.get('air_quality_data')
+@app.route('/favorites/bulk', methods=['POST', 'DELETE'])
+def handle_favorites_bulk():
+    try:
+        cities = bulk_cities(request.get_json(force=True, silent=True))
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+    return jsonify(bulk_update_favorites(request.method, cities))
 
-    if not weather_data or not air_quality_data:
-        return jsonify({"error": "Weather or air quality data not provided"}), 400
-    
-    if not GEMINI_API_KEY:
-        return jsonify({"error": "Gemini API key not configured. Please set GEMINI_API_KEY in your .env file."}), 503
+def _bucket(value, step):
+    try:
+        return round(float(value) / step) * step
+    except (TypeError, ValueError):
+        return value
+
+def _significant(value, digits=2):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return value
+    if value == 0:
+        return 0
+    return round(value, digits - 1 - math.floor(math.log10(abs(value))))
 
-    prompt = f"""
+def _text(value):
+    return value.strip().lower() if isinstance(value, str) else value
+
+def quantize_health_inputs(weather_data, air_quality_data):
+    """Reduce the readings the prompt uses to coarse buckets, so similar conditions share one analysis."""
+    weather = {
+        'temperature': _bucket(weather_data.get('temperature'), 1),
+        'description': _text(weather_data.get('description')),
+        'humidity': _bucket(weather_data.get('humidity'), 5),
+        'wind_speed': _bucket(weather_data.get('wind_speed'), 2),
+    }
+    components = air_quality_data.get('components')
+    if isinstance(components, dict):
+        components = {name: _significant(value) for name, value in sorted(components.items())}
+    air_quality = {
+        'aqi': air_quality_data.get('aqi'),
+        'description': air_quality_data.get('description'),
+        'components': components,
+    }
+    return weather, air_quality
+
+def analysis_key(weather_data, air_quality_data):
+    payload = json.dumps([HEALTH_MODEL, weather_data, air_quality_data], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+_gemini_lock = threading.Lock()
+_gemini_model = None
+
+def gemini_model():
+    """The shared Gemini model, importing and configuring the SDK on first use.
+
+    The SDK import dominates startup time, and pre-forked workers must not
+    inherit a gRPC channel, so nothing touches it until the first analysis.
+    """
+    global _gemini_model
+    if _gemini_model is None:
+        with _gemini_lock:
+            if _gemini_model is None:
+                import google.generativeai as genai
+                if GEMINI_BASE_URL:
+                    # A custom endpoint is plain HTTP, so use the REST transport instead of gRPC
+                    genai.configure(api_key=GEMINI_API_KEY, transport='rest',
+                                    client_options={'api_endpoint': GEMINI_BASE_URL})
+                else:
+                    genai.configure(api_key=GEMINI_API_KEY)
+                _gemini_model = genai.GenerativeModel(HEALTH_MODEL)
+    return _gemini_model
+
+def generate_health_analysis(prompt):
+    model = gemini_model()
+    with observe_upstream('gemini', 'generate'):
+        return model.generate_content(prompt).text
+
+def build_health_prompt(weather_data, air_quality_data):
+    return f"""
     คุณคือผู้เชี่ยวชาญด้านสุขภาพและสภาพอากาศ 🌤️
 
 โปรดให้คำแนะนำด้านสุขภาพแบบส่วนบุคคล โดยอ้างอิงจากข้อมูลสภาพอากาศและคุณภาพอากาศด้านล่างนี้
@@ -339,16 +1022,148 @@ def health_analysis():
 ### 💡 คำแนะนำเพื่อสุขภาพและการใช้ชีวิต:
     """
 
+def health_analysis_request(data):
+    """Validate a /health_analysis body; returns the analysis cache key and the Gemini prompt."""
+    data = data or {}
+    weather_data = data.get('weather_data')
+    air_quality_data = data.get('air_quality_data')
+
+    if not weather_data or not air_quality_data:
+        raise APIError("Weather or air quality data not provided", 400)
+
+    if not GEMINI_API_KEY:
+        raise APIError("Gemini API key not configured. Please set GEMINI_API_KEY in your .env file.", 503)
+
+    # The prompt is built from the bucketed readings so a cached answer matches every request sharing its key.
+    weather_data, air_quality_data = quantize_health_inputs(weather_data, air_quality_data)
+    return analysis_key(weather_data, air_quality_data), build_health_prompt(weather_data, air_quality_data)
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def follow_health_analysis(flight):
+    """SSE events replaying another request's generation of the same analysis."""
     try:
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        response = model.generate_content(prompt)
-        recommendations = response.text
+        for text in flight.follow(HEALTH_STREAM_TIMEOUT):
+            yield sse_event('chunk', {'text': text})
+    except Exception as e:
+        app.logger.error(f"Error streaming content from Gemini API: {e}")
+        yield sse_event('error', {'error': f"Failed to get AI analysis: {str(e)}"})
+        return
+    yield sse_event('done', {'cached': False, 'shared': True})
+
+def stream_health_analysis(key, prompt):
+    """Yield SSE events (chunk*, then done or error) for one analysis, caching the full text once complete."""
+    cached = analysis_cache.get(key)
+    if cached is not None:
+        yield sse_event('chunk', {'text': cached})
+        yield sse_event('done', {'cached': True})
+        return
+    flight, leader = analysis_streams.join(key)
+    if not leader:
+        yield from follow_health_analysis(flight)
+        return
+
+    deadline = time.monotonic() + HEALTH_STREAM_TIMEOUT
+    parts = []
+    finished = False
+    try:
+        model = gemini_model()
+        with observe_upstream('gemini', 'stream'):
+            # The RPC deadline bounds a stalled stream; the loop check bounds a slow trickle of chunks.
+            response = model.generate_content(prompt, stream=True, request_options={'timeout': HEALTH_STREAM_TIMEOUT})
+            for chunk in response:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"no complete answer within {HEALTH_STREAM_TIMEOUT:g}s")
+                if chunk.text:
+                    parts.append(chunk.text)
+                    flight.append(chunk.text)
+                    yield sse_event('chunk', {'text': chunk.text})
+        analysis_cache.set(key, ''.join(parts))
+        finished = True
+        analysis_streams.finish(key, flight)
+        yield sse_event('done', {'cached': False})
+    except Exception as e:
+        finished = True
+        analysis_streams.finish(key, flight, e)
+        app.logger.error(f"Error streaming content from Gemini API: {e}")
+        yield sse_event('error', {'error': f"Failed to get AI analysis: {str(e)}"})
+    finally:
+        if not finished:
+            # The client disconnected (or the server closed the stream); stop reading from Gemini.
+            analysis_streams.finish(key, flight, RuntimeError("the request generating it was cancelled"))
+            app.logger.info("HEALTH_ANALYSIS: stream cancelled before completion")
+
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+def live_events(subscription):
+    """Yield 'update' events (the full document first, then changed fields only) with keep-alive comments between."""
+    deadline = time.monotonic() + LIVE_STREAM_DURATION
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        update = subscription.wait(min(LIVE_HEARTBEAT, remaining))
+        yield sse_event('update', update) if update is not None else ": keep-alive\n\n"
+
+LIVE_HUB_FULL = "Too many locations are being followed right now, try again later"
+
+def live_subscription(key, location, wakeup=None):
+    subscription = live_hub.subscribe(key, location, wakeup)
+    if subscription is None:
+        raise APIError(LIVE_HUB_FULL, 503)
+    return subscription
+
+@app.route('/health_analysis', methods=['POST'])
+def health_analysis():
+    try:
+        key, prompt = health_analysis_request(request.get_json())
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+
+    try:
+        recommendations = analysis_cache.get_or_load(key, lambda: generate_health_analysis(prompt))
         return jsonify({"analysis": recommendations}) # Changed key from 'recommendations' to 'analysis'
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
     except Exception as e:
         app.logger.error(f"Error generating content with Gemini API: {e}")
         return jsonify({"error": f"Failed to get AI analysis: {str(e)}"}), 500
 
+@app.route('/health_analysis/stream', methods=['POST'])
+def health_analysis_stream():
+    """Same input as /health_analysis, answered as Server-Sent Events while Gemini generates."""
+    try:
+        key, prompt = health_analysis_request(request.get_json(silent=True))
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+    return app.response_class(stream_health_analysis(key, prompt), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+@app.route('/live')
+def live():
+    """Follow a city (?city=) or coordinates (?lat=&lon=): weather and air quality changes as Server-Sent Events."""
+    try:
+        key, location = live_request(request.args)
+    except APIError as e:
+        return jsonify({"error": e.message}), e.status_code
+    slots = live_stream_slots
+    if slots is None or not slots.acquire(blocking=False):
+        return jsonify({"error": "Too many live streams are open on this server, try again later"}), 503
+    try:
+        subscription = live_subscription(key, location)
+    except APIError as e:
+        slots.release()
+        return jsonify({"error": e.message}), e.status_code
+    response = app.response_class(live_events(subscription), mimetype='text/event-stream', headers=SSE_HEADERS)
+    # Runs even when the client leaves before the generator starts.
+    response.call_on_close(subscription.close)
+    response.call_on_close(slots.release)
+    return response
+
 
 if __name__ == '__main__':
     init_db()
+    # The debug reloader runs this block in a watcher process too; only warm from the serving child.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_tasks()
     app.run(debug=True, host='0.0.0.0', port=8080)
@@ -0,0 +1,123 @@
+"""Client rate limiting and upstream call budgets.
+
+``RateLimiter`` keeps a token bucket per (client, route): each bucket holds up
+to ``burst`` tokens and refills at ``per_minute / 60`` tokens a second. The
+buckets live in the worker's memory (least recently used ones are dropped
+beyond ``max_clients``), so with several workers a client gets up to that
+many times the limit.
+
+``UpstreamBudget`` counts the calls made to one upstream API in the current
+minute and day (UTC) against the plan's caps. The counters live in a cache
+backend; given a SQLite or Redis one, every worker draws from the same budget.
+``spend()`` refuses a call once a window's budget is used up,
+and ``ttl_scale()`` tells caches how much longer to keep entries once less than
+``reserve`` of a budget is left, from 1x up to ``max_stretch``x when empty.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from cache import MemoryBackend
+
+WINDOWS = (('minute', 60), ('day', 86400))
+
+
+class RateLimiter:
+    def __init__(self, per_minute, burst, routes=None, max_clients=10000, clock=time.monotonic):
+        """``routes`` maps a route to its own (per_minute, burst); a per_minute of 0 disables the limit."""
+        self.default = (per_minute, burst)
+        self.routes = dict(routes or {})
+        self.max_clients = max_clients
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def limit_for(self, route):
+        return self.routes.get(route, self.default)
+
+    def allow(self, client, route):
+        """Take a token from the (client, route) bucket; returns 0 when allowed, else seconds until a token is free."""
+        per_minute, burst = self.limit_for(route)
+        if per_minute <= 0:
+            return 0.0
+        rate = per_minute / 60.0
+        now = self._clock()
+        with self._lock:
+            tokens, updated = self._buckets.pop((client, route), (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[(client, route)] = (tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class UpstreamBudget:
+    def __init__(self, name, per_minute=0, per_day=0, backend=None, reserve=0.25, max_stretch=4.0,
+                 clock=time.time):
+        """A cap of 0 means that window is not limited."""
+        self.name = name
+        self.limits = {'minute': per_minute, 'day': per_day}
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.reserve = reserve
+        self.max_stretch = max_stretch
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.rejected = 0
+
+    def _key(self, window, seconds, now):
+        return f"budget:{self.name}:{window}:{int(now // seconds)}"
+
+    def _used(self, amount):
+        now = self._clock()
+        return {window: self.backend.incr(self._key(window, seconds, now), amount, seconds)
+                for window, seconds in WINDOWS if self.limits[window]}
+
+    def _counts(self):
+        now = self._clock()
+        return {window: self.backend.counter(self._key(window, seconds, now))
+                for window, seconds in WINDOWS if self.limits[window]}
+
+    def spend(self, endpoint):
+        """Count one call to ``endpoint``; False (and nothing counted) if a window's budget is used up."""
+        used = self._used(1)
+        if any(used[window] > self.limits[window] for window in used):
+            self._used(-1)
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        return True
+
+    def remaining(self):
+        """Calls left in each limited window."""
+        return {window: max(self.limits[window] - used, 0) for window, used in self._counts().items()}
+
+    def left(self):
+        """Smallest share of a window's budget still available (1.0 without limits)."""
+        return min([remaining / self.limits[window] for window, remaining in self.remaining().items()], default=1.0)
+
+    def low(self):
+        return self.left() < self.reserve
+
+    def ttl_scale(self):
+        left = self.left()
+        if left >= self.reserve:
+            return 1.0
+        return 1.0 + (self.max_stretch - 1.0) * (1.0 - left / self.reserve)
+
+    def reset(self):
+        self.backend.clear(f"budget:{self.name}:")
+        with self._lock:
+            self.calls = {}
+            self.rejected = 0
@@ -0,0 +1,395 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from cache import CacheEntry, MemoryBackend, RedisBackend, SQLiteBackend, StreamFlights, TTLCache, make_key
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_make_key_normalizes_queries():
+    assert make_key(city="  Bangkok ") == make_key(city="bangkok") == "city:bangkok"
+    assert make_key(lat="13.75631", lon="100.50179") == "coord:13.76,100.50"
+    assert make_key(lat="13.7563", lon="100.5018", precision=3) == "coord:13.756,100.502"
+    assert make_key(lat="abc", lon="1") == "coord:abc,1"
+
+
+def test_hit_miss_and_expiry():
+    clock = FakeClock()
+    cache = TTLCache('test', ttl=10, clock=clock)
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return len(calls)
+
+    assert cache.get_or_load('k', loader) == 1
+    assert cache.get_or_load('k', loader) == 1
+    clock.now += 11
+    assert cache.get_or_load('k', loader) == 2
+
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 2
+    assert stats['hit_ratio'] == pytest.approx(1 / 3, abs=1e-4)
+
+
+def test_fresh_for_counts_down_to_zero():
+    clock = FakeClock()
+    cache = TTLCache('test', ttl=10, stale_ttl=30, clock=clock)
+    assert cache.fresh_for('a') == 0
+    cache.set('a', 1)
+    clock.now += 4
+    assert cache.fresh_for('a') == 6
+    clock.now += 10
+    assert cache.fresh_for('a') == 0
+
+
+def test_stale_value_is_served_while_refreshing():
+    clock = FakeClock()
+    cache = TTLCache('test', ttl=10, stale_ttl=30, clock=clock)
+    cache.set('k', 'old')
+    clock.now += 15
+
+    refreshed = threading.Event()
+
+    def loader():
+        refreshed.set()
+        return 'new'
+
+    assert cache.get_or_load('k', loader) == 'old'
+    assert refreshed.wait(1)
+    for _ in range(100):
+        if cache.peek('k') == 'new':
+            break
+        time.sleep(0.01)
+    assert cache.get_or_load('k', loader) == 'new'
+    assert cache.stats()['stale_hits'] == 1
+
+
+def test_loader_errors_are_not_cached():
+    cache = TTLCache('test', ttl=10)
+
+    def failing():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        cache.get_or_load('k', failing)
+    assert cache.get_or_load('k', lambda: 'ok') == 'ok'
+    assert cache.stats()['load_errors'] == 1
+
+
+def test_concurrent_misses_share_one_load():
+    cache = TTLCache('test', ttl=10)
+    calls = []
+    release = threading.Event()
+
+    def loader():
+        calls.append(1)
+        release.wait(1)
+        return 'value'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load('k', loader))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == ['value'] * 8
+    assert len(calls) == 1
+    assert cache.stats()['coalesced'] == 7
+    assert cache.stats()['saved_loads'] == 7
+
+
+def test_lru_eviction():
+    cache = TTLCache('test', ttl=10, max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get_or_load('a', lambda: None)
+    cache.set('c', 3)
+
+    assert cache.peek('a') == 1
+    assert cache.peek('b') is None
+    assert cache.peek('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+
+class FakeRedis:
+    """Minimal stand-in for the subset of the Redis protocol RedisBackend uses."""
+
+    def __init__(self):
+        self.data = {}
+
+    def _alive(self, key):
+        item = self.data.get(key)
+        if item is not None and item[1] is not None and item[1] <= time.time():
+            del self.data[key]
+            item = None
+        return item
+
+    def get(self, key):
+        item = self._alive(key)
+        return item[0] if item else None
+
+    def set(self, key, value, nx=False, px=None):
+        if nx and self._alive(key):
+            return None
+        if isinstance(value, str):
+            value = value.encode()
+        self.data[key] = (value, time.time() + px / 1000 if px else None)
+        return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def incrby(self, key, amount):
+        item = self._alive(key)
+        value = int(item[0]) + amount if item else amount
+        self.data[key] = (str(value).encode(), item[1] if item else None)
+        return value
+
+    def pexpire(self, key, px):
+        if self._alive(key):
+            self.data[key] = (self.data[key][0], time.time() + px / 1000)
+
+    def scan_iter(self, match):
+        prefix = match.rstrip('*')
+        return [key for key in list(self.data) if key.startswith(prefix)]
+
+
+def test_sqlite_backend_roundtrip_and_expiry(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'cache.db'), max_entries=2)
+    now = time.time()
+    backend.set('weather:a', CacheEntry({'temp': 30, 'city': 'กรุงเทพ'}, now + 60, now + 120))
+    assert backend.get('weather:a') == CacheEntry({'temp': 30, 'city': 'กรุงเทพ'}, now + 60, now + 120)
+
+    backend.set('weather:old', CacheEntry(1, now - 20, now - 10))
+    assert backend.get('weather:old') is None
+
+    backend.set('weather:b', CacheEntry(2, now + 60, now + 120))
+    backend.set('weather:c', CacheEntry(3, now + 60, now + 120))
+    assert backend.stats()['size'] == 2
+
+    backend.clear('weather:')
+    assert backend.stats()['size'] == 0
+
+
+def test_sqlite_backend_batches_its_bookkeeping_writes(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'cache.db'), max_entries=20)
+    now = time.time()
+    for i in range(21):
+        backend.set(f'weather:{i}', CacheEntry(i, now + 60, now + 120))
+    # The size is checked every other insert here (max_entries // 10), so one extra row may linger.
+    assert backend.stats()['size'] == 21
+    backend.set('weather:21', CacheEntry(21, now + 60, now + 120))
+    assert backend.stats() == {'backend': 'sqlite', 'size': 20, 'evictions': 2}
+
+    accessed = lambda: backend._connect().execute(
+        "SELECT accessed FROM cache_entries WHERE key = 'weather:21'").fetchone()[0]
+    before = accessed()
+    assert backend.get('weather:21').value == 21
+    assert accessed() == before
+    backend.touch_interval = 0
+    backend.get('weather:21')
+    assert accessed() > before
+
+
+def test_sqlite_lock_is_exclusive_across_connections(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    worker_a, worker_b = SQLiteBackend(path), SQLiteBackend(path)
+
+    token = worker_a.acquire_lock('weather:k', timeout=5)
+    assert token is not None
+    assert worker_b.acquire_lock('weather:k', timeout=5) is None
+    worker_a.release_lock('weather:k', token)
+    assert worker_b.acquire_lock('weather:k', timeout=5) is not None
+
+
+def test_shared_backend_lets_one_worker_refresh(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    worker_a = TTLCache('weather', ttl=60, backend=SQLiteBackend(path))
+    worker_b = TTLCache('weather', ttl=60, backend=SQLiteBackend(path), poll_interval=0.01)
+    calls = []
+    started = threading.Event()
+
+    def slow_loader():
+        calls.append('a')
+        started.set()
+        time.sleep(0.2)
+        return {'temp': 31}
+
+    thread = threading.Thread(target=worker_a.get_or_load, args=('city:bangkok', slow_loader))
+    thread.start()
+    started.wait(1)
+    value = worker_b.get_or_load('city:bangkok', lambda: calls.append('b'))
+    thread.join()
+
+    assert value == {'temp': 31}
+    assert calls == ['a']
+    assert worker_b.stats()['peer_loads'] == 1
+
+
+def test_waiting_worker_loads_as_soon_as_the_lock_holder_fails(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    worker_a = TTLCache('weather', ttl=60, backend=SQLiteBackend(path), lock_timeout=30)
+    worker_b = TTLCache('weather', ttl=60, backend=SQLiteBackend(path), lock_timeout=30, poll_interval=0.01)
+    started = threading.Event()
+
+    def failing_loader():
+        started.set()
+        time.sleep(0.1)
+        raise ValueError("upstream down")
+
+    thread = threading.Thread(target=lambda: pytest.raises(ValueError, worker_a.get_or_load, 'k', failing_loader))
+    thread.start()
+    started.wait(1)
+    began = time.monotonic()
+    assert worker_b.get_or_load('k', lambda: {'temp': 31}) == {'temp': 31}
+    thread.join()
+    # Worker B took the released lock instead of waiting out lock_timeout.
+    assert time.monotonic() - began < 5
+    assert worker_b.stats()['loads'] == 1
+
+
+@pytest.mark.parametrize('make_backend', [
+    lambda tmp_path: MemoryBackend(),
+    lambda tmp_path: SQLiteBackend(str(tmp_path / 'cache.db')),
+    lambda tmp_path: RedisBackend(FakeRedis()),
+], ids=['memory', 'sqlite', 'redis'])
+def test_counters_add_up_expire_and_clear(make_backend, tmp_path):
+    backend = make_backend(tmp_path)
+    assert backend.incr('budget:a:minute:1', 1, ttl=60) == 1
+    assert backend.incr('budget:a:minute:1', 2, ttl=60) == 3
+    assert backend.incr('budget:a:minute:1', -1, ttl=60) == 2
+    assert backend.counter('budget:a:minute:1') == 2
+    assert backend.counter('budget:a:minute:2') == 0
+
+    assert backend.incr('budget:b:minute:1', 5, ttl=0.05) == 5
+    time.sleep(0.1)
+    assert backend.counter('budget:b:minute:1') == 0
+    assert backend.incr('budget:b:minute:1', 1, ttl=0.05) == 1
+
+    backend.clear('budget:a:')
+    assert backend.counter('budget:a:minute:1') == 0
+
+
+def test_memory_counters_drop_past_windows():
+    backend = MemoryBackend()
+    backend.incr('budget:a:minute:1', 1, ttl=0.05)
+    time.sleep(0.1)
+    backend.incr('budget:a:minute:2', 1, ttl=0.05)
+    assert list(backend._counters) == ['budget:a:minute:2']
+
+
+def test_ttl_scale_stretches_new_entries():
+    clock = FakeClock()
+    scale = [1.0]
+    cache = TTLCache('test', ttl=10, stale_ttl=5, clock=clock, ttl_scale=lambda: scale[0])
+    cache.set('a', 1)
+    assert cache.fresh_for('a') == 10
+    scale[0] = 3.0
+    cache.set('b', 2)
+    assert cache.fresh_for('b') == 30
+    clock.now += 40
+    assert cache.get_or_load('b', lambda: pytest.fail("should be served stale")) == 2
+    assert cache.stats()['ttl_scale'] == 3.0
+
+
+def test_redis_backend_against_stand_in():
+    client = FakeRedis()
+    cache = TTLCache('forecast', ttl=60, backend=RedisBackend(client))
+    assert cache.get_or_load('city:bangkok', lambda: [{'temp_min': 25}]) == [{'temp_min': 25}]
+    assert cache.get_or_load('city:bangkok', lambda: pytest.fail("should be cached")) == [{'temp_min': 25}]
+
+    backend = cache.backend
+    token = backend.acquire_lock('forecast:city:bangkok', timeout=5)
+    assert backend.acquire_lock('forecast:city:bangkok', timeout=5) is None
+    backend.release_lock('forecast:city:bangkok', token)
+    assert backend.acquire_lock('forecast:city:bangkok', timeout=5) is not None
+
+    cache.clear()
+    assert cache.peek('city:bangkok') is None
+
+
+def test_async_concurrent_misses_share_one_load():
+    cache = TTLCache('test', ttl=10)
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'value'
+
+    async def run():
+        return await asyncio.gather(*(cache.get_or_load_async('k', loader) for _ in range(8)))
+
+    assert asyncio.run(run()) == ['value'] * 8
+    assert len(calls) == 1
+    assert cache.stats()['coalesced'] == 7
+    assert cache.peek('k') == 'value'
+
+
+def test_async_stale_value_is_served_while_refreshing():
+    clock = FakeClock()
+    cache = TTLCache('test', ttl=10, stale_ttl=30, clock=clock)
+    cache.set('k', 'old')
+    clock.now += 15
+
+    async def loader():
+        return 'new'
+
+    async def run():
+        stale = await cache.get_or_load_async('k', loader)
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        return stale, await cache.get_or_load_async('k', loader)
+
+    assert asyncio.run(run()) == ('old', 'new')
+
+
+def test_stream_followers_replay_the_leaders_parts():
+    flights = StreamFlights()
+    flight, leader = flights.join('k')
+    assert leader
+    flight.append('a')
+    follower, leader = flights.join('k')
+    assert follower is flight and not leader
+
+    def produce():
+        time.sleep(0.02)
+        flight.append('b')
+        flights.finish('k', flight)
+
+    threading.Thread(target=produce).start()
+
+    async def follow_async():
+        return [part async for part in flight.follow_async(1)]
+
+    assert list(flight.follow(1)) == ['a', 'b']
+    assert asyncio.run(follow_async()) == ['a', 'b']
+    # The key is free again once the leader finished.
+    assert flights.join('k')[1]
+
+
+def test_stream_followers_see_the_leaders_error_or_time_out():
+    flights = StreamFlights()
+    flight, _ = flights.join('k')
+    with pytest.raises(TimeoutError):
+        list(flight.follow(0.01))
+    with pytest.raises(TimeoutError):
+        asyncio.run(flight.follow_async(0.01).__anext__())
+
+    flights.finish('k', flight, ValueError('boom'))
+    with pytest.raises(ValueError):
+        list(flight.follow(1))
@@ -0,0 +1,98 @@
+import sqlite3
+import threading
+
+import pytest
+
+from favorites_store import FavoritesStore
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_store(tmp_path, **kw):
+    return FavoritesStore(str(tmp_path / 'favorites.db'), **kw)
+
+
+def test_add_list_remove(tmp_path):
+    store = make_store(tmp_path)
+    assert store.add('Bangkok') is True
+    assert store.add('Bangkok') is False
+    assert store.add('Tokyo') is True
+    assert store.list() == ['Bangkok', 'Tokyo']
+    assert store.remove('Bangkok') is True
+    assert store.remove('Bangkok') is False
+    assert store.list() == ['Tokyo']
+
+
+def test_uses_wal_journal(tmp_path):
+    store = make_store(tmp_path)
+    assert store._connect().execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_list_is_cached_until_write_or_ttl(tmp_path):
+    clock = FakeClock()
+    store = make_store(tmp_path, cache_ttl=5, clock=clock)
+    other = make_store(tmp_path)  # stands in for another worker process
+    store.add('Bangkok')
+    assert store.list() == ['Bangkok']
+
+    other.add('Tokyo')
+    assert store.list() == ['Bangkok']  # served from memory
+    clock.now = 6
+    assert store.list() == ['Bangkok', 'Tokyo']
+
+    store.add('Paris')  # own writes invalidate immediately
+    assert store.list() == ['Bangkok', 'Tokyo', 'Paris']
+
+
+def test_bulk_operations_are_single_transactions(tmp_path):
+    store = make_store(tmp_path)
+    store.add('Bangkok')
+    assert store.add_many(['Tokyo', 'Bangkok', 'Tokyo', 'Paris']) == (['Tokyo', 'Paris'], ['Bangkok'])
+    assert store.remove_many(['Tokyo', 'London']) == ['Tokyo']
+    assert store.list() == ['Bangkok', 'Paris']
+
+
+def test_failed_bulk_add_rolls_back(tmp_path):
+    store = make_store(tmp_path)
+    with pytest.raises(sqlite3.Error):
+        store.add_many(['Tokyo', object()])  # unbindable value fails mid-transaction
+    assert store.list() == []
+
+
+def test_concurrent_writers_do_not_lock(tmp_path):
+    store = make_store(tmp_path)
+    errors = []
+
+    def write(n):
+        try:
+            for i in range(20):
+                store.add(f'city-{n}-{i}')
+                if i % 2:
+                    store.remove(f'city-{n}-{i}')
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert len(store.list()) == 8 * 10
+
+
+def test_forked_child_opens_its_own_connection(tmp_path, monkeypatch):
+    import favorites_store
+
+    store = make_store(tmp_path)
+    store.add('Paris')
+    parent_conn = store._connect()
+    monkeypatch.setattr(favorites_store.os, 'getpid', lambda: -1)
+    assert store._connect() is not parent_conn
+    assert store.list() == ['Paris']
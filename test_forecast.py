@@ -0,0 +1,71 @@
+import pytest
+
+import forecast
+from forecast import aggregate_daily, aggregate_many
+
+BANGKOK = 7 * 3600
+
+
+def entry(dt, temp_min, temp_max, condition, icon, temp=None, **extra):
+    main = {'temp_min': temp_min, 'temp_max': temp_max}
+    if temp is not None:
+        main['temp'] = temp
+    return dict({'dt': dt, 'main': main, 'weather': [{'main': condition, 'icon': icon}]}, **extra)
+
+
+def sample_items(count=40):
+    start = 1704067200  # 2024-01-01 00:00 UTC
+    conditions = ['Clear', 'Clouds', 'Rain', 'Clouds', 'Rain']
+    items = []
+    for i in range(count):
+        extra = {'rain': {'3h': 0.5}} if i % 3 == 0 else {}
+        items.append(entry(start + i * 10800, 20 + i % 8, 26 + i % 5, conditions[i % 5], f"0{i % 4 + 1}d",
+                           temp=23 + i % 6, pop=(i % 10) / 10, **extra))
+    return items
+
+
+def test_days_are_bucketed_in_city_local_time():
+    items = [
+        entry(1704124800, 20, 25, 'Clear', '01n', temp=22),   # 2024-01-01 16:00 UTC = 23:00 Bangkok
+        entry(1704135600, 18, 24, 'Clouds', '02n', temp=21),  # 19:00 UTC = 02:00 Jan 02 in Bangkok
+    ]
+    utc = aggregate_daily(items)
+    local = aggregate_daily(items, BANGKOK)
+    assert [day['date'] for day in utc] == ['Mon, Jan 01']
+    assert [day['date'] for day in local] == ['Mon, Jan 01', 'Tue, Jan 02']
+    assert local[1]['hourly'] == [{'time': '02:00', 'temp': 21, 'icon': '02n'}]
+
+
+def test_daily_summary_fields():
+    items = [
+        entry(1704088800, 20.4, 25.6, 'Clouds', '03d', temp=22, rain={'3h': 1.25}, pop=0.2),  # 06:00 UTC
+        entry(1704110400, 18.0, 27.3, 'Rain', '10d', temp=26, rain={'3h': 2.0}, snow={'3h': 0.1}, pop=0.9),
+        entry(1704121200, 19.0, 24.0, 'Rain', '09d', temp=24),
+    ]
+    [day] = aggregate_daily(items)
+    assert day == {
+        'date': 'Mon, Jan 01', 'temp_min': 18, 'temp_max': 27, 'temp_mean': 24.0,
+        'description': 'Rain', 'icon': '10d', 'precipitation': 3.4, 'pop': 90,
+        'hourly': [{'time': '06:00', 'temp': 22, 'icon': '03d'},
+                   {'time': '12:00', 'temp': 26, 'icon': '10d'},
+                   {'time': '15:00', 'temp': 24, 'icon': '09d'}],
+    }
+
+
+def test_icon_falls_back_to_first_entry_without_midday():
+    items = [entry(1704067200, 20, 25, 'Clear', '01n'), entry(1704078000, 20, 25, 'Clear', '02n')]
+    assert aggregate_daily(items)[0]['icon'] == '01n'
+
+
+def test_limits_number_of_days():
+    assert len(aggregate_daily(sample_items(), days=3)) == 3
+
+
+@pytest.mark.parametrize('use_numpy', [False, True])
+def test_aggregate_many_matches_single_city(monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(forecast, 'np', None)
+    cities = [(sample_items(), BANGKOK), (sample_items()[5:], -5 * 3600), ([], 0)]
+    assert aggregate_many(cities) == [aggregate_daily(items, offset) for items, offset in cities]
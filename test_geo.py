@@ -0,0 +1,50 @@
+import pytest
+
+from geo import Gazetteer, GeoGrid, distance_m, geohash_bounds, geohash_encode
+
+
+def test_geohash_matches_reference_value():
+    assert geohash_encode(57.64911, 10.40744, 11) == 'u4pruydqqvj'
+    lat_min, lat_max, lon_min, lon_max = geohash_bounds('u4pruydqqvj')
+    assert lat_min <= 57.64911 <= lat_max and lon_min <= 10.40744 <= lon_max
+
+
+def test_snap_is_shared_within_a_cell_and_bounded_by_error_radius():
+    grid = GeoGrid(6)
+    key, center = grid.snap('13.7563', '100.5018')
+    assert grid.snap(13.7566, 100.5022) == (key, center)
+    assert key.startswith('geo:') and len(key) == 10
+    assert distance_m(13.7563, 100.5018, center['lat'], center['lon']) <= grid.max_error_m(13.75)
+
+    stats = grid.stats()
+    assert stats['max_error_m'] == 684  # ~1.2 km x 0.6 km cells
+    assert stats['snapped'] == 2
+    assert 0 < stats['mean_error_m'] <= stats['max_observed_error_m'] <= stats['max_error_m']
+
+
+def test_coarser_precision_widens_cells():
+    assert GeoGrid(5).max_error_m() > GeoGrid(6).max_error_m() > GeoGrid(7).max_error_m()
+
+
+@pytest.mark.parametrize('lat, lon', [('abc', '1'), (91, 0), (0, 181)])
+def test_snap_rejects_invalid_coordinates(lat, lon):
+    with pytest.raises(ValueError):
+        GeoGrid(6).snap(lat, lon)
+
+
+def test_gazetteer_lookup_by_name_alias_and_country():
+    gazetteer = Gazetteer([
+        {'name': 'Bangkok', 'lat': 13.7563, 'lon': 100.5018, 'country': 'TH', 'aliases': ['กรุงเทพ']},
+    ])
+    assert gazetteer.lookup('  bangKOK ')['lat'] == 13.7563
+    assert gazetteer.lookup('กรุงเทพ')['name'] == 'Bangkok'
+    assert gazetteer.lookup('Bangkok, th')['country'] == 'TH'
+    assert gazetteer.lookup('Bangkok, US') is None
+    assert gazetteer.lookup('Atlantis') is None
+    assert gazetteer.stats() == {'names': 2, 'hits': 3, 'misses': 2, 'hit_ratio': 0.6}
+
+
+def test_bundled_gazetteer_loads():
+    gazetteer = Gazetteer.from_file()
+    assert gazetteer.lookup('Chiang Mai', record=False)['country'] == 'TH'
+    assert gazetteer.stats()['hits'] == 0
@@ -0,0 +1,116 @@
+import math
+
+import pytest
+
+from history import HistoryStore, decode_chunk, encode_chunk
+
+HOUR = 3600
+DAY = 86400
+T0 = 1704067200  # 2024-01-01 00:00 UTC
+
+
+@pytest.fixture
+def store(tmp_path):
+    return HistoryStore(str(tmp_path / 'history.db'), batch_size=100)
+
+
+def test_chunk_encoding_roundtrip():
+    rows = [(T0, {'temperature': 30.5, 'aqi': 2}), (T0 + 600, {'temperature': 31.0})]
+    timestamps, columns = decode_chunk(encode_chunk(rows, ('temperature', 'aqi')), 2, ['temperature', 'aqi'])
+    assert list(timestamps) == [T0, T0 + 600]
+    assert list(columns['temperature']) == [30.5, 31.0]
+    assert columns['aqi'][0] == 2 and math.isnan(columns['aqi'][1])
+
+
+def test_writes_are_batched(store):
+    store.batch_size = 3
+    for i in range(2):
+        store.record('weather', 13.75, 100.5, T0 + i * 600, {'temperature': 30 + i})
+    assert store.stats['flushes'] == 0
+    store.record('weather', 13.75, 100.5, T0 + 1200, {'temperature': 32})
+    assert store.stats['flushes'] == 1
+    rows = store._connect().execute('SELECT day, count FROM history_chunks').fetchall()
+    assert rows == [(T0 // DAY, 3)]
+
+
+def test_flushes_merge_into_one_chunk_per_day(store):
+    for i in range(3):
+        store.record('weather', 13.75, 100.5, T0 + i * HOUR, {'temperature': 30 + i})
+        store.record('air_quality', 13.75, 100.5, T0 + i * HOUR, {'aqi': i + 1})
+        store.flush()
+    store.record('weather', 13.75, 100.5, T0 + DAY, {'temperature': 25})
+    store.flush()
+
+    rows = store._connect().execute('SELECT day, count FROM history_chunks ORDER BY day').fetchall()
+    assert rows == [(T0 // DAY, 6), (T0 // DAY + 1, 1)]
+    points = store.query('coord:13.8,100.5', T0, T0 + DAY, 'raw')
+    assert [(point['t'], point['temperature'], point['aqi']) for point in points[:3]] == [
+        (T0, 30.0, 1.0), (T0 + HOUR, 31.0, 2.0), (T0 + 2 * HOUR, 32.0, 3.0)]
+    assert points[3] == {'t': T0 + DAY, 'temperature': 25.0}
+
+
+def test_rollups_merge_across_flushes(store):
+    store.record('weather', 13.75, 100.5, T0 + 600, {'temperature': 30, 'humidity': 60})
+    store.flush()
+    store.record('weather', 13.75, 100.5, T0 + 1800, {'temperature': 34})
+    store.record('weather', 13.75, 100.5, T0 + 2 * HOUR, {'temperature': 28})
+    store.flush()
+    location = 'coord:13.8,100.5'
+
+    hourly = store.query(location, T0, T0 + DAY, 'hour')
+    assert [point['t'] for point in hourly] == [T0, T0 + 2 * HOUR]
+    assert hourly[0]['temperature'] == {'avg': 32.0, 'min': 30.0, 'max': 34.0, 'count': 2}
+    assert hourly[0]['humidity']['count'] == 1
+
+    daily = store.query(location, T0, T0 + DAY, 'day')
+    assert daily == [{'t': T0, 'temperature': {'avg': 30.67, 'min': 28.0, 'max': 34.0, 'count': 3},
+                      'humidity': {'avg': 60.0, 'min': 60.0, 'max': 60.0, 'count': 1}}]
+
+
+def test_raw_query_spans_day_partitions(store):
+    for i in range(4):
+        store.record('air_quality', 13.75, 100.5, T0 + i * 12 * HOUR, {'aqi': i + 1, 'pm2_5': 10.0 * i})
+    store.flush()
+    points = store.query('coord:13.8,100.5', T0 + HOUR, T0 + 2 * DAY, 'raw')
+    assert [(point['t'], point['aqi']) for point in points] == [(T0 + 12 * HOUR, 2), (T0 + DAY, 3), (T0 + 36 * HOUR, 4)]
+
+
+def test_repeated_observations_are_recorded_once(store):
+    assert store.record('weather', 13.75, 100.5, T0, {'temperature': 30}) is True
+    assert store.record('weather', 13.751, 100.502, T0, {'temperature': 30}) is False
+    assert store.record('air_quality', 13.75, 100.5, T0, {'aqi': 2}) is True
+    assert store.stats['duplicates'] == 1
+
+
+def test_workers_sharing_a_file_store_an_observation_once(store):
+    other_worker = HistoryStore(store.path)
+    for worker in (store, other_worker):
+        worker.record('weather', 13.75, 100.5, T0, {'temperature': 30})
+        worker.record('weather', 13.75, 100.5, T0 + HOUR, {'temperature': 32})
+    assert store.flush() == 2
+    other_worker.record('weather', 13.75, 100.5, T0 + 2 * HOUR, {'temperature': 34})
+    assert other_worker.flush() == 1
+    assert other_worker.stats['duplicates'] == 2
+
+    [day] = store.query('coord:13.8,100.5', T0, T0 + DAY, 'day')
+    assert day['temperature'] == {'avg': 32.0, 'min': 30.0, 'max': 34.0, 'count': 3}
+    assert len(store.query('coord:13.8,100.5', T0, T0 + DAY, 'raw')) == 3
+
+
+def test_queries_do_not_flush(store):
+    store.record('weather', 13.75, 100.5, T0, {'temperature': 30})
+    assert store.query('coord:13.8,100.5', T0, T0 + DAY, 'raw') == []
+    assert store.find_location('Bangkok') is None
+    assert store.stats['flushes'] == 0
+
+
+def test_weather_and_air_quality_share_a_location(store):
+    store.record_weather({'name': 'Bangkok', 'dt': T0, 'coord': {'lat': 13.7563, 'lon': 100.5018},
+                          'main': {'temp': 31.2, 'humidity': 60}, 'wind': {'speed': 2.5}})
+    store.record_air_quality({'lat': '13.75', 'lon': '100.49'},
+                             {'list': [{'dt': T0, 'main': {'aqi': 3}, 'components': {'pm2_5': 35.4}}]})
+    store.flush()
+    location = store.find_location('BANGKOK')
+    assert location == 'coord:13.8,100.5'
+    [point] = store.query(location, T0, T0, 'raw')
+    assert point == {'t': T0, 'temperature': 31.2, 'humidity': 60.0, 'wind_speed': 9.0, 'aqi': 3.0, 'pm2_5': 35.4}
@@ -0,0 +1,55 @@
+import gzip
+
+import http_cache
+
+BODY = b'{"city": "Bangkok", "temperature": 30.2}' * 40
+
+
+def test_negotiate_prefers_available_encodings_and_honours_q_values():
+    assert http_cache.negotiate(None) is None
+    assert http_cache.negotiate('gzip, deflate') == 'gzip'
+    assert http_cache.negotiate('gzip;q=0, identity') is None
+    assert http_cache.negotiate('*') == ('br' if http_cache.brotli else 'gzip')
+    assert http_cache.negotiate('br') == ('br' if http_cache.brotli else None)
+
+
+def test_matches_ignores_weak_prefix_and_encoding_suffix():
+    etag = http_cache.etag_for(BODY)
+    assert http_cache.matches(etag, etag)
+    assert http_cache.matches(f'"other", W/{etag[:-1]}-gzip"', etag)
+    assert http_cache.matches('*', etag)
+    assert not http_cache.matches('"other"', etag)
+    assert not http_cache.matches(None, etag)
+
+
+def test_finalize_compresses_and_answers_revalidation_with_304():
+    status, body, headers = http_cache.finalize('GET', 200, 'application/json', BODY, {}, accept_encoding='gzip')
+    assert status == 200
+    assert gzip.decompress(body) == BODY
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Cache-Control'] == 'no-cache'
+    assert headers['ETag'] == http_cache.etag_for(BODY)[:-1] + '-gzip"'
+
+    status, body, headers = http_cache.finalize('GET', 200, 'application/json', BODY, {'Cache-Control': 'max-age=60'},
+                                                if_none_match=headers['ETag'])
+    assert (status, body) == (304, b'')
+    assert 'Cache-Control' not in headers
+
+
+def test_finalize_leaves_small_binary_and_error_responses_uncompressed():
+    assert http_cache.finalize('GET', 200, 'application/json', b'{}', {}, accept_encoding='gzip')[2].get(
+        'Content-Encoding') is None
+    assert http_cache.finalize('GET', 200, 'image/jpeg', BODY, {}, accept_encoding='gzip')[2].get(
+        'Content-Encoding') is None
+    assert http_cache.finalize('GET', 404, 'application/json', BODY, {}, accept_encoding='gzip') == (404, BODY, {})
+    assert http_cache.finalize('POST', 200, 'application/json', BODY, {}, accept_encoding='gzip') == (200, BODY, {})
+
+
+def test_fingerprint_follows_file_content(tmp_path):
+    path = tmp_path / 'app.css'
+    path.write_text('body { color: red; }')
+    first = http_cache.fingerprint(str(path))
+    assert first == http_cache.fingerprint(str(path))
+    path.write_text('body { color: blue; }')
+    assert http_cache.fingerprint(str(path)) != first
+    assert http_cache.fingerprint(str(tmp_path / 'missing.css')) is None
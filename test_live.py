@@ -0,0 +1,96 @@
+import threading
+
+from live import LiveHub, diff, merge
+
+
+def test_diff_keeps_only_changed_fields():
+    old = {'weather': {'temperature': 30, 'humidity': 70, 'city': 'Bangkok'}, 'errors': {}}
+    new = {'weather': {'temperature': 31, 'humidity': 70, 'city': 'Bangkok'}, 'errors': {}, 'air_quality': {'aqi': 2}}
+    assert diff(old, new) == {'weather': {'temperature': 31}, 'air_quality': {'aqi': 2}}
+    assert diff(new, old) == {'weather': {'temperature': 30}, 'air_quality': None}
+    assert diff(old, old) == {}
+
+
+def test_merge_applies_diffs_in_order():
+    first = {'weather': {'temperature': 30, 'humidity': 70}}
+    second = {'weather': {'temperature': 31, 'humidity': 70}}
+    third = {'weather': {'temperature': 31, 'humidity': 65}}
+    pending = merge(diff(first, second), diff(second, third))
+    assert pending == {'weather': {'temperature': 31, 'humidity': 65}}
+    assert merge(first, pending) == third
+
+
+class SteppedLoad:
+    """Returns the next reading each time the poller loads, and lets the test wait for loads."""
+
+    def __init__(self, readings):
+        self.readings = list(readings)
+        self.calls = 0
+        self.loaded = threading.Semaphore(0)
+
+    def __call__(self, location):
+        reading = self.readings[min(self.calls, len(self.readings) - 1)]
+        self.calls += 1
+        self.loaded.release()
+        return reading
+
+
+def test_one_poller_fans_out_changes_to_every_subscriber():
+    load = SteppedLoad([{'temperature': 30, 'aqi': 2}, {'temperature': 31, 'aqi': 2}])
+    hub = LiveHub(load, interval=3600)
+    subscriptions = [hub.subscribe('geo:w4rqqb', {'lat': 13.75, 'lon': 100.5}) for _ in range(5)]
+    assert load.loaded.acquire(timeout=5)
+    for subscription in subscriptions:
+        assert subscription.wait(5) == {'temperature': 30, 'aqi': 2}
+    assert load.calls == 1
+    assert hub.locations() == {'geo:w4rqqb': 5}
+
+    # A late subscriber starts from the latest snapshot without another load.
+    late = hub.subscribe('geo:w4rqqb', {'lat': 13.75, 'lon': 100.5})
+    assert late.poll() == {'temperature': 30, 'aqi': 2}
+    assert load.calls == 1
+
+    for subscription in subscriptions + [late]:
+        subscription.close()
+    assert hub.locations() == {}
+
+
+def test_slow_subscriber_gets_changes_merged_and_poller_stops_with_last_subscriber():
+    load = SteppedLoad([{'temperature': 30, 'aqi': 2}, {'temperature': 31, 'aqi': 2}, {'temperature': 31, 'aqi': 4}])
+    hub = LiveHub(load, interval=0.01)
+    subscription = hub.subscribe('geo:w4rqqb', {})
+    for _ in range(3):
+        assert load.loaded.acquire(timeout=5)
+    assert load.loaded.acquire(timeout=5)
+    assert subscription.poll() == {'temperature': 31, 'aqi': 4}
+    assert hub.stats['updates'] == 3
+
+    subscription.close()
+    calls = load.calls
+    threading.Event().wait(0.1)
+    assert load.calls <= calls + 1
+
+
+def test_subscribe_refuses_new_locations_beyond_the_limit():
+    hub = LiveHub(lambda location: {}, interval=3600, max_locations=1)
+    assert hub.has_room('b')
+    first = hub.subscribe('a', {})
+    assert hub.has_room('a') and not hub.has_room('b')
+    assert hub.subscribe('b', {}) is None
+    second = hub.subscribe('a', {})
+    assert second is not None
+    first.close()
+    second.close()
+    assert hub.subscribe('b', {}) is not None
+    hub.stop()
+
+
+def test_load_errors_are_counted_and_not_pushed():
+    def load(location):
+        raise RuntimeError('upstream down')
+
+    hub = LiveHub(load, interval=3600)
+    subscription = hub.subscribe('a', {})
+    assert subscription.wait(0.2) is None
+    assert hub.stats['errors'] == 1
+    subscription.close()
@@ -1,13 +1,120 @@
 import pytest
+import main
+import asgi
 from main import app, get_aqi_description, get_wind_direction
+import asyncio
+import gzip
 import json
+import os
+import subprocess
 import sys
+import threading
+import time
+from flask import url_for
+from werkzeug.wrappers import Response
+import http_cache
+from favorites_store import FavoritesStore
+from cache import StreamFlights
+from history import HistoryStore
+from geo import GeoGrid, Gazetteer
+from live import LiveHub
+from ratelimit import RateLimiter, UpstreamBudget
+from urllib.parse import quote
+from benchmarks.fake_upstream import FakeUpstream
 
-@pytest.fixture
-def client():
+
+class ASGITestClient:
+    """Drives asgi.app with the same call style as Flask's test client."""
+
+    def __init__(self, loop):
+        self._client = asgi.app.test_client()
+        self._loop = loop
+
+    def _request(self, method, path, json=None, headers=None):
+        async def call():
+            response = await self._client.open(path, method=method, json=json, headers=headers)
+            return Response(await response.get_data(), status=response.status_code, headers=list(response.headers.items()))
+        return self._loop.run_until_complete(call())
+
+    def get(self, path, headers=None):
+        return self._request('GET', path, headers=headers)
+
+    def post(self, path, json=None):
+        return self._request('POST', path, json=json)
+
+    def delete(self, path, json=None):
+        return self._request('DELETE', path, json=json)
+
+
+@pytest.fixture(params=['wsgi', 'asgi'])
+def client(request, monkeypatch, tmp_path):
     app.config['TESTING'] = True
-    with app.test_client() as client:
-        yield client
+    monkeypatch.setattr(main, 'favorites_store', FavoritesStore(str(tmp_path / 'favorites.db')))
+    monkeypatch.setattr(main, 'history_store', HistoryStore(str(tmp_path / 'history.db')))
+    monkeypatch.setattr(main, 'geo_grid', GeoGrid(main.geo_grid.precision))
+    monkeypatch.setattr(main, 'gazetteer', Gazetteer.from_file())
+    for cache in main.CACHES:
+        cache.clear()
+    main.rate_limiter.reset()
+    for budget in main.upstream_budgets.values():
+        budget.reset()
+    if request.param == 'wsgi':
+        with app.test_client() as client:
+            yield client
+    else:
+        asgi.app.config['TESTING'] = True
+        loop = asyncio.new_event_loop()
+        yield ASGITestClient(loop)
+        loop.run_until_complete(asgi.openweather_async.aclose())
+        loop.close()
+
+
+@pytest.fixture
+def fake_openweather(monkeypatch):
+    """Point the OpenWeather URLs at a local stand-in that checks the API key like the real service."""
+    with FakeUpstream() as fake:
+        for name, path in [('WEATHER_API_URL', '/data/2.5/weather'), ('FORECAST_API_URL', '/data/2.5/forecast'),
+                           ('AIR_QUALITY_API_URL', '/data/2.5/air_pollution'), ('GEOCODING_API_URL', '/geo/1.0/direct')]:
+            monkeypatch.setattr(main, name, fake.url + path)
+        monkeypatch.setattr(main, 'API_KEY', 'test-key')
+        yield fake
+
+
+def patch_upstream(monkeypatch, fake_get):
+    """Send both the sync session and the async client to ``fake_get``."""
+    monkeypatch.setattr(main.openweather.session, 'get', fake_get)
+
+    async def fake_send(url, params):
+        return fake_get(url, params=params)
+
+    monkeypatch.setattr(asgi.openweather_async, '_send', fake_send)
+
+
+class StubResponse:
+    def __init__(self, payload, status_code=200):
+        self.payload = payload
+        self.status_code = status_code
+
+    def json(self):
+        return self.payload
+
+
+def serve_payloads(monkeypatch, payloads, status=None):
+    """Answer upstream GETs with ``payloads[url]`` (404 for other URLs); returns the (url, params) calls made.
+
+    ``status(url, params)``, if given, picks the status code of each response.
+    """
+    calls = []
+
+    def fake_get(url, params=None, **kwargs):
+        calls.append((url, params))
+        if url not in payloads:
+            return StubResponse({}, 404)
+        return StubResponse(payloads[url], status(url, params) if status else 200)
+
+    monkeypatch.setattr('main.API_KEY', 'test-key')
+    patch_upstream(monkeypatch, fake_get)
+    return calls
 
 def test_index(client):
     response = client.get('/')
@@ -38,15 +145,130 @@ def test_favorites_get(client):
     assert response.is_json
     assert isinstance(response.get_json(), list)
 
-def test_weather_api_key_valid(client):
+def test_weather_api_key_valid(client, fake_openweather):
     response = client.get('/weather?city=Bangkok')
-    # If API key is valid, should not get 401
-    assert response.status_code != 401
-    # If API key is invalid, error message should be present
-    if response.status_code == 200:
-        assert "city" in response.get_json()
-    else:
-        assert "error" in response.get_json()
+    assert response.status_code == 200
+    assert response.get_json()["city"] == "Bangkok"
+    assert fake_openweather.stats()['/data/2.5/weather'] == 1
+
+
+def test_weather_api_key_invalid(client, fake_openweather, monkeypatch):
+    monkeypatch.setattr(main, 'API_KEY', 'invalid')
+    response = client.get('/weather?city=Bangkok')
+    assert response.status_code == 401
+    assert "API Key" in response.get_json()["error"]
+
+
+def test_conditional_get_and_compression(client, fake_openweather):
+    response = client.get('/forecast?city=Bangkok', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert 0 < response.cache_control.max_age <= main.forecast_cache.ttl
+    forecast = json.loads(gzip.decompress(response.data))
+    assert forecast
+
+    etag = response.headers['ETag']
+    assert etag.endswith('-gzip"')
+    revalidated = client.get('/forecast?city=Bangkok', headers={'If-None-Match': etag})
+    assert revalidated.status_code == 304
+    assert revalidated.data == b''
+    plain = client.get('/forecast?city=Bangkok')
+    assert 'Content-Encoding' not in plain.headers
+    assert plain.get_json() == forecast
+    assert fake_openweather.stats()['/data/2.5/forecast'] == 1
+
+
+def test_static_urls_are_fingerprinted(client):
+    filename = os.listdir(app.static_folder)[0]
+    with app.test_request_context():
+        url = url_for('static', filename=filename)
+    assert '?v=' in url
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == http_cache.IMMUTABLE_MAX_AGE
+    assert not client.get(f'/static/{filename}?v=stale').cache_control.immutable
+
+
+def test_rate_limit_per_client_and_route(client, monkeypatch):
+    monkeypatch.setattr(main, 'rate_limiter', RateLimiter(60, 2))
+    assert client.get('/favorites').status_code == 200
+    assert client.get('/favorites').status_code == 200
+    response = client.get('/favorites')
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+    assert 'Too many requests' in response.get_json()['error']
+    # Other routes have their own bucket.
+    assert client.get('/cache_stats').status_code == 200
+    assert main.RATE_LIMITED.value(route='/favorites') >= 1
+
+
+def test_client_address_honours_trusted_proxy_hops(monkeypatch):
+    assert main.client_address('10.0.0.1', '203.0.113.7') == '10.0.0.1'
+    monkeypatch.setattr(main, 'TRUSTED_PROXY_HOPS', 1)
+    assert main.client_address('10.0.0.1', 'spoofed, 203.0.113.7') == '203.0.113.7'
+    assert main.client_address('10.0.0.1', None) == '10.0.0.1'
+
+
+def test_used_up_budget_serves_cached_data_and_refuses_new_calls(client, fake_openweather, monkeypatch):
+    budget = UpstreamBudget('openweather', per_minute=1)
+    monkeypatch.setattr(main, 'upstream_budgets', dict(main.upstream_budgets, openweather=budget))
+    monkeypatch.setattr(main.weather_cache, 'ttl_scale', budget.ttl_scale)
+
+    response = client.get('/weather?city=Bangkok')
+    assert response.status_code == 200
+    # The last call of the window was stored with the TTL stretched to the maximum.
+    assert response.cache_control.max_age > main.weather_cache.ttl
+    assert client.get('/weather?city=Bangkok').status_code == 200
+
+    response = client.get('/weather?city=Chiang%20Mai')
+    assert response.status_code == 503
+    assert 'budget' in response.get_json()['error']
+    assert fake_openweather.stats()['/data/2.5/weather'] == 1
+    assert budget.calls == {'weather': 1} and budget.rejected == 1
+
+    text = client.get('/metrics').data.decode()
+    assert 'upstream_budget_remaining{upstream="openweather",window="minute"} 0' in text
+    assert 'upstream_budget_rejected_total{upstream="openweather"} 1' in text
+
+
+def test_retries_are_charged_to_the_budget(client, fake_openweather, monkeypatch):
+    budget = UpstreamBudget('openweather', per_minute=2)
+    monkeypatch.setattr(main, 'upstream_budgets', dict(main.upstream_budgets, openweather=budget))
+    monkeypatch.setattr(fake_openweather, 'error_rate', 1.0)
+    monkeypatch.setattr(main.openweather, '_sleep', lambda delay: None)
+    monkeypatch.setattr(asgi.openweather_async, '_sleep', lambda delay: asyncio.sleep(0))
+
+    response = client.get('/weather?city=Bangkok')
+    assert response.status_code == 503
+    # Three attempts were allowed by UPSTREAM_MAX_RETRIES, but the budget only paid for two.
+    assert fake_openweather.stats()['/data/2.5/weather'] == 2
+    assert budget.calls == {'weather': 2} and budget.rejected == 1
+
+
+def test_metrics_and_server_timing(client, fake_openweather):
+    before = main.REQUESTS.value(route='/dashboard', method='GET', status=200)
+    upstream_before = main.UPSTREAM_LATENCY.count(upstream='openweather', endpoint='forecast')
+
+    response = client.get('/dashboard?city=Bangkok')
+    assert response.status_code == 200
+    timing = response.headers['Server-Timing']
+    assert timing.startswith('upstream;desc="3 calls";dur=')
+    assert 'app;dur=' in timing and 'serialize;dur=' in timing and 'total;dur=' in timing
+
+    assert main.REQUESTS.value(route='/dashboard', method='GET', status=200) == before + 1
+    assert main.UPSTREAM_LATENCY.count(upstream='openweather', endpoint='forecast') == upstream_before + 1
+    assert main.IN_FLIGHT.value() == 0
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    text = response.get_data(as_text=True)
+    assert 'http_request_duration_seconds_bucket{route="/dashboard",method="GET",le="+Inf"}' in text
+    assert 'upstream_request_duration_seconds_count{upstream="openweather",endpoint="weather"}' in text
+    assert 'cache_events_total{cache="forecast",event="misses"} 1' in text
+    assert 'cache_hit_ratio{cache="weather"}' in text
 
 
 def test_get_aqi_description_mapping():
@@ -90,21 +312,7 @@ def test_forecast_processing(monkeypatch, client):
         ]
     }
 
-    class DummyResponse:
-        status_code = 200
-        text = json.dumps(sample_data)
-
-        def raise_for_status(self):
-            return None
-
-        def json(self):
-            return sample_data
-
-    def dummy_get(url, params=None, **kwargs):
-        return DummyResponse()
-
-    monkeypatch.setattr('main.API_KEY', 'test-key')
-    monkeypatch.setattr('main.requests.get', dummy_get)
+    serve_payloads(monkeypatch, {main.FORECAST_API_URL: sample_data})
 
     response = client.get('/forecast?city=Bangkok')
     assert response.status_code == 200
@@ -128,12 +336,520 @@ def test_forecast_processing(monkeypatch, client):
     assert second_day["icon"] == "09d"
 
 
+def test_air_quality_is_cached(monkeypatch, client):
+    sample_data = {"list": [{"main": {"aqi": 2}, "components": {"pm2_5": 12.5}}]}
+    calls = serve_payloads(monkeypatch, {main.AIR_QUALITY_API_URL: sample_data})
+
+    first = client.get('/air_quality?lat=13.7563&lon=100.5018')
+    second = client.get('/air_quality?lat=13.7561&lon=100.5021')
+    assert first.status_code == second.status_code == 200
+    assert first.get_json() == second.get_json()
+    assert first.get_json()["description"] == "Fair"
+    assert len(calls) == 1
+
+    stats = client.get('/cache_stats').get_json()
+    assert stats["air_quality"]["misses"] == 1
+    assert stats["air_quality"]["hits"] == 1
+
+
+def test_dashboard_no_params(client):
+    response = client.get('/dashboard')
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+def test_dashboard_fetches_all_sections(monkeypatch, client):
+    payloads = {
+        main.GEOCODING_API_URL: [{"name": "Bangkok", "lat": 13.7563, "lon": 100.5018, "country": "TH"}],
+        main.WEATHER_API_URL: {
+            "name": "Phra Nakhon", "timezone": 25200,
+            "sys": {"sunrise": 1704150000, "sunset": 1704191000},
+            "main": {"temp": 31.2, "feels_like": 35.4, "temp_min": 30.1, "temp_max": 32.8, "humidity": 60},
+            "wind": {"speed": 2.5, "deg": 90},
+            "coord": {"lat": 13.7563, "lon": 100.5018},
+            "weather": [{"description": "few clouds", "icon": "02d"}],
+        },
+        main.FORECAST_API_URL: {"list": [
+            {"dt": 1704110400, "main": {"temp_min": 25.0, "temp_max": 33.0}, "weather": [{"main": "Clouds", "icon": "02d"}]},
+        ]},
+        main.AIR_QUALITY_API_URL: {"list": []},
+    }
+    calls = serve_payloads(monkeypatch, payloads)
+    monkeypatch.setattr(main, 'gazetteer', Gazetteer())  # unknown locally, so the city is geocoded
+
+    response = client.get('/dashboard?city=Bangkok')
+    assert response.status_code == 200
+    dashboard = response.get_json()
+    assert dashboard["location"]["lat"] == 13.7563
+    assert dashboard["weather"]["city"] == "Bangkok"
+    assert dashboard["weather"]["temperature"] == 31
+    assert dashboard["forecast"][0]["description"] == "Clouds"
+    assert dashboard["air_quality"] is None
+    assert dashboard["errors"]["air_quality"]["status"] == 404
+
+    # Everything after geocoding is fetched by the centre of the coordinates' grid cell.
+    _, center = main.geo_grid.snap(13.7563, 100.5018)
+    for url, params in calls:
+        if url != main.GEOCODING_API_URL:
+            assert params["lat"] == center["lat"] and "q" not in params
+    assert len(calls) == 4
+
+    client.get('/dashboard?city=bangkok')
+    assert len(calls) == 5  # only the failed air quality section is retried
+
+
+def test_weather_batch_streams_deduped_results(monkeypatch, client):
+    weather = {
+        "name": "Bangkok", "timezone": 25200,
+        "sys": {"sunrise": 1704150000, "sunset": 1704191000},
+        "main": {"temp": 31.2, "feels_like": 35.4, "temp_min": 30.1, "temp_max": 32.8, "humidity": 60},
+        "wind": {"speed": 2.5, "deg": 90},
+        "coord": {"lat": 13.75, "lon": 100.5},
+        "weather": [{"description": "few clouds", "icon": "02d"}],
+    }
+    calls = serve_payloads(monkeypatch, {main.WEATHER_API_URL: weather},
+                           status=lambda url, params: 404 if params.get('q') == 'Atlantis' else 200)
+    main.weather_cache.set(main.snap_coords(18.7901, 98.9799)[0], {"city": "Chiang Mai"})  # same grid cell
+
+    response = client.post('/weather/batch', json={
+        "cities": ["Bangkok", " bangkok", "Atlantis"],
+        "coords": [{"lat": 18.79, "lon": 98.98}],
+    })
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+
+    assert len(lines) == 3
+    assert lines[0] == {"query": {"lat": 18.79, "lon": 98.98}, "status": 200, "weather": {"city": "Chiang Mai"}}
+    by_query = {line["query"]: line for line in lines[1:]}
+    assert by_query["Bangkok"]["weather"]["temperature"] == 31
+    assert by_query["Atlantis"]["status"] == 500
+    assert len(calls) == 2
+
+
+def test_nearby_coordinates_share_one_upstream_call(monkeypatch, client):
+    calls = serve_payloads(monkeypatch, {
+        main.AIR_QUALITY_API_URL: {"list": [{"main": {"aqi": 2}, "components": {"pm2_5": 12.5}}]}})
+
+    # About 50 m apart, inside the same precision-6 geohash cell.
+    assert client.get('/air_quality?lat=13.7563&lon=100.5018').status_code == 200
+    assert client.get('/air_quality?lat=13.7566&lon=100.5022').status_code == 200
+    assert len(calls) == 1
+    _, params = calls[0]
+    assert (params['lat'], params['lon']) != ('13.7563', '100.5018')
+
+    geo = client.get('/cache_stats').get_json()['geo']
+    assert geo['snapped'] == 2
+    assert 0 < geo['max_observed_error_m'] <= geo['max_error_m']
+    assert client.get('/air_quality?lat=91&lon=0').status_code == 400
+
+
+def test_dashboard_resolves_known_cities_without_geocoding(monkeypatch, client):
+    calls = serve_payloads(monkeypatch, {})
+
+    dashboard = client.get('/dashboard?city=' + quote('กรุงเทพ')).get_json()
+    assert dashboard["location"]["name"] == "Bangkok"
+    assert calls and main.GEOCODING_API_URL not in [url for url, _ in calls]
+    assert client.get('/cache_stats').get_json()['geo']['gazetteer']['hits'] == 1
+
+
+def test_weather_batch_requires_locations(client):
+    response = client.post('/weather/batch', json={"cities": []})
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+def test_weather_batch_accepts_a_bare_list_of_cities(monkeypatch, client):
+    monkeypatch.setattr('main.API_KEY', 'test-key')
+    main.weather_cache.set(main.make_key('Bangkok'), {"city": "Bangkok"})
+    response = client.post('/weather/batch', json=["Bangkok"])
+    assert response.status_code == 200
+    assert [json.loads(line) for line in response.data.decode().splitlines()] == [
+        {"query": "Bangkok", "status": 200, "weather": {"city": "Bangkok"}}]
+
+    response = client.post('/weather/batch', json="Bangkok")
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+def test_fetched_observations_are_queryable_in_history(monkeypatch, client):
+    payloads = {
+        main.WEATHER_API_URL: {
+            "name": "Bangkok", "timezone": 25200, "dt": 1704110400,
+            "sys": {"sunrise": 1704150000, "sunset": 1704191000},
+            "main": {"temp": 31.2, "feels_like": 35.4, "temp_min": 30.1, "temp_max": 32.8, "humidity": 60},
+            "wind": {"speed": 2.5, "deg": 90},
+            "coord": {"lat": 13.7563, "lon": 100.5018},
+            "weather": [{"description": "few clouds", "icon": "02d"}],
+        },
+        main.AIR_QUALITY_API_URL: {"list": [{"dt": 1704111000, "main": {"aqi": 3}, "components": {"pm2_5": 35.4}}]},
+    }
+
+    serve_payloads(monkeypatch, payloads)
+
+    assert client.get('/weather?city=Bangkok').status_code == 200
+    assert client.get('/air_quality?lat=13.75&lon=100.49').status_code == 200
+    main.history_store.flush()  # normally done in the background every HISTORY_FLUSH_INTERVAL
+
+    response = client.get('/history?city=bangkok&from=2024-01-01T12:00:00&to=2024-01-01T13:00:00')
+    assert response.status_code == 200
+    history = response.get_json()
+    assert history["location"] == "coord:13.8,100.5"
+    assert history["resolution"] == "hour"
+    [point] = history["points"]
+    assert point["t"] == 1704110400
+    assert point["temperature"]["avg"] == 31.2
+    assert point["aqi"]["max"] == 3
+
+    raw = client.get('/history?lat=13.76&lon=100.5&from=1704110400&to=1704111000&resolution=raw').get_json()
+    assert [p["t"] for p in raw["points"]] == [1704110400, 1704111000]
+
+
+def test_history_finds_a_city_by_its_coordinates(client):
+    # Air quality readings carry no city name, and the station was recorded under another name.
+    main.history_store.record('air_quality', 18.79, 98.98, 1704110400, {'aqi': 4})
+    main.history_store.record('weather', 18.8, 99.0, 1704110400, {'temperature': 24}, name='Mueang Chiang Mai')
+    main.history_store.flush()
+    response = client.get('/history?city=chiang%20mai&from=1704110000&to=1704111000&resolution=raw')
+    assert response.status_code == 200
+    assert response.get_json()["points"] == [{"t": 1704110400, "aqi": 4.0, "temperature": 24.0}]
+
+    main.geocode_cache.set(main.make_key('Atlantis'), {"name": "Atlantis", "lat": 18.8, "lon": 98.95})
+    assert client.get('/history?city=Atlantis&from=1704110000&to=1704111000').get_json()["location"] == "coord:18.8,99.0"
+
+
+@pytest.mark.parametrize('query, status', [
+    ('', 400),
+    ('?city=Atlantis', 404),
+    ('?city=Bangkok&resolution=minute', 400),
+    ('?city=Bangkok&from=yesterday', 400),
+    ('?lat=1&lon=2&from=200&to=100', 400),
+])
+def test_history_rejects_bad_queries(client, query, status):
+    response = client.get('/history' + query)
+    assert response.status_code == status
+    assert "error" in response.get_json()
+
+
+def test_favorites_add_and_remove(client):
+    assert client.post('/favorites', json={'city': 'Bangkok'}).json == {"success": True, "city": "Bangkok"}
+    assert client.post('/favorites', json={'city': 'Bangkok'}).json == {"error": "City already in favorites"}
+    assert client.get('/favorites').json == ["Bangkok"]
+    client.delete('/favorites', json={'city': 'Bangkok'})
+    assert client.get('/favorites').json == []
+
+def test_favorites_bulk_add_and_remove(client):
+    client.post('/favorites', json={'city': 'Bangkok'})
+    response = client.post('/favorites/bulk', json={'cities': ['Tokyo', 'Bangkok', 'Paris', 'Tokyo']})
+    assert response.status_code == 200
+    assert response.json == {"success": True, "added": ["Tokyo", "Paris"], "skipped": ["Bangkok"]}
+    assert client.get('/favorites').json == ["Bangkok", "Tokyo", "Paris"]
+
+    response = client.delete('/favorites/bulk', json={'cities': ['Tokyo', 'London']})
+    assert response.json == {"success": True, "removed": ["Tokyo"]}
+    assert client.get('/favorites').json == ["Bangkok", "Paris"]
+
+def test_favorites_bulk_requires_cities(client):
+    response = client.post('/favorites/bulk', json={'cities': []})
+    assert response.status_code == 400
+    assert response.json == {"error": "Cities not provided"}
+
+def test_favorites_bulk_rejects_non_object_bodies(client):
+    for method in (client.post, client.delete):
+        response = method('/favorites/bulk', json=['Tokyo'])
+        assert response.status_code == 400
+        assert response.json == {"error": 'Body must be a JSON object like {"cities": [...]}'}
+    assert client.get('/favorites').json == []
+
+def test_warmed_favorites_render_with_current_conditions(monkeypatch, client):
+    payloads = {
+        main.GEOCODING_API_URL: [{"name": "Bangkok", "lat": 13.7563, "lon": 100.5018, "country": "TH"}],
+        main.WEATHER_API_URL: {
+            "name": "Bangkok", "timezone": 25200,
+            "sys": {"sunrise": 1704150000, "sunset": 1704191000},
+            "main": {"temp": 31.2, "feels_like": 35.4, "temp_min": 30.1, "temp_max": 32.8, "humidity": 60},
+            "wind": {"speed": 2.5, "deg": 90},
+            "coord": {"lat": 13.7563, "lon": 100.5018},
+            "weather": [{"description": "few clouds", "icon": "02d"}],
+        },
+        main.FORECAST_API_URL: {"list": []},
+        main.AIR_QUALITY_API_URL: {"list": [{"main": {"aqi": 2}, "components": {"pm2_5": 12.5}}]},
+    }
+    calls = serve_payloads(monkeypatch, payloads)
+    monkeypatch.setattr('main.list_favorites', lambda: ["Bangkok"])
+
+    assert main.favorites_warmer.run_once() == 1
+    assert len(calls) == 3  # Bangkok is in the gazetteer, so there is no geocoding call
+
+    page = client.get('/').data.decode()
+    assert '31°C' in page
+    assert 'AQI 2' in page
+
+    client.get('/dashboard?city=Bangkok')
+    assert len(calls) == 3
+
+
 def test_health_analysis_missing_payload(client):
     response = client.post('/health_analysis', json={})
     assert response.status_code == 400
     assert response.is_json
     assert "error" in response.get_json()
 
+def test_health_analysis_reuses_answer_for_similar_conditions(monkeypatch, client):
+    prompts = []
+
+    class FakeModel:
+        def __init__(self, name):
+            self.name = name
+
+        def generate_content(self, prompt):
+            prompts.append(prompt)
+            return type('Response', (), {'text': 'stay hydrated'})()
+
+        async def generate_content_async(self, prompt):
+            return self.generate_content(prompt)
+
+    monkeypatch.setattr(main, 'GEMINI_API_KEY', 'test-key')
+    monkeypatch.setattr(main, 'gemini_model', lambda: FakeModel(main.HEALTH_MODEL))
+    air_quality = {'aqi': 3, 'description': 'Moderate', 'components': {'pm2_5': 35.4, 'o3': 61.2}}
+
+    for temperature, pm2_5 in ((30.2, 35.4), (29.8, 35.1)):
+        payload = {
+            'weather_data': {'temperature': temperature, 'description': 'Clear sky', 'humidity': 71, 'wind_speed': 10.3},
+            'air_quality_data': dict(air_quality, components={'pm2_5': pm2_5, 'o3': 61.2}),
+        }
+        response = client.post('/health_analysis', json=payload)
+        assert response.status_code == 200
+        assert response.get_json() == {"analysis": "stay hydrated"}
+
+    assert len(prompts) == 1
+    assert '30' in prompts[0]
+    stats = client.get('/cache_stats').get_json()['health_analysis']
+    assert stats['hits'] == 1
+    assert stats['saved_loads'] == 1
+
+
+HEALTH_PAYLOAD = {
+    'weather_data': {'temperature': 30.2, 'description': 'Clear sky', 'humidity': 71, 'wind_speed': 10.3},
+    'air_quality_data': {'aqi': 3, 'description': 'Moderate', 'components': {'pm2_5': 35.4}},
+}
+
+
+def fake_streaming_model(chunks, calls):
+    class Chunk:
+        def __init__(self, text):
+            self.text = text
+
+    class AsyncChunks:
+        def __init__(self):
+            self._chunks = iter(chunks)
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            try:
+                return Chunk(next(self._chunks))
+            except StopIteration:
+                raise StopAsyncIteration
+
+    class FakeModel:
+        def __init__(self, name):
+            pass
+
+        def generate_content(self, prompt, stream=False, request_options=None):
+            calls.append(prompt)
+            return (Chunk(text) for text in chunks)
+
+        async def generate_content_async(self, prompt, stream=False):
+            calls.append(prompt)
+            return AsyncChunks()
+
+    return FakeModel
+
+
+def parse_sse(body):
+    events = []
+    for message in body.decode('utf-8').strip().split('\n\n'):
+        if message.startswith(':'):
+            continue
+        fields = dict(line.split(': ', 1) for line in message.split('\n'))
+        events.append((fields['event'], json.loads(fields['data'])))
+    return events
+
+
+def test_health_analysis_stream_sends_chunks_then_caches(monkeypatch, client):
+    calls = []
+    monkeypatch.setattr(main, 'GEMINI_API_KEY', 'test-key')
+    monkeypatch.setattr(main, 'gemini_model', lambda: fake_streaming_model(['## Advice', ' drink water'], calls)(main.HEALTH_MODEL))
+
+    response = client.post('/health_analysis/stream', json=HEALTH_PAYLOAD)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    assert parse_sse(response.data) == [
+        ('chunk', {'text': '## Advice'}),
+        ('chunk', {'text': ' drink water'}),
+        ('done', {'cached': False}),
+    ]
+
+    response = client.post('/health_analysis/stream', json=HEALTH_PAYLOAD)
+    assert parse_sse(response.data) == [('chunk', {'text': '## Advice drink water'}), ('done', {'cached': True})]
+    assert client.post('/health_analysis', json=HEALTH_PAYLOAD).get_json() == {"analysis": "## Advice drink water"}
+    assert len(calls) == 1
+
+
+def test_health_analysis_stream_followers_replay_the_generation_in_flight(monkeypatch, client):
+    calls = []
+    monkeypatch.setattr(main, 'GEMINI_API_KEY', 'test-key')
+    monkeypatch.setattr(main, 'gemini_model', lambda: fake_streaming_model(['unused'], calls)(main.HEALTH_MODEL))
+    monkeypatch.setattr(main, 'analysis_streams', StreamFlights())
+    key = main.health_analysis_request(HEALTH_PAYLOAD)[0]
+    flight, leader = main.analysis_streams.join(key)
+    assert leader
+    flight.append('## Advice')
+
+    def finish():
+        time.sleep(0.05)
+        flight.append(' drink water')
+        main.analysis_streams.finish(key, flight)
+
+    threading.Thread(target=finish).start()
+    assert parse_sse(client.post('/health_analysis/stream', json=HEALTH_PAYLOAD).data) == [
+        ('chunk', {'text': '## Advice'}),
+        ('chunk', {'text': ' drink water'}),
+        ('done', {'cached': False, 'shared': True}),
+    ]
+    assert calls == []
+    assert main.analysis_streams.stats == {'leaders': 1, 'followers': 1}
+
+
+def test_health_analysis_stream_reports_failures_as_events(monkeypatch, client):
+    monkeypatch.setattr(main, 'GEMINI_API_KEY', 'test-key')
+    monkeypatch.setattr(main, 'HEALTH_STREAM_TIMEOUT', 0)
+    monkeypatch.setattr(main, 'gemini_model', lambda: fake_streaming_model(['never sent'], [])(main.HEALTH_MODEL))
+
+    events = parse_sse(client.post('/health_analysis/stream', json=HEALTH_PAYLOAD).data)
+    assert [event for event, _ in events] == ['error']
+    assert 'within 0s' in events[0][1]['error']
+    assert main.analysis_cache.peek(main.health_analysis_request(HEALTH_PAYLOAD)[0]) is None
+
+
+def test_health_analysis_stream_validates_payload(client):
+    response = client.post('/health_analysis/stream', json={})
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "Weather or air quality data not provided"}
+
+
+def test_importing_main_leaves_gemini_sdk_unloaded(tmp_path):
+    env = dict(os.environ, ANALYSIS_CACHE_DB_PATH=str(tmp_path / 'cache.db'), BUDGET_DB_PATH=str(tmp_path / 'cache.db'), DATABASE_PATH=str(tmp_path / 'db.db'))
+    result = subprocess.run([sys.executable, '-c', "import sys, main; print('google.generativeai' in sys.modules)"],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True, text=True)
+    assert result.stdout.strip().splitlines()[-1] == 'False'
+
+
+def test_gemini_model_is_configured_once(monkeypatch):
+    monkeypatch.setattr(main, '_gemini_model', None)
+    monkeypatch.setattr(main, 'GEMINI_API_KEY', 'test-key')
+    model = main.gemini_model()
+    assert model.model_name == f"models/{main.HEALTH_MODEL}"
+    assert main.gemini_model() is model
+
+
+def test_create_app_prepares_storage_and_optionally_starts_tasks(monkeypatch, tmp_path):
+    store = FavoritesStore(str(tmp_path / 'favorites.db'))
+    started = []
+    monkeypatch.setattr(main, 'favorites_store', store)
+    monkeypatch.setattr(main, 'start_background_tasks', lambda: started.append(True))
+
+    assert main.create_app(start_tasks=False) is main.app
+    assert started == [] and (tmp_path / 'favorites.db').exists()
+    assert main.create_app() is main.app
+    assert started == [True]
+
+
+def test_quantize_health_inputs_buckets_readings():
+    weather, air_quality = main.quantize_health_inputs(
+        {'temperature': 31.6, 'description': ' Light Rain', 'humidity': 83, 'wind_speed': 12.9, 'city': 'Bangkok'},
+        {'aqi': 2, 'description': 'Fair', 'components': {'pm10': 123.4, 'co': 0}})
+    assert weather == {'temperature': 32, 'description': 'light rain', 'humidity': 85, 'wind_speed': 12}
+    assert air_quality['components'] == {'co': 0, 'pm10': 120.0}
+
+
+def test_live_streams_snapshot_from_one_shared_poller(monkeypatch, client, fake_openweather):
+    monkeypatch.setattr(main, 'live_hub', LiveHub(main.live_snapshot, interval=0.05))
+    monkeypatch.setattr(main, 'LIVE_STREAM_DURATION', 0.3)
+    monkeypatch.setattr(main, 'LIVE_HEARTBEAT', 0.1)
+
+    response = client.get('/live?city=Bangkok')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    events = parse_sse(response.data)
+    response.close()
+    assert [event for event, _ in events] == ['update']
+    snapshot = events[0][1]
+    assert snapshot['weather']['city'] == 'Bangkok'
+    assert snapshot['air_quality']['aqi'] in range(1, 6)
+    assert 'forecast' not in snapshot
+    # The poller re-read the caches several times but upstream was called once per endpoint.
+    assert main.live_hub.stats['polls'] > 1
+    assert fake_openweather.stats()['/data/2.5/weather'] == 1
+    assert main.live_hub.locations() == {}
+
+
+def test_live_rejects_when_too_many_locations_are_followed(monkeypatch, client, fake_openweather):
+    monkeypatch.setattr(main, 'live_hub', LiveHub(main.live_snapshot, max_locations=0))
+    response = client.get('/live?city=Bangkok')
+    assert response.status_code == 503
+    assert client.get('/live').status_code == 400
+
+
+def test_asgi_live_subscribes_only_once_the_body_starts(monkeypatch, fake_openweather):
+    monkeypatch.setattr(main, 'live_hub', LiveHub(main.live_snapshot, interval=0.05))
+    monkeypatch.setattr(main, 'LIVE_STREAM_DURATION', 0.1)
+
+    async def call():
+        async with asgi.app.test_request_context('/live?city=Bangkok'):
+            response = await asgi.live()
+        # A client that disconnects before the body starts leaves no poller behind.
+        assert response.status_code == 200
+        assert main.live_hub.locations() == {}
+        async with response.response as body:
+            events = [chunk async for chunk in body]
+        assert events[0].startswith('event: update')
+        assert main.live_hub.locations() == {}
+        await asgi.openweather_async.aclose()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(call())
+    finally:
+        loop.close()
+
+
+def test_live_streams_are_capped_per_wsgi_worker(monkeypatch, fake_openweather):
+    monkeypatch.setattr(main, 'live_hub', LiveHub(main.live_snapshot, interval=0.05))
+    monkeypatch.setattr(main, 'live_stream_slots', threading.BoundedSemaphore(1))
+    monkeypatch.setattr(main, 'LIVE_STREAM_DURATION', 0.1)
+    with app.test_client() as client:
+        first = client.get('/live?city=Bangkok', buffered=False)
+        assert first.status_code == 200
+        assert client.get('/live?city=Bangkok').status_code == 503
+        first.close()
+        # Closing the first stream frees its slot.
+        second = client.get('/live?city=Bangkok')
+        assert second.status_code == 200
+        second.close()
+
+        monkeypatch.setattr(main, 'live_stream_slots', None)
+        assert client.get('/live?city=Bangkok').status_code == 503
+    assert main.live_hub.locations() == {}
+
+
+def test_index_follows_live_updates_only_under_asgi(client):
+    enabled = 'true' if isinstance(client, ASGITestClient) else 'false'
+    assert f'const liveEnabled = {enabled};' in client.get('/').data.decode()
+
+
 if __name__ == "__main__":
     import pytest
-    sys.exit(pytest.main([__file__]))
\ No newline at end of file
+    sys.exit(pytest.main([__file__]))
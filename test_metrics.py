@@ -0,0 +1,83 @@
+import contextvars
+import threading
+
+import pytest
+
+import metrics
+
+
+def test_counter_and_gauge_render_with_labels():
+    registry = metrics.Registry()
+    requests = registry.counter('requests_total', 'Requests.', ('route', 'status'))
+    in_flight = registry.gauge('in_flight', 'In flight.')
+    requests.inc(route='/weather', status=200)
+    requests.inc(2, route='/weather', status=200)
+    requests.inc(route='/say "hi"', status=500)
+    in_flight.inc()
+    in_flight.dec()
+
+    text = registry.render()
+    assert '# TYPE requests_total counter' in text
+    assert 'requests_total{route="/weather",status="200"} 3' in text
+    assert 'requests_total{route="/say \\"hi\\"",status="500"} 1' in text
+    assert 'in_flight 0' in text
+    assert text.endswith('\n')
+
+
+def test_labels_must_match_declaration():
+    counter = metrics.Counter('c', 'c.', ('route',))
+    with pytest.raises(ValueError):
+        counter.inc(path='/')
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram('latency_seconds', 'Latency.', ('route',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 3.0):
+        histogram.observe(value, route='/')
+
+    lines = histogram.render()
+    assert 'latency_seconds_bucket{route="/",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{route="/",le="1.0"} 3' in lines
+    assert 'latency_seconds_bucket{route="/",le="+Inf"} 4' in lines
+    assert 'latency_seconds_sum{route="/"} 4.05' in lines
+    assert histogram.count(route='/') == 4
+
+
+def test_collectors_run_on_every_scrape():
+    registry = metrics.Registry()
+    scrapes = []
+
+    @registry.collector
+    def collect():
+        scrapes.append(1)
+        gauge = metrics.Gauge('scrapes', 'Scrapes so far.')
+        gauge.set(len(scrapes))
+        return [gauge]
+
+    assert 'scrapes 1' in registry.render()
+    assert 'scrapes 2' in registry.render()
+
+
+def test_server_timing_counts_parallel_upstream_calls_once(monkeypatch):
+    clock = iter([0.0, 0.3, 0.1, 0.4]).__next__
+    monkeypatch.setattr(metrics.time, 'perf_counter', clock)
+    metrics.start_timing()
+    # Two overlapping calls: 0.0-0.3 and 0.1-0.4 cover 0.4s of wall time.
+    first, second = metrics.upstream_span(), metrics.upstream_span()
+    first.__enter__()
+    first.__exit__(None, None, None)
+    second.__enter__()
+    second.__exit__(None, None, None)
+    metrics.add_timing('serialize', 0.05)
+
+    assert metrics.server_timing(0.5) == (
+        'upstream;desc="2 calls";dur=400.0, app;dur=50.0, serialize;dur=50.0, total;dur=500.0')
+
+
+def test_timings_follow_the_context_into_worker_threads():
+    timings = metrics.start_timing()
+    context = contextvars.copy_context()
+    worker = threading.Thread(target=context.run, args=(lambda: metrics.add_timing('serialize', 0.25),))
+    worker.start()
+    worker.join()
+    assert timings['serialize'] == 0.25
@@ -0,0 +1,85 @@
+import pytest
+
+from cache import SQLiteBackend
+from ratelimit import RateLimiter, UpstreamBudget
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_allows_a_burst_then_refills_at_the_rate():
+    clock = FakeClock()
+    limiter = RateLimiter(per_minute=60, burst=3, clock=clock)
+    assert [limiter.allow('1.2.3.4', '/weather') for _ in range(3)] == [0, 0, 0]
+    assert limiter.allow('1.2.3.4', '/weather') == pytest.approx(1.0)
+    # Other clients and other routes have their own buckets.
+    assert limiter.allow('5.6.7.8', '/weather') == 0
+    assert limiter.allow('1.2.3.4', '/forecast') == 0
+
+    clock.now += 1.5
+    assert limiter.allow('1.2.3.4', '/weather') == 0
+    assert limiter.allow('1.2.3.4', '/weather') == pytest.approx(0.5)
+
+
+def test_route_limits_and_disabled_routes():
+    limiter = RateLimiter(per_minute=60, burst=10, routes={'/health_analysis': (6, 1), '/metrics': (0, 0)},
+                          clock=FakeClock())
+    assert limiter.allow('a', '/health_analysis') == 0
+    assert limiter.allow('a', '/health_analysis') == pytest.approx(10.0)
+    assert all(limiter.allow('a', '/metrics') == 0 for _ in range(100))
+
+
+def test_least_recently_used_buckets_are_dropped():
+    limiter = RateLimiter(per_minute=60, burst=1, max_clients=2, clock=FakeClock())
+    limiter.allow('a', '/weather')
+    limiter.allow('b', '/weather')
+    limiter.allow('c', '/weather')
+    # 'a' was forgotten, so it starts again with a full bucket; 'c' was not.
+    assert limiter.allow('a', '/weather') == 0
+    assert limiter.allow('c', '/weather') > 0
+
+
+def test_budget_refuses_calls_beyond_the_window_cap_until_it_rolls_over():
+    clock = FakeClock(1200.0)
+    budget = UpstreamBudget('openweather', per_minute=3, per_day=100, clock=clock)
+    assert [budget.spend('weather') for _ in range(3)] == [True, True, True]
+    assert budget.spend('forecast') is False
+    assert budget.remaining() == {'minute': 0, 'day': 97}
+    assert budget.calls == {'weather': 3} and budget.rejected == 1
+
+    clock.now += 60
+    assert budget.spend('forecast') is True
+    assert budget.remaining() == {'minute': 2, 'day': 96}
+
+
+def test_ttl_scale_grows_as_the_budget_runs_out():
+    budget = UpstreamBudget('gemini', per_minute=0, per_day=8, reserve=0.5, max_stretch=4.0, clock=FakeClock())
+    assert budget.ttl_scale() == 1.0
+    for _ in range(4):
+        budget.spend('generate')
+    assert budget.ttl_scale() == 1.0 and not budget.low()
+    for _ in range(2):
+        budget.spend('generate')
+    assert budget.low()
+    assert budget.ttl_scale() == pytest.approx(2.5)
+    for _ in range(2):
+        budget.spend('generate')
+    assert budget.ttl_scale() == pytest.approx(4.0)
+    assert UpstreamBudget('unlimited').ttl_scale() == 1.0
+
+
+def test_workers_sharing_a_backend_share_the_budget(tmp_path):
+    clock = FakeClock()
+    workers = [UpstreamBudget('openweather', per_minute=4, backend=SQLiteBackend(str(tmp_path / 'cache.db')),
+                              clock=clock) for _ in range(2)]
+    results = [workers[i % 2].spend('weather') for i in range(6)]
+    assert results == [True, True, True, True, False, False]
+    assert workers[0].remaining() == workers[1].remaining() == {'minute': 0}
+
+    workers[0].reset()
+    assert workers[1].remaining() == {'minute': 4}
@@ -0,0 +1,180 @@
+import asyncio
+
+import pytest
+import requests
+
+from upstream import AsyncUpstreamClient, AuthError, CircuitBreaker, CircuitOpenError, UpstreamClient
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload=None, headers=None):
+        self.status_code = status_code
+        self.payload = payload or {}
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code}", response=self)
+
+    def json(self):
+        return self.payload
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_client(responses, **kwargs):
+    sleeps = []
+    client = UpstreamClient('test', sleep=sleeps.append, **kwargs)
+    calls = []
+
+    def fake_get(url, params=None, timeout=None):
+        calls.append(timeout)
+        result = responses.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    client.session.get = fake_get
+    return client, calls, sleeps
+
+
+def test_retries_transient_errors_then_succeeds():
+    client, calls, sleeps = make_client([
+        FakeResponse(503),
+        requests.exceptions.ConnectTimeout("slow"),
+        FakeResponse(200, {"ok": True}),
+    ], connect_timeout=1, read_timeout=2, max_retries=2, backoff_base=0.5)
+
+    assert client.get_json('http://upstream/x') == {"ok": True}
+    assert calls == [(1, 2)] * 3
+    assert len(sleeps) == 2
+    assert 0 <= sleeps[0] <= 0.5 and 0 <= sleeps[1] <= 1.0
+
+
+def test_retry_after_is_honoured_for_429():
+    client, _, sleeps = make_client([
+        FakeResponse(429, headers={'Retry-After': '3'}),
+        FakeResponse(200, {"ok": True}),
+    ], max_retries=1)
+
+    client.get_json('http://upstream/x')
+    assert sleeps == [3]
+
+
+def test_gives_up_after_max_retries():
+    client, calls, _ = make_client([FakeResponse(502)] * 3, max_retries=2)
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.get_json('http://upstream/x')
+    assert len(calls) == 3
+
+
+def test_on_retry_runs_before_each_retry_and_can_stop_them():
+    client, calls, _ = make_client([FakeResponse(503), FakeResponse(503), FakeResponse(200, {"ok": True})],
+                                   max_retries=2)
+    retries = []
+    assert client.get_json('http://upstream/x', on_retry=lambda: retries.append(len(calls))) == {"ok": True}
+    assert retries == [1, 2]
+
+    class OutOfBudget(Exception):
+        pass
+
+    def refuse():
+        raise OutOfBudget()
+
+    client, calls, sleeps = make_client([FakeResponse(503), FakeResponse(200)], max_retries=2)
+    with pytest.raises(OutOfBudget):
+        client.get_json('http://upstream/x', on_retry=refuse)
+    assert len(calls) == 1 and sleeps == []
+
+
+def test_max_call_duration_covers_every_attempt_and_backoff():
+    client = UpstreamClient('test', connect_timeout=3, read_timeout=10, max_retries=2, backoff_cap=8)
+    assert client.max_call_duration() == 13 * 3 + 8 * 2
+
+
+def test_client_errors_are_not_retried():
+    client, calls, _ = make_client([FakeResponse(404)], max_retries=2)
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.get_json('http://upstream/x')
+    assert len(calls) == 1
+
+    client, _, _ = make_client([FakeResponse(401)])
+    with pytest.raises(AuthError):
+        client.get_json('http://upstream/x')
+
+
+def test_circuit_opens_and_recovers():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=clock)
+    client, calls, _ = make_client(
+        [FakeResponse(500), FakeResponse(500), FakeResponse(200, {"ok": True})],
+        max_retries=0, breaker=breaker)
+
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.HTTPError):
+            client.get_json('http://upstream/x')
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        client.get_json('http://upstream/x')
+    assert len(calls) == 2
+
+    clock.now += 31
+    assert breaker.state == 'half-open'
+    assert client.get_json('http://upstream/x') == {"ok": True}
+    assert breaker.state == 'closed'
+
+
+def test_trial_call_refused_by_on_retry_does_not_wedge_the_breaker():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock)
+    client, calls, _ = make_client(
+        [FakeResponse(503), FakeResponse(503), FakeResponse(503), FakeResponse(200, {"ok": True})],
+        max_retries=1, breaker=breaker)
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.get_json('http://upstream/x')
+    assert breaker.state == 'open'
+
+    class OutOfBudget(Exception):
+        pass
+
+    def refuse():
+        raise OutOfBudget()
+
+    clock.now += 31
+    # The half-open trial gets a 503 and its retry is refused by the budget.
+    with pytest.raises(OutOfBudget):
+        client.get_json('http://upstream/x', on_retry=refuse)
+    assert client.get_json('http://upstream/x') == {"ok": True}
+    assert breaker.state == 'closed'
+
+
+def test_async_client_retries_and_shares_error_types():
+    sleeps = []
+
+    async def fake_sleep(delay):
+        sleeps.append(delay)
+
+    client = AsyncUpstreamClient('test', sleep=fake_sleep, max_retries=1)
+    responses = [requests.exceptions.ConnectionError("reset"), FakeResponse(200, {"ok": True}), FakeResponse(401)]
+
+    async def fake_send(url, params):
+        result = responses.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    client._send = fake_send
+
+    async def run():
+        assert await client.get_json('http://upstream/x') == {"ok": True}
+        with pytest.raises(AuthError):
+            await client.get_json('http://upstream/x')
+
+    asyncio.run(run())
+    assert len(sleeps) == 1
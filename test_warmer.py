@@ -0,0 +1,44 @@
+import threading
+import time
+
+from warmer import CacheWarmer
+
+
+def test_run_once_warms_every_item_with_bounded_concurrency():
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def warm(item):
+        with lock:
+            active.append(item)
+            peak.append(len(active))
+        time.sleep(0.02)
+        with lock:
+            active.remove(item)
+        if item == 'bad':
+            raise ValueError("upstream down")
+
+    warmer = CacheWarmer('test', lambda: ['a', 'b', 'c', 'd', 'bad'], warm, concurrency=2)
+    assert warmer.run_once() == 4
+    assert max(peak) <= 2
+    assert warmer.stats == {'runs': 1, 'warmed': 4, 'errors': 1}
+
+
+def test_start_runs_until_stopped():
+    runs = threading.Event()
+    warmer = CacheWarmer('test', lambda: ['a'], lambda item: runs.set(), interval=60)
+    warmer.start()
+    assert runs.wait(1)
+    warmer.stop()
+
+
+def test_only_the_lock_holder_warms(tmp_path):
+    path = str(tmp_path / 'warmer.lock')
+    first = CacheWarmer('test', lambda: ['a'], lambda item: None, lock_path=path)
+    second = CacheWarmer('test', lambda: ['a'], lambda item: None, lock_path=path)
+    assert first.holds_lock() and first.holds_lock()
+    # flock locks belong to the open file, so a second warmer is refused even within one process.
+    assert not second.holds_lock()
+    first._lock_file.close()
+    assert second.holds_lock()
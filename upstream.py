@@ -0,0 +1,248 @@
+"""Shared HTTP client for upstream APIs.
+
+One ``UpstreamClient`` per upstream service keeps a pooled keep-alive
+``requests.Session``, applies connect/read timeouts to every call, retries
+429/5xx responses and connection errors with jittered exponential backoff,
+and trips a circuit breaker after repeated failures so callers fail fast
+while the service is down.
+
+``AsyncUpstreamClient`` is the asyncio twin built on ``httpx.AsyncClient``;
+it raises the same exception types so callers can share error handling.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class AuthError(requests.exceptions.RequestException):
+    """The upstream rejected our credentials (HTTP 401)."""
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """The circuit breaker is open, so the call was not attempted."""
+
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures.
+
+    While open every call is rejected until ``reset_timeout`` seconds have
+    passed; then a single trial call is let through (half-open) and its
+    outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if self._clock() - self._opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._clock() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        """End a half-open trial that finished without an outcome (e.g. it was cancelled)."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                self._opened_at = self._clock()
+            self._trial_in_flight = False
+
+
+class _RetryingClient:
+    def __init__(self, name, connect_timeout=3.05, read_timeout=10.0, max_retries=2, backoff_base=0.5,
+                 backoff_cap=8.0, pool_size=20, breaker=None, sleep=None):
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.pool_size = pool_size
+        self.breaker = breaker or CircuitBreaker()
+        self._sleep = sleep
+
+    def max_call_duration(self):
+        """Longest a ``get_json`` call can take: every attempt timing out, plus the longest backoffs."""
+        connect_timeout, read_timeout = self.timeout
+        return (connect_timeout + read_timeout) * (self.max_retries + 1) + self.backoff_cap * self.max_retries
+
+    def _backoff(self, attempt, response=None):
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        if response is not None and response.status_code == 429:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                delay = max(delay, min(self.backoff_cap, int(retry_after)))
+        return delay
+
+    def _check_circuit(self, url):
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.name} circuit is open; skipping call to {url}")
+
+    def _finish(self, response):
+        if response.status_code == 401:
+            # Bad credentials say nothing about the service's health.
+            self.breaker.record_success()
+            raise AuthError(f"{self.name} rejected the API key", response=response)
+        self.breaker.record_success()
+        if response.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{response.status_code} from {self.name}", response=response)
+        return response.json()
+
+
+class UpstreamClient(_RetryingClient):
+    def __init__(self, name, sleep=time.sleep, **kwargs):
+        super().__init__(name, sleep=sleep, **kwargs)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_json(self, url, params=None, on_retry=None):
+        """GET ``url`` and return the decoded JSON body.
+
+        Raises ``AuthError`` on 401, ``CircuitOpenError`` while the breaker is
+        open, and other ``requests`` exceptions once retries are exhausted.
+        ``on_retry()`` is called before every retry (e.g. to charge it to a
+        call budget); whatever it raises ends the call.
+        """
+        self._check_circuit(url)
+        try:
+            return self._get_json(url, params, on_retry)
+        except BaseException:
+            # Without this a trial call ended by on_retry would keep the breaker half-open, refusing every call.
+            self.breaker.release_trial()
+            raise
+
+    def _get_json(self, url, params, on_retry):
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+                logger.debug("%s: %s responded %s", self.name, url, response.status_code)
+                if response.status_code not in RETRY_STATUSES:
+                    break
+                error = requests.exceptions.HTTPError(f"{response.status_code} from {url}", response=response)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+            except requests.exceptions.RequestException:
+                self.breaker.record_failure()
+                raise
+            if attempt >= self.max_retries:
+                self.breaker.record_failure()
+                raise error
+            if on_retry is not None:
+                on_retry()
+            delay = self._backoff(attempt, response)
+            logger.warning("%s: retrying %s in %.2fs after %s", self.name, url, delay, error)
+            self._sleep(delay)
+            attempt += 1
+
+        return self._finish(response)
+
+
+class AsyncUpstreamClient(_RetryingClient):
+    def __init__(self, name, sleep=asyncio.sleep, **kwargs):
+        super().__init__(name, sleep=sleep, **kwargs)
+        # httpx connection pools are bound to the event loop that created them.
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self):
+        import httpx
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            connect_timeout, read_timeout = self.timeout
+            client = self._clients[loop] = httpx.AsyncClient(
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size))
+        return client
+
+    async def _send(self, url, params):
+        import httpx
+
+        try:
+            return await self._client().get(url, params=params)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+
+    async def get_json(self, url, params=None, on_retry=None):
+        """Coroutine version of ``UpstreamClient.get_json``."""
+        self._check_circuit(url)
+        try:
+            return await self._get_json(url, params, on_retry)
+        except BaseException:
+            self.breaker.release_trial()
+            raise
+
+    async def _get_json(self, url, params, on_retry):
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = await self._send(url, params)
+                logger.debug("%s: %s responded %s", self.name, url, response.status_code)
+                if response.status_code not in RETRY_STATUSES:
+                    break
+                error = requests.exceptions.HTTPError(f"{response.status_code} from {url}", response=response)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+            except requests.exceptions.RequestException:
+                self.breaker.record_failure()
+                raise
+            if attempt >= self.max_retries:
+                self.breaker.record_failure()
+                raise error
+            if on_retry is not None:
+                on_retry()
+            delay = self._backoff(attempt, response)
+            logger.warning("%s: retrying %s in %.2fs after %s", self.name, url, delay, error)
+            await self._sleep(delay)
+            attempt += 1
+
+        return self._finish(response)
+
+    async def aclose(self):
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
@@ -0,0 +1,91 @@
+"""Background cache warmer.
+
+``CacheWarmer`` periodically calls ``warm(item)`` for every item returned by
+``list_items()``, at most ``concurrency`` at a time, so popular lookups are
+already cached when a user asks for them.
+
+Given a ``lock_path``, only the process holding an exclusive lock on that
+file warms, so several workers on one host don't each repeat the same
+upstream calls; the others try again every ``interval`` and take over if the
+holder exits.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Windows: every process warms
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class CacheWarmer:
+    def __init__(self, name, list_items, warm, interval=300, concurrency=4, lock_path=None):
+        self.name = name
+        self.list_items = list_items
+        self.warm = warm
+        self.interval = interval
+        self.concurrency = concurrency
+        self.lock_path = lock_path
+        self._lock_file = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {'runs': 0, 'warmed': 0, 'errors': 0}
+
+    def holds_lock(self):
+        """Take the warm lock if it is free; True while this process holds it (or there is none)."""
+        if self.lock_path is None or fcntl is None:
+            return True
+        if self._lock_file is not None:
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        # Kept open for the life of the process; the OS releases the lock when it exits.
+        self._lock_file = lock_file
+        logger.info("%s warmer: warming from process %d", self.name, os.getpid())
+        return True
+
+    def _warm_one(self, item):
+        try:
+            self.warm(item)
+            return True
+        except Exception as e:
+            logger.warning("%s warmer: could not warm %r: %s", self.name, item, e)
+            return False
+
+    def run_once(self):
+        """Warm every item once; returns the number warmed successfully."""
+        items = list(self.list_items())
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix=f"warm-{self.name}") as pool:
+            results = list(pool.map(self._warm_one, items))
+        warmed = sum(results)
+        self.stats['runs'] += 1
+        self.stats['warmed'] += warmed
+        self.stats['errors'] += len(results) - warmed
+        logger.debug("%s warmer: warmed %d/%d items", self.name, warmed, len(items))
+        return warmed
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.holds_lock():
+                    self.run_once()
+            except Exception as e:
+                logger.error("%s warmer: run failed: %s", self.name, e)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=f"warmer-{self.name}", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()